@@ -0,0 +1,574 @@
+"""
+This module benchmarks marketplace implementations on generated scenarios
+
+Scenarios are built with the functions of test-gen/test_generator.py (or read
+from an existing .in file), every implementation runs them in its own process
+and the measurements are printed as JSON, so runs can be compared over time.
+
+Usage example:
+    python3 benchmark.py --producers 200 --consumers 1000 --products 20 \\
+        --time-scale 0 -i global -i striped -i striped+blocking+batch -o bench.json
+
+--queue-micro instead compares the producer queue backends alone: threads
+taking and freeing slots of one shared queue as fast as they can.
+
+--remote-micro compares the in-process Marketplace with one served over
+loopback TCP by another process (tema.remote_marketplace): ops/sec and call
+latency of threads publishing and buying without sleeping, one call at a
+time and with --pipeline-depth calls in flight per thread.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+from threading import Lock, Thread
+
+from tema.producer import Producer
+from tema.consumer import Consumer
+from tema.logging_pipeline import close_marketplace_logger
+from tema.marketplace import Marketplace, CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED
+from tema.metrics import MarketplaceMetrics
+from tema.order_sink import OrderSink
+from tema.producer_queue import ProducerQueue
+from tema.scenario import STREAM_SUFFIX, read_stream, resolve_config
+from tema.binary_scenario import BINARY_SUFFIX, read_binary
+from tema.selection import SELECTION_POLICIES
+from tema.sharded_marketplace import ShardedMarketplace
+from tema.remote_marketplace import MarketplaceServer, RemoteMarketplace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-gen'))
+import test_generator  # pylint: disable=wrong-import-position
+
+
+def generate_scenario(args):
+    """
+    Builds a market configuration like test_generator.py writes to the .in
+    files, from the benchmark's command line arguments.
+    """
+    random.seed(args.seed)
+    products = test_generator.generate_products(args.products)
+    producers = test_generator.generate_producers(args.producers, products, not args.complex,
+                                                  args.hot_producers, args.hot_factor)
+    for prod_id in list(products.keys()):
+        if not products[prod_id]["is_produced"]:
+            del products[prod_id]
+    consumers = test_generator.generate_consumers(args.consumers, products,
+                                                  args.min_carts, args.max_carts,
+                                                  has_remove_operation=not args.no_removal,
+                                                  basic_test=not args.complex, zipf=args.zipf)
+    for product in products.values():
+        del product["is_produced"]
+    for consumer in consumers:
+        consumer["carts"] = [cart["ops"] for cart in consumer["carts"]]
+    return {"products": products, "producers": producers, "consumers": consumers,
+            "marketplace": test_generator.generate_marketplace(args.queue_size)}
+
+
+def scale_times(market_config, scale):
+    """
+    Multiplies every sleep of the scenario by scale (0 benchmarks the
+    marketplace alone, 1 keeps the configured pacing).
+    """
+    for producer in market_config["producers"]:
+        producer["products"] = [[product, quantity, sleep_time * scale]
+                                for product, quantity, sleep_time in producer["products"]]
+        producer["republish_wait_time"] *= scale
+    for consumer in market_config["consumers"]:
+        consumer["retry_wait_time"] *= scale
+    return market_config
+
+
+class _MeasuredMarketplace:
+    """
+    Wraps a marketplace to time add_to_cart and count failed adds and publishes
+    in a MarketplaceMetrics of the client side. It keeps fixed size histograms
+    instead of every sample, so long runs do not grow without bound.
+    """
+    def __init__(self, marketplace, stats):
+        self.marketplace = marketplace
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.marketplace, name)
+
+    def add_to_cart(self, cart_id, product, timeout=0):
+        """
+        Timed Marketplace.add_to_cart.
+        """
+        start = time.perf_counter()
+        added = self.marketplace.add_to_cart(cart_id, product, timeout=timeout)
+        self.stats.observe('add_latency', time.perf_counter() - start)
+        if not added:
+            self.stats.count('add_retries')
+        return added
+
+    def add_many(self, cart_id, product, quantity, timeout=0):
+        """
+        Timed Marketplace.add_many.
+        """
+        start = time.perf_counter()
+        added = self.marketplace.add_many(cart_id, product, quantity, timeout=timeout)
+        self.stats.observe('add_latency', time.perf_counter() - start)
+        if not added:
+            self.stats.count('add_retries')
+        return added
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Counted Marketplace.publish.
+        """
+        self.stats.count('publish_calls')
+        published = self.marketplace.publish(producer_id, product, timeout=timeout)
+        if not published:
+            self.stats.count('publish_retries')
+        return published
+
+    def publish_many(self, producer_id, product, quantity, timeout=0):
+        """
+        Counted Marketplace.publish_many.
+        """
+        self.stats.count('publish_calls')
+        published = self.marketplace.publish_many(producer_id, product, quantity, timeout=timeout)
+        if not published:
+            self.stats.count('publish_retries')
+        return published
+
+
+class _CountingSink(OrderSink):
+    """
+    Order sink that only counts the orders and their units.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def emit(self, buyer, products):
+        self.stats.count('orders')
+        self.stats.count('units', len(products))
+
+
+def parse_implementation(name):
+    """
+    Turns an implementation name like "striped+blocking+batch", "sharded4" or
+    "global+fullest" (a selection policy) into the options of the run.
+    """
+    options = {"name": name, "concurrency": CONCURRENCY_GLOBAL, "shards": None,
+               "blocking": False, "batch": False, "selection": "first_fit"}
+    for part in name.split("+"):
+        if part in (CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED):
+            options["concurrency"] = part
+        elif part.startswith("sharded"):
+            options["shards"] = int(part[len("sharded"):] or os.cpu_count())
+        elif part in ("blocking", "batch"):
+            options[part] = True
+        elif part in SELECTION_POLICIES:
+            options["selection"] = part
+        else:
+            raise argparse.ArgumentTypeError("unknown implementation part " + part)
+    if options["shards"] and options["batch"]:
+        raise argparse.ArgumentTypeError("the sharded engine has no bulk calls, drop batch")
+    return options
+
+
+def run_scenario(market_config, options, log_sample_rate):
+    """
+    Runs the scenario once on the implementation described by options, in the
+    current process, and returns the measurements.
+    """
+    stats = MarketplaceMetrics()
+    metrics = None
+    market_config = resolve_config(market_config)
+    log_dir = tempfile.mkdtemp()
+    log_file = os.path.join(log_dir, 'marketplace.log')
+    if options["shards"]:
+        marketplace = ShardedMarketplace(**market_config["marketplace"], shards=options["shards"],
+                                         log_file=log_file, order_sink=_CountingSink(stats),
+                                         selection=options["selection"])
+    else:
+        metrics = MarketplaceMetrics()
+        marketplace = Marketplace(**market_config["marketplace"],
+                                  concurrency=options["concurrency"], log_file=log_file,
+                                  error_sample_rate=log_sample_rate,
+                                  order_sink=_CountingSink(stats), metrics=metrics,
+                                  selection=options["selection"])
+    measured = _MeasuredMarketplace(marketplace, stats)
+
+    producers = [Producer(**config, marketplace=measured, blocking=options["blocking"],
+                          batch=options["batch"], daemon=True)
+                 for config in market_config["producers"]]
+    consumers = [Consumer(**config, marketplace=measured, blocking=options["blocking"],
+                          batch=options["batch"])
+                 for config in market_config["consumers"]]
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for thread in producers + consumers:
+        thread.start()
+    for consumer in consumers:
+        consumer.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    # the daemon producers never stop: stop the shards and the log writer under them
+    if options["shards"]:
+        marketplace.close()
+    else:
+        close_marketplace_logger(log_file)
+
+    client = stats.snapshot()
+    counters = client["counters"]
+    orders = counters.get("orders", 0)
+    snapshot = metrics.snapshot() if metrics is not None else None
+    return {
+        "implementation": options["name"],
+        "timed_out": False,
+        "elapsed_sec": elapsed,
+        "cpu_sec": cpu,
+        "orders": orders,
+        "units": counters.get("units", 0),
+        "orders_per_sec": orders / elapsed if elapsed else None,
+        "add_to_cart": {"retries": counters.get("add_retries", 0),
+                        "latency": client["histograms"].get("add_latency")},
+        "publish": {"calls": counters.get("publish_calls", 0),
+                    "retries": counters.get("publish_retries", 0)},
+        "locks": None if snapshot is None else {
+            "wait": snapshot["histograms"].get("lock_wait"),
+            "hold": snapshot["histograms"].get("lock_hold")},
+        "marketplace_counters": None if snapshot is None else snapshot["counters"],
+    }
+
+
+def _run_child(connection, market_config, options, log_sample_rate):
+    """
+    Benchmark process: runs the scenario and sends back the measurements.
+    """
+    connection.send(run_scenario(market_config, options, log_sample_rate))
+    connection.close()
+
+
+def run_isolated(market_config, options, log_sample_rate, timeout):
+    """
+    Runs the scenario in a fresh process, so the producer threads that never
+    stop (and anything else a run leaves behind) die with it.
+    """
+    connection, child_connection = Pipe()
+    process = Process(target=_run_child,
+                      args=(child_connection, market_config, options, log_sample_rate))
+    process.start()
+    if connection.poll(timeout):
+        result = connection.recv()
+    else:
+        result = {"implementation": options["name"], "timed_out": True}
+        process.terminate()
+    process.join()
+    return result
+
+
+class _ListQueue:
+    """
+    The original producer queue: a list of the published products, checked
+    with len() and emptied with list.remove, here under a lock.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = ["other"] * (capacity // 2) # products of other consumers' interest
+        self.lock = Lock()
+
+    def reserve(self, wanted=1):
+        """
+        Publishes wanted units, if they fit.
+        """
+        with self.lock:
+            if len(self.items) + wanted > self.capacity:
+                return None
+            self.items.extend(["product"] * wanted)
+            return wanted
+
+    def release(self, count=1):
+        """
+        Takes count units off the queue.
+        """
+        with self.lock:
+            for _ in range(count):
+                self.items.remove("product")
+
+
+class _CountedQueue:
+    """
+    A count of the units on the market under a lock, what the marketplace
+    used before ProducerQueue.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.lock = Lock()
+
+    def reserve(self, wanted=1):
+        """
+        Takes up to wanted slots.
+        """
+        with self.lock:
+            taken = min(self.capacity - self.count, wanted)
+            if taken <= 0:
+                return None
+            self.count += taken
+            return taken
+
+    def release(self, count=1):
+        """
+        Frees count slots.
+        """
+        with self.lock:
+            self.count -= count
+
+
+QUEUE_BACKENDS = {"list": _ListQueue, "counted": _CountedQueue, "producer_queue": ProducerQueue}
+
+
+def micro_producer_queues(capacity, thread_counts, ops):
+    """
+    Times ops reserve/release cycles per thread on one shared queue of every
+    backend, for every thread count.
+    """
+    results = []
+    for name, backend in QUEUE_BACKENDS.items():
+        for threads in thread_counts:
+            queue = backend(capacity)
+
+            def cycle(queue=queue):
+                for _ in range(ops):
+                    if queue.reserve():
+                        queue.release()
+
+            workers = [Thread(target=cycle) for _ in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            results.append({"backend": name, "threads": threads, "elapsed_sec": elapsed,
+                            "cycles_per_sec": threads * ops / elapsed})
+    return results
+
+
+def _serve_remote(connection, queue_size, log_file):
+    """
+    Server process of the remote microbenchmark: sends its address back, then
+    serves until terminated.
+    """
+    marketplace = Marketplace(queue_size, log_file=log_file)
+    asyncio.run(MarketplaceServer(marketplace).serve_forever(connection.send))
+
+
+def _micro_cycles(marketplace, product, ops, depth, stats):
+    """
+    ops publish + add_to_cart cycles of a new producer and cart, depth calls of
+    each kind in flight at a time (through submit) when depth > 1. Every call's
+    latency goes in the stats.
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+
+    def observe(future, start):
+        stats.observe('latency', time.perf_counter() - start)
+        if not future.result():
+            stats.count('failed')
+
+    for _ in range(ops // depth):
+        for method, owner in (("publish", producer_id), ("add_to_cart", cart_id)):
+            if depth == 1:
+                start = time.perf_counter()
+                done = getattr(marketplace, method)(owner, product)
+                stats.observe('latency', time.perf_counter() - start)
+                if not done:
+                    stats.count('failed')
+                continue
+            futures = []
+            for _ in range(depth):
+                start = time.perf_counter()
+                future = marketplace.submit(method, owner, product)
+                future.add_done_callback(lambda future, start=start: observe(future, start))
+                futures.append(future)
+            for future in futures:
+                future.result()
+
+
+def micro_remote(queue_size, thread_counts, ops, depth, connections):
+    """
+    Times _micro_cycles threads, each with its own product, on an in-process
+    Marketplace and on a remote one one call at a time and depth calls at a
+    time, for every thread count.
+    """
+    log_dir = tempfile.mkdtemp()
+    queue_size = max(queue_size, depth)
+    connection, child_connection = Pipe()
+    server = Process(target=_serve_remote, daemon=True,
+                     args=(child_connection, queue_size, os.path.join(log_dir, 'server.log')))
+    server.start()
+    address = tuple(connection.recv())
+    results = []
+    try:
+        for engine, in_flight in (("inprocess", 1), ("remote", 1), ("remote+pipelined", depth)):
+            for threads in thread_counts:
+                stats = MarketplaceMetrics()
+                if engine == "inprocess":
+                    marketplace = Marketplace(queue_size,
+                                              log_file=os.path.join(log_dir, 'marketplace.log'))
+                else:
+                    marketplace = RemoteMarketplace(address, connections=connections)
+                workers = [Thread(target=_micro_cycles,
+                                  args=(marketplace, "product%d" % i, ops, in_flight, stats))
+                           for i in range(threads)]
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - start
+                if engine != "inprocess":
+                    marketplace.close()
+                snapshot = stats.snapshot()
+                calls = snapshot["histograms"]["latency"]["count"]
+                results.append({"engine": engine, "threads": threads, "depth": in_flight,
+                                "elapsed_sec": elapsed, "ops_per_sec": calls / elapsed,
+                                "failed": snapshot["counters"].get("failed", 0),
+                                "latency": snapshot["histograms"]["latency"]})
+                print("{} with {} threads: {:.0f} ops/sec".format(engine, threads,
+                                                                 calls / elapsed),
+                      file=sys.stderr)
+    finally:
+        server.terminate()
+    return results
+
+
+def parse_args():
+    """
+    Parses the command line.
+    """
+    parser = argparse.ArgumentParser(description="marketplace throughput/latency benchmark")
+    parser.add_argument("--scenario", metavar="FILE",
+                        help="benchmark an existing .in, .ndjson or .bin file instead of "
+                             "generating a scenario")
+    parser.add_argument("--producers", type=int, default=50)
+    parser.add_argument("--consumers", type=int, default=200)
+    parser.add_argument("--products", type=int, default=10)
+    parser.add_argument("--queue-size", type=int, default=40)
+    parser.add_argument("--min-carts", type=int, default=1)
+    parser.add_argument("--max-carts", type=int, default=5)
+    parser.add_argument("--complex", action="store_true",
+                        help="generate more products per producer and bigger carts")
+    parser.add_argument("--no-removal", action="store_true",
+                        help="generate carts without remove operations")
+    parser.add_argument("--zipf", type=float, default=0,
+                        help="exponent of the Zipf law followed by the products' popularity "
+                             "(0 = uniform)")
+    parser.add_argument("--hot-producers", type=int, default=0,
+                        help="number of producers stocking every product in bulk")
+    parser.add_argument("--hot-factor", type=int, default=10,
+                        help="how many times the usual quantities the hot producers stock")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--time-scale", type=float, default=0.1,
+                        help="multiplier for every sleep of the scenario (0 = no sleeping)")
+    parser.add_argument("-i", "--implementation", action="append", type=parse_implementation,
+                        help="implementation to run: global or striped, optionally with "
+                             "+blocking and/or +batch, or shardedN, each optionally with "
+                             "+<selection policy> (default: global, striped)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per implementation")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds before a run is reported as timed out")
+    parser.add_argument("--log-sample-rate", type=int, default=1,
+                        help="log only one in N of the failed add_to_cart errors")
+    parser.add_argument("--queue-micro", action="store_true",
+                        help="only run the producer queue microbenchmark (uses --queue-size)")
+    parser.add_argument("--micro-threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--micro-ops", type=int, default=200000, help="cycles per thread")
+    parser.add_argument("--remote-micro", action="store_true",
+                        help="only run the in-process vs loopback server microbenchmark "
+                             "(uses --queue-size and --micro-threads)")
+    parser.add_argument("--remote-ops", type=int, default=5000,
+                        help="publish + add_to_cart cycles per thread of --remote-micro")
+    parser.add_argument("--pipeline-depth", type=int, default=16,
+                        help="calls in flight per thread in the pipelined remote runs")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="connections of the remote marketplace client")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    return parser.parse_args()
+
+
+def write_report(report, output):
+    """
+    Prints the report as JSON to the output file, or stdout.
+    """
+    report = json.dumps(report, indent=4)
+    if output:
+        with open(output, 'w') as output_file:
+            print(report, file=output_file)
+    else:
+        print(report)
+
+
+def main():
+    """
+    Builds the scenario, runs every implementation on it and prints the report.
+    """
+    args = parse_args()
+    if args.queue_micro:
+        report = {"queue_size": args.queue_size, "python": sys.version.split()[0],
+                  "runs": micro_producer_queues(args.queue_size, args.micro_threads,
+                                                args.micro_ops)}
+        write_report(report, args.output)
+        return
+    if args.remote_micro:
+        report = {"queue_size": args.queue_size, "python": sys.version.split()[0],
+                  "ops_per_thread": args.remote_ops, "pipeline_depth": args.pipeline_depth,
+                  "connections": args.connections,
+                  "runs": micro_remote(args.queue_size, args.micro_threads, args.remote_ops,
+                                       args.pipeline_depth, args.connections)}
+        write_report(report, args.output)
+        return
+    implementations = args.implementation or [parse_implementation(CONCURRENCY_GLOBAL),
+                                              parse_implementation(CONCURRENCY_STRIPED)]
+    if args.scenario:
+        if args.scenario.endswith(BINARY_SUFFIX):
+            with open(args.scenario, 'rb') as input_file:
+                market_config = read_binary(input_file)
+        else:
+            with open(args.scenario) as input_file:
+                if args.scenario.endswith(STREAM_SUFFIX):
+                    market_config = read_stream(input_file)
+                else:
+                    market_config = json.load(input_file)
+        scenario = {"file": args.scenario}
+    else:
+        market_config = generate_scenario(args)
+        scenario = {key: getattr(args, key)
+                    for key in ("producers", "consumers", "products", "queue_size", "min_carts",
+                                "max_carts", "complex", "no_removal", "zipf", "hot_producers",
+                                "hot_factor", "seed")}
+    scenario["time_scale"] = args.time_scale
+    scenario["cart_ops"] = sum(len(cart) for consumer in market_config["consumers"]
+                               for cart in consumer["carts"])
+    market_config = scale_times(market_config, args.time_scale)
+
+    runs = []
+    for options in implementations:
+        for repeat in range(args.repeat):
+            result = run_isolated(market_config, options, args.log_sample_rate, args.timeout)
+            result["repeat"] = repeat
+            runs.append(result)
+            print("{} run {}: {}".format(options["name"], repeat,
+                                         "timed out" if result["timed_out"] else
+                                         "{:.0f} orders/sec".format(result["orders_per_sec"])),
+                  file=sys.stderr)
+
+    write_report({"scenario": scenario, "python": sys.version.split()[0], "runs": runs},
+                 args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,56 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
+from collections import Counter
 import sys
 
+CHUNK_SIZE = 1 << 20
+
+
+def read_lines(filename):
+    """
+    Yields the "consumer bought product" lines of a file, reading it in chunks.
+    Lines are split after the product's closing parenthesis, since sometimes
+    there is no new line between consumer outputs.
+    """
+    with open(filename) as input_file:
+        rest = ""
+        while True:
+            chunk = input_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            pieces = (rest + chunk).split(")")
+            rest = pieces.pop()
+            for piece in pieces:
+                piece = piece.strip()
+                if piece:
+                    yield piece + ")"
+        if rest.strip():
+            yield rest.strip() + ")"
+
+
+def count_lines(filename):
+    """
+    Counts every distinct line of a file.
+    """
+    counts = Counter()
+    counts.update(read_lines(filename))
+    return counts
+
+
+def mismatches(output_filename, ref_filename):
+    """
+    Returns the sorted (line, expected count, output count) of the lines the
+    output doesn't print as many times as the reference does. The reference
+    counts are computed first and the output is compared against them in a
+    single pass.
+    """
+    expected = count_lines(ref_filename)
+    remaining = Counter(expected)
+    remaining.subtract(read_lines(output_filename))
+    return sorted((line, expected[line], expected[line] - count)
+                  for line, count in remaining.items() if count)
+
 
 def main():
     if len(sys.argv) != 4:
@@ -17,29 +64,16 @@ def main():
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
-    with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
-
-    sorted_output_filename = output_filename + ".sorted"
-
-    # write to input file (tests/{test_name}.in)
-    with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
-
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
+    wrong = mismatches(output_filename, ref_filename)
 
-    if len(out) == 0:
+    if not wrong:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
     else:
         print(f"Test {testname}" + ":\t\t" + "FAILED")
+        line, expected, got = wrong[0]
+        consumer, _, product = line.partition(" bought ")
+        print(f"\t{consumer} bought {product} {got} times instead of {expected} "
+              f"({len(wrong)} mismatching lines)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+"""
+This module converts market configurations between the .in format, its
+line-delimited .ndjson variant (see tema/scenario.py) and its binary .bin
+variant (see tema/binary_scenario.py), by file suffix.
+
+Usage example:
+    python3 convert_scenario.py tests/01.in 01.bin
+"""
+
+import argparse
+import json
+
+from tema.binary_scenario import BINARY_SUFFIX, read_binary, write_binary
+from tema.scenario import STREAM_SUFFIX, read_stream, write_stream
+
+
+def read_config(path):
+    """
+    Reads a configuration in any of the formats, shaped like the .in files.
+    """
+    if path.endswith(BINARY_SUFFIX):
+        with open(path, 'rb') as input_file:
+            return read_binary(input_file)
+    with open(path) as input_file:
+        if path.endswith(STREAM_SUFFIX):
+            return read_stream(input_file)
+        return json.load(input_file)
+
+
+def write_config(market_config, path):
+    """
+    Writes a configuration shaped like the .in files in the format of path.
+    """
+    if path.endswith(BINARY_SUFFIX):
+        with open(path, 'wb') as output_file:
+            write_binary(market_config, output_file)
+        return
+    with open(path, 'w') as output_file:
+        if path.endswith(STREAM_SUFFIX):
+            write_stream(market_config, output_file)
+        else:
+            json.dump(market_config, output_file, indent=4)
+
+
+def main():
+    """
+    Reads the input configuration and writes it in the output's format.
+    """
+    parser = argparse.ArgumentParser(description="convert market configurations")
+    parser.add_argument("input_file")
+    parser.add_argument("output_file")
+    args = parser.parse_args()
+    write_config(read_config(args.input_file), args.output_file)
+
+
+if __name__ == '__main__':
+    main()
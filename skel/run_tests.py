@@ -0,0 +1,158 @@
+"""
+This module runs the homework's tests in parallel, like run_tests.sh does one
+after the other, and reports the wall time and CPU time of each, and the
+peak RSS of the tests finished so far (getrusage only keeps the largest)
+
+Every test runs test.py in its own process and working directory (so each
+one writes its own marketplace.log), with its output in tests/NN.out as
+run_tests.sh writes it, and is checked against tests/NN.ref.out.
+
+Usage example:
+    python3 run_tests.py -j 4 01 05 10 -- --engine asyncio
+"""
+
+import argparse
+import glob
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Timer
+
+from check_test import mismatches
+from tema.watchdog import ABORT_EXIT_CODE
+
+TESTS = "tests"
+SLOW_TESTS_TIMEOUT = 60 # tests 09 and 10
+TIMEOUT = 30
+RUSAGE_LOCK = Lock() # held while a test is reaped, for its share of the children's usage
+
+
+def parse_args():
+    """
+    Parses the command line: the tests to run and the runner's options.
+    """
+    parser = argparse.ArgumentParser(description="run the tests in parallel")
+    parser.add_argument("tests", nargs="*", metavar="NN",
+                        help="tests to run (default: every tests/NN.in)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of tests running at the same time (default: one per "
+                             "CPU; the tests mostly sleep, so more is fine)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="seconds before a test is killed (default: %d, %d for tests 09 and "
+                             "up, like run_tests.sh)" % (TIMEOUT, SLOW_TESTS_TIMEOUT))
+    parser.add_argument("--work-dir", default=None,
+                        help="directory holding the tests' working directories and logs "
+                             "(default: a temporary one)")
+    parser.epilog = "arguments after a -- are passed to test.py"
+    argv = sys.argv[1:]
+    test_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:len(argv) - len(test_args) - bool(test_args)])
+    args.test_args = test_args
+    return args
+
+
+def kill_test(process):
+    """
+    Kills a test and whatever it started (the remote engine's server).
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_test(name, args, work_dir):
+    """
+    Runs test.py on tests/{name}.in in work_dir/{name} and checks its output.
+    Returns the test's result row.
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    input_file = os.path.join(base, TESTS, name + ".in")
+    output_file = os.path.join(base, TESTS, name + ".out")
+    cwd = os.path.join(work_dir, name)
+    os.makedirs(cwd, exist_ok=True)
+    timeout = args.timeout or (SLOW_TESTS_TIMEOUT if name >= "09" else TIMEOUT)
+
+    with open(output_file, "w") as output:
+        started = time.perf_counter()
+        # in its own process group, for kill_test to reach its children
+        process = subprocess.Popen([sys.executable, os.path.join(base, "test.py"), input_file]
+                                   + args.test_args, stdout=output, cwd=cwd,
+                                   start_new_session=True)
+        killer = Timer(timeout, kill_test, [process])
+        killer.start()
+        try:
+            # waits without reaping, so that only this test is reaped between
+            # the two getrusage calls
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            wall = time.perf_counter() - started
+            with RUSAGE_LOCK:
+                before = resource.getrusage(resource.RUSAGE_CHILDREN)
+                process.wait()
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        finally:
+            killer.cancel()
+            kill_test(process)
+
+    if process.returncode != 0:
+        if process.returncode == -9:
+            result = "TIMEOUT"
+        elif process.returncode == ABORT_EXIT_CODE: # the watchdog noticed a stall
+            result = "STALLED"
+        else:
+            result = "ERROR %d" % process.returncode
+    else:
+        wrong = mismatches(output_file, os.path.join(base, TESTS, name + ".ref.out"))
+        result = "FAILED" if wrong else "PASSED"
+    return {"test": name, "result": result, "wall_sec": wall,
+            "cpu_sec": (usage.ru_utime + usage.ru_stime) - (before.ru_utime + before.ru_stime),
+            "max_rss_mb": usage.ru_maxrss / 1024} # ru_maxrss is in KB on Linux
+
+
+def print_summary(rows, elapsed):
+    """
+    Prints the results as a table, plus the tests' total times and the
+    elapsed time of the whole run.
+    """
+    print("%-6s %-10s %10s %10s %12s" % ("test", "result", "wall (s)", "cpu (s)", "max rss (MB)"))
+    for row in rows:
+        print("%-6s %-10s %10.2f %10.2f %12.1f" % (row["test"], row["result"], row["wall_sec"],
+                                                   row["cpu_sec"], row["max_rss_mb"]))
+    passed = sum(row["result"] == "PASSED" for row in rows)
+    print("%d/%d passed, %.2fs wall and %.2fs cpu in total, run in %.2fs" % (
+        passed, len(rows), sum(row["wall_sec"] for row in rows),
+        sum(row["cpu_sec"] for row in rows), elapsed))
+
+
+def main():
+    """
+    Runs the tests, printing their results in order as they finish, then the summary.
+    """
+    args = parse_args()
+    base = os.path.dirname(os.path.abspath(__file__))
+    tests = args.tests or sorted(os.path.basename(path)[:-len(".in")]
+                                 for path in glob.glob(os.path.join(base, TESTS, "[0-9]*.in")))
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="marketplace-tests-")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_test, name, args, work_dir) for name in tests]
+        rows = []
+        for future in futures:
+            row = future.result()
+            rows.append(row)
+            # same line as check_test.py, for parse.awk
+            print(f"Test {row['test'].lstrip('0')}" + ":\t\t" + row["result"], flush=True)
+    print()
+    print_summary(rows, time.perf_counter() - started)
+    print("logs in %s" % work_dir)
+    return 0 if all(row["result"] == "PASSED" for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
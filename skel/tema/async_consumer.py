@@ -0,0 +1,29 @@
+"""Coroutine consumer for the AsyncMarketplace"""
+
+class AsyncConsumer:
+    """
+    Coroutine counterpart of the Consumer, for the AsyncMarketplace.
+    """
+    def __init__(self, carts, marketplace, retry_wait_time, name=None):
+        self.carts = carts
+        self.marketplace = marketplace
+        self.retry_wait_time = retry_wait_time
+        self.name = name
+
+    async def run(self):
+        """
+        Fills and orders every cart, waiting on the marketplace for missing products.
+        """
+        for cart in self.carts:
+            cart_id = self.marketplace.new_cart()
+
+            for operation in cart:
+                for _ in range(operation["quantity"]):
+                    if operation["type"] == "add":
+                        while not await self.marketplace.add_to_cart(
+                                cart_id, operation["product"], timeout=self.retry_wait_time):
+                            pass
+                    else:
+                        await self.marketplace.remove_from_cart(cart_id, operation["product"])
+
+            await self.marketplace.place_order(cart_id, self.name)
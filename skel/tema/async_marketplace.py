@@ -0,0 +1,154 @@
+"""asyncio/collections/unittest modules"""
+from collections import deque
+import asyncio
+import unittest
+
+from tema.marketplace import Marketplace
+
+
+class _LoopMarketplace(Marketplace):
+    """
+    Marketplace driven from a single event loop. Its locks are never contended,
+    and instead of notifying threading Conditions it wakes the asyncio.Events of
+    the coroutines waiting in an AsyncMarketplace.
+    """
+    def __init__(self, queue_size_per_producer, order_sink=None):
+        Marketplace.__init__(self, queue_size_per_producer, order_sink=order_sink)
+        self.producer_waiters = {} # (producer_id, deque of asyncio.Event waiting for a slot)
+        self.product_waiters = {} # (product id, deque of asyncio.Event waiting for stock)
+
+    @staticmethod
+    def _wake(waiters, count):
+        """
+        Sets the first count events still waiting in the waiters deque.
+        """
+        while waiters and count > 0:
+            event = waiters.popleft()
+            if not event.is_set():
+                event.set()
+                count -= 1
+
+    def _release_slots(self, producer_id, count=1):
+        self.producers[producer_id].release(count)
+        self._wake(self.producer_waiters.get(producer_id), count)
+
+    def _signal_product(self, product_id, count):
+        self._wake(self.product_waiters.get(product_id), count)
+
+
+class AsyncMarketplace:
+    """
+    Coroutine version of the Marketplace, for running every producer and
+    consumer as a task on one event loop instead of as an OS thread.
+
+    publish and add_to_cart take the same timeout as the threaded Marketplace
+    (0 fails right away, None waits forever), waiting on an asyncio.Event that
+    is set as soon as a slot frees up or the product is stocked.
+    """
+    def __init__(self, queue_size_per_producer, order_sink=None):
+        self.marketplace = _LoopMarketplace(queue_size_per_producer, order_sink)
+
+    def register_producer(self):
+        """
+        Register a producer in the database with its own id.
+        """
+        return self.marketplace.register_producer()
+
+    def new_cart(self):
+        """
+        Regiser a new cart in the database with its own id.
+        """
+        return self.marketplace.new_cart()
+
+    @staticmethod
+    async def _wait(waiters, key, attempt, timeout):
+        """
+        Calls attempt() until it returns something truthy, waiting for waiters[key]
+        to be signaled in between for at most timeout seconds overall (None
+        means forever). Returns the last result.
+        """
+        result = attempt()
+        if result or timeout == 0:
+            return result
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not result:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            event = asyncio.Event()
+            queue = waiters.setdefault(key, deque())
+            queue.append(event)
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if not event.is_set():
+                    queue.remove(event)
+            result = attempt()
+        return result
+
+    async def publish(self, producer_id, product, timeout=0):
+        """
+        Publish a producer's item on the market, waiting up to timeout seconds
+        for room in the producer's queue.
+        """
+        return await self._wait(self.marketplace.producer_waiters, int(producer_id),
+                                lambda: self.marketplace.publish(producer_id, product), timeout)
+
+    async def add_to_cart(self, cart_id, product, timeout=0):
+        """
+        Add an item to a cart, waiting up to timeout seconds for it to be produced.
+        """
+        return await self._wait(self.marketplace.product_waiters,
+                                self.marketplace.catalog.intern(product),
+                                lambda: self.marketplace.add_to_cart(cart_id, product), timeout)
+
+    async def remove_from_cart(self, cart_id, product):
+        """
+        Removes an item from a cart (if the item exists in the cart)
+        """
+        self.marketplace.remove_from_cart(cart_id, product)
+
+    async def place_order(self, cart_id, buyer):
+        """
+        Places an order from a cart with a specific id on behalf of buyer.
+        """
+        return self.marketplace.place_order(cart_id, buyer=buyer)
+
+
+class TestAsyncMarketplace(unittest.IsolatedAsyncioTestCase):
+    """
+    Class that represents the AsyncMarketplace test class.
+    """
+    def setUp(self):
+        self.marketplace = AsyncMarketplace(3)
+
+    async def test_add_to_cart_waits_for_publish(self):
+        """
+        A waiting add should complete as soon as the product is published.
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+        self.assertFalse(await self.marketplace.add_to_cart(cart_id, "tea"))
+        adding = asyncio.ensure_future(self.marketplace.add_to_cart(cart_id, "tea", timeout=5))
+        await asyncio.sleep(0)
+        self.assertTrue(await self.marketplace.publish(producer_id, "tea"))
+        self.assertTrue(await adding)
+        self.assertEqual(self.marketplace.marketplace.producer_waiters, {})
+
+    async def test_publish_timeout(self):
+        """
+        A waiting publish on a full queue should time out, and succeed once a
+        unit is bought.
+        """
+        producer_id = self.marketplace.register_producer()
+        for product in ["tea1", "tea2", "tea3"]:
+            await self.marketplace.publish(producer_id, product)
+        self.assertFalse(await self.marketplace.publish(producer_id, "tea4", timeout=0.01))
+        publishing = asyncio.ensure_future(
+            self.marketplace.publish(producer_id, "tea4", timeout=5))
+        await asyncio.sleep(0)
+        await self.marketplace.add_to_cart(self.marketplace.new_cart(), "tea1")
+        self.assertTrue(await publishing)
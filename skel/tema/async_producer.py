@@ -0,0 +1,25 @@
+"""asyncio module"""
+import asyncio
+
+class AsyncProducer:
+    """
+    Coroutine counterpart of the Producer, for the AsyncMarketplace.
+    """
+    def __init__(self, products, marketplace, republish_wait_time, name=None):
+        self.products = products
+        self.marketplace = marketplace
+        self.republish_wait_time = republish_wait_time
+        self.name = name
+        self.this_producer_id = self.marketplace.register_producer()
+
+    async def run(self):
+        """
+        Publishes the products forever, waiting for room in the queue when it's full.
+        """
+        while True:
+            for product, quantity, wait_time in self.products:
+                for _ in range(quantity):
+                    while not await self.marketplace.publish(self.this_producer_id, product,
+                                                             timeout=self.republish_wait_time):
+                        pass
+                    await asyncio.sleep(wait_time)
@@ -0,0 +1,201 @@
+"""
+This module reads and writes the binary variant of the .in format (.bin),
+which test.py and the benchmark read through mmap without parsing the carts.
+
+Layout (little-endian, sections aligned to 8 bytes):
+    magic      8 bytes  b"MKTSCN1\\0"
+    header     uint32 metadata length, uint32 padding, uint64 carts, uint64 ops
+    metadata   UTF-8 JSON: marketplace, products (the product table), product
+               ids in table order, producers, consumers without their carts
+               but with "carts": number of carts
+    cart sizes uint32 per cart: its number of operations, consumer by consumer
+    operations 2 x uint32 per operation: product table index, and quantity
+               with the top bit set for removals
+"""
+from array import array
+from io import BytesIO
+from json import dumps, loads
+import mmap
+import struct
+import sys
+import tempfile
+import unittest
+
+from tema.scenario import build_products
+
+BINARY_SUFFIX = ".bin"
+MAGIC = b"MKTSCN1\0"
+HEADER = struct.Struct("<IIQQ")
+REMOVE_FLAG = 1 << 31
+
+
+def _padding(offset):
+    """
+    Bytes needed after offset to reach the next multiple of 8.
+    """
+    return -offset % 8
+
+
+def _little_endian(words):
+    """
+    The uint32 array words, byte swapped on big-endian machines.
+    """
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+
+def write_binary(market_config, output_file):
+    """
+    Writes a configuration shaped like the .in files to the binary output_file.
+    Its consumers are iterated once, so they may be generated on the fly.
+    """
+    product_ids = list(market_config['products'])
+    index = {product_id: position for position, product_id in enumerate(product_ids)}
+    consumers = []
+    sizes = array('I')
+    operations = array('I')
+    for consumer in market_config['consumers']:
+        consumers.append(dict({key: value for key, value in consumer.items() if key != 'carts'},
+                              carts=len(consumer['carts'])))
+        for cart in consumer['carts']:
+            sizes.append(len(cart))
+            for operation in cart:
+                operations.append(index[operation['product']])
+                operations.append(operation['quantity'] |
+                                  (REMOVE_FLAG if operation['type'] == "remove" else 0))
+    metadata = dumps({"marketplace": market_config['marketplace'],
+                      "products": market_config['products'], "product_ids": product_ids,
+                      "producers": market_config['producers'],
+                      "consumers": consumers}).encode()
+    output_file.write(MAGIC)
+    output_file.write(HEADER.pack(len(metadata), 0, len(sizes), len(operations) // 2))
+    output_file.write(metadata + bytes(_padding(len(metadata))))
+    output_file.write(_little_endian(sizes).tobytes() + bytes(_padding(4 * len(sizes))))
+    output_file.write(_little_endian(operations).tobytes())
+
+
+class _Sections:
+    """
+    The sections of a binary scenario held in a buffer (usually an mmap).
+    """
+    def __init__(self, buffer):
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a binary scenario")
+        if sys.byteorder != 'little':
+            raise ValueError("binary scenarios are only mapped on little-endian machines")
+        metadata_length, _, carts, operations = HEADER.unpack_from(buffer, len(MAGIC))
+        offset = len(MAGIC) + HEADER.size
+        self.metadata = loads(bytes(buffer[offset:offset + metadata_length]))
+        offset += metadata_length + _padding(metadata_length)
+        view = memoryview(buffer)
+        self.sizes = view[offset:offset + 4 * carts].cast('I')
+        offset += 4 * carts + _padding(4 * carts)
+        self.operations = view[offset:offset + 8 * operations].cast('I')
+
+
+def _carts(sections, products, first_cart, count, first_operation):
+    """
+    The carts first_cart .. first_cart + count - 1 decoded one at a time,
+    with products[index] for the products.
+    """
+    operations = sections.operations
+    position = 2 * first_operation
+    for cart in range(first_cart, first_cart + count):
+        decoded = []
+        for _ in range(sections.sizes[cart]):
+            quantity = operations[position + 1]
+            decoded.append({"type": "remove" if quantity & REMOVE_FLAG else "add",
+                            "product": products[operations[position]],
+                            "quantity": quantity & ~REMOVE_FLAG})
+            position += 2
+        yield decoded
+
+
+def _consumers(sections, products):
+    """
+    The consumers of the metadata, each with a generator over its carts.
+    """
+    first_cart = first_operation = 0
+    consumers = []
+    for consumer in sections.metadata['consumers']:
+        count = consumer['carts']
+        consumers.append(dict(consumer, carts=_carts(sections, products, first_cart, count,
+                                                     first_operation)))
+        first_operation += sum(sections.sizes[first_cart:first_cart + count])
+        first_cart += count
+    return consumers
+
+
+def map_binary(input_file):
+    """
+    Maps an opened binary scenario and returns it resolved like
+    resolve_config does, every consumer's carts being a generator that
+    decodes them from the mapping as they are iterated.
+    """
+    sections = _Sections(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ))
+    metadata = sections.metadata
+    by_id = build_products(metadata['products'])
+    products = [by_id[product_id] for product_id in metadata['product_ids']]
+    for producer in metadata['producers']:
+        producer['products'] = [(by_id[i], quantity, sleep_time)
+                                for i, quantity, sleep_time in producer['products']]
+    return {"marketplace": metadata['marketplace'], "producers": metadata['producers'],
+            "consumers": _consumers(sections, products)}
+
+
+def read_binary(input_file):
+    """
+    Reads a whole binary scenario into a configuration shaped like the .in files.
+    """
+    sections = _Sections(input_file.read())
+    metadata = sections.metadata
+    consumers = _consumers(sections, metadata['product_ids'])
+    for consumer in consumers:
+        consumer['carts'] = list(consumer['carts'])
+    return {"products": metadata['products'], "producers": metadata['producers'],
+            "consumers": consumers, "marketplace": metadata['marketplace']}
+
+
+class TestBinaryScenario(unittest.TestCase):
+    """
+    Class that represents the binary scenario format test class.
+    """
+    CONFIG = {"products": {"id1": {"product_type": "Tea", "name": "Linden", "type": "Herbal",
+                                   "price": 9},
+                           "id2": {"product_type": "Coffee", "name": "Arabica", "price": 10,
+                                   "acidity": 5.1, "roast_level": "MEDIUM"}},
+              "producers": [{"name": "prod1", "products": [["id1", 2, 0.1], ["id2", 1, 0.2]],
+                             "republish_wait_time": 0.2}],
+              "consumers": [{"name": "cons1", "retry_wait_time": 0.1,
+                             "carts": [[{"type": "add", "product": "id2", "quantity": 3},
+                                        {"type": "remove", "product": "id2", "quantity": 1}],
+                                       [{"type": "add", "product": "id1", "quantity": 1}]]},
+                            {"name": "cons2", "retry_wait_time": 0.3,
+                             "carts": [[{"type": "add", "product": "id1", "quantity": 7}]]}],
+              "marketplace": {"queue_size_per_producer": 2}}
+
+    def test_round_trip(self):
+        """
+        Reading a written scenario should give the configuration back.
+        """
+        output_file = BytesIO()
+        write_binary(self.CONFIG, output_file)
+        output_file.seek(0)
+        self.assertEqual(read_binary(output_file), self.CONFIG)
+
+    def test_map(self):
+        """
+        A mapped scenario should decode its carts lazily, with Products.
+        """
+        with tempfile.TemporaryFile() as output_file:
+            write_binary(self.CONFIG, output_file)
+            output_file.flush()
+            market_config = map_binary(output_file)
+        self.assertEqual(market_config['producers'][0]['products'][1][0].name, "Arabica")
+        first, second = market_config['consumers']
+        self.assertEqual(second['retry_wait_time'], 0.3)
+        self.assertEqual([cart[0]['quantity'] for cart in second['carts']], [7])
+        carts = list(first['carts'])
+        self.assertEqual(carts[0][1]['type'], "remove")
+        self.assertEqual(carts[1][0]['product'].name, "Linden")
@@ -0,0 +1,82 @@
+"""Thread/unittest modules"""
+from threading import Lock
+import unittest
+
+from tema.product import Tea
+
+
+class ProductCatalog:
+    """
+    Interns products: every distinct product gets a dense integer id the first
+    time it is seen, and the marketplace keeps ids instead of Product objects
+    in its inventory and carts. Ids hash and compare as plain ints, and the
+    Product objects are only looked up again when an order is placed.
+
+    Callers usually pass the same Product instance over and over (one per
+    product of the .in file), so the instance a product was first interned
+    with is also found by identity, which skips hashing and comparing the
+    dataclass fields. Equal copies still work, through the slower dict.
+    """
+    def __init__(self):
+        self.ids = {} # (product, product id)
+        self.by_identity = {} # (id() of the interned instance, product id)
+        self.products = [] # interned instance of every product id
+        self.lock = Lock()
+
+    def lookup(self, product):
+        """
+        The id of product, or None if it was never interned.
+        """
+        product_id = self.by_identity.get(id(product))
+        if product_id is not None and self.products[product_id] is product:
+            return product_id
+        return self.ids.get(product)
+
+    def intern(self, product):
+        """
+        The id of product, registering it if it wasn't seen before.
+        """
+        product_id = self.lookup(product)
+        if product_id is None:
+            with self.lock:
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    # publish the product before its id, lookup() reads without the lock
+                    product_id = len(self.products)
+                    self.products.append(product)
+                    self.ids[product] = product_id
+                    self.by_identity[id(product)] = product_id
+        return product_id
+
+    def product(self, product_id):
+        """
+        The product with the given id.
+        """
+        return self.products[product_id]
+
+    def __len__(self):
+        return len(self.products)
+
+
+class TestProductCatalog(unittest.TestCase):
+    """
+    Class that represents the product catalog test class.
+    """
+    def test_intern(self):
+        """
+        Equal products should share one id, different ones get the next id.
+        """
+        catalog = ProductCatalog()
+        self.assertEqual(catalog.intern(Tea("Linden", 9, "Herbal")), 0)
+        self.assertEqual(catalog.intern("coffee"), 1)
+        self.assertEqual(catalog.intern(Tea("Linden", 9, "Herbal")), 0)
+        self.assertEqual(catalog.product(0), Tea("Linden", 9, "Herbal"))
+        self.assertEqual(len(catalog), 2)
+
+    def test_lookup(self):
+        """
+        Looking a product up shouldn't register it.
+        """
+        catalog = ProductCatalog()
+        self.assertIsNone(catalog.lookup("tea"))
+        self.assertEqual(len(catalog), 0)
@@ -0,0 +1,210 @@
+"""Thread/heapq/time/unittest modules"""
+from contextlib import contextmanager, nullcontext
+from heapq import heappop, heappush
+from itertools import count
+from threading import Event, Lock, Thread, current_thread
+import time
+import unittest
+
+
+class RealClock:
+    """
+    The wall clock: sleeping really sleeps. Producers and consumers use it
+    unless they are given another clock.
+    """
+    def time(self):
+        """
+        Seconds elapsed since some fixed point.
+        """
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        """
+        Sleeps for seconds.
+        """
+        time.sleep(seconds)
+
+    def register(self, thread):
+        """
+        Nothing to do, see VirtualClock.register.
+        """
+
+    def enter(self):
+        """
+        Nothing to do, see VirtualClock.enter.
+        """
+
+    def leave(self):
+        """
+        Nothing to do, see VirtualClock.leave.
+        """
+
+    def hold(self):
+        """
+        Nothing to do, see VirtualClock.hold.
+        """
+        return nullcontext()
+
+    def stop(self):
+        """
+        Nothing to do, see VirtualClock.stop.
+        """
+
+
+REAL_CLOCK = RealClock()
+
+
+class VirtualClock:
+    """
+    Simulated time for the threads of a scenario. The registered threads run
+    one at a time, like the events of a discrete event simulation: a thread
+    that sleeps is queued with its wakeup time and hands its turn to the
+    thread with the earliest wakeup, the clock jumping straight to it. Ties
+    go to the thread that went to sleep first, so a run only depends on the
+    scenario, and sleeping costs no wall time at all.
+
+    The threads must only wait through the clock: one blocked on anything
+    else (like the marketplace's blocking mode) keeps the turn while it waits.
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleepers = [] # heap of (wakeup time, sequence number, Event of the thread)
+        self.sequence = count()
+        self.events = {} # (registered thread, Event set when it gets the turn)
+        self.idle = True # no thread has the turn
+        self.held = False # hold() defers the first turn
+        self.stopped = False # stop() ended the simulation
+        self.lock = Lock()
+
+    def time(self):
+        """
+        The simulated seconds elapsed since the clock was created.
+        """
+        return self.now
+
+    def register(self, thread):
+        """
+        Adds a thread to the simulation, queued to run at the current time.
+        Called before the thread starts, so the threads created together are
+        queued in their creation order.
+        """
+        with self.lock:
+            self.events[thread] = Event()
+            heappush(self.sleepers, (self.now, next(self.sequence), self.events[thread]))
+
+    def enter(self):
+        """
+        Called by a registered thread when it starts: waits for its turn.
+        """
+        event = self.events[current_thread()]
+        with self.lock:
+            if self.idle and not self.held:
+                self._hand_off()
+        event.wait()
+        event.clear()
+
+    def sleep(self, seconds):
+        """
+        Queues the calling thread to wake up seconds later and hands the turn
+        to the earliest sleeper, then waits for the thread's next turn.
+        """
+        event = self.events[current_thread()]
+        with self.lock:
+            heappush(self.sleepers, (self.now + seconds, next(self.sequence), event))
+            self._hand_off()
+        event.wait()
+        event.clear()
+
+    def leave(self):
+        """
+        Called by a registered thread when it is done: hands its turn over.
+        """
+        with self.lock:
+            del self.events[current_thread()]
+            self._hand_off()
+
+    @contextmanager
+    def hold(self):
+        """
+        Keeps the simulation from starting while the threads are being
+        created, so they all join it at time 0.
+        """
+        with self.lock:
+            self.held = True
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.held = False
+                if self.idle:
+                    self._hand_off()
+
+    def stop(self):
+        """
+        Ends the simulation: the threads still registered (like the daemon
+        producers once the consumers are done) never get another turn.
+        """
+        with self.lock:
+            self.stopped = True
+
+    def _hand_off(self):
+        """
+        Gives the turn to the earliest sleeper, advancing the time to its
+        wakeup. Must be called with the lock held.
+        """
+        if self.stopped:
+            return
+        if not self.sleepers:
+            self.idle = True
+            return
+        wakeup, _, event = heappop(self.sleepers)
+        self.now = max(self.now, wakeup)
+        self.idle = False
+        event.set()
+
+
+class TestVirtualClock(unittest.TestCase):
+    """
+    Class that represents the virtual clock test class.
+    """
+    def _run(self, clock, naps):
+        """
+        Runs a thread per list of naps, each recording when it wakes up.
+        """
+        wakeups = []
+
+        def nap(name, seconds):
+            clock.enter()
+            for second in seconds:
+                clock.sleep(second)
+                wakeups.append((name, clock.time()))
+            clock.leave()
+
+        threads = [Thread(target=nap, args=(name, seconds)) for name, seconds in naps.items()]
+        with clock.hold():
+            for thread in threads:
+                clock.register(thread)
+                thread.start()
+        for thread in threads:
+            thread.join()
+        return wakeups
+
+    def test_order(self):
+        """
+        Threads should wake up in the order of their wakeup times, ties going
+        to the first one to sleep, without sleeping for real.
+        """
+        clock = VirtualClock()
+        started = time.monotonic()
+        wakeups = self._run(clock, {"a": [100, 50], "b": [30, 30, 90], "c": [150]})
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(wakeups, [("b", 30), ("b", 60), ("a", 100), ("c", 150), ("b", 150),
+                                   ("a", 150)])
+        self.assertEqual(clock.time(), 150)
+
+    def test_reproducible(self):
+        """
+        Runs of the same threads should interleave the same way.
+        """
+        naps = {name: [0.1 * (i % 3)] * 20 for i, name in enumerate("abcdef")}
+        self.assertEqual(self._run(VirtualClock(), naps), self._run(VirtualClock(), naps))
@@ -1,33 +1,164 @@
-"""Thread/time modules"""
-from threading import Thread
-import time
+"""Thread/unittest modules"""
+from threading import Thread, Timer
+import unittest
+
+from tema.clock import REAL_CLOCK
+from tema.marketplace import CartClosedError, Marketplace
+from tema.order_sink import CollectorOrderSink
 
 class Consumer(Thread):
     """
     Class that represents the Consumer in the MPMC program.
+
+    With blocking=True the consumer waits on the marketplace for the product to
+    be stocked instead of sleeping retry_wait_time between failed adds. With
+    batch=True it first tries to fill the whole cart in one apply_cart_ops call
+    and otherwise moves as many units per call as the marketplace has. Its
+    sleeps go through clock, which can be a VirtualClock. Units whose hold
+    expired before the order was placed are added again.
+
+    progress, waiting_for and retries tell a Watchdog how the consumer is doing.
     """
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, blocking=False, batch=False,
+                 clock=REAL_CLOCK, **kwargs):
         Thread.__init__(self, **kwargs)
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
+        self.blocking = blocking
+        self.batch = batch
+        self.clock = clock
+        self.progress = 0 # units added and orders placed
+        self.waiting_for = None # product the consumer keeps failing to add
+        self.retries = 0 # failed adds of waiting_for in a row
+        self.clock.register(self)
 
     def run(self):
+        self.clock.enter()
+        try:
+            self.shop()
+        finally:
+            self.clock.leave()
+
+    def shop(self):
+        """
+        Fills and orders every cart. A cart reaped (cart_ttl) while the
+        consumer was waiting gave its units back to the market: it is lost, so
+        its operations are replayed in a new cart.
+        """
         for cart in self.carts:
-            cart_id = int(self.marketplace.new_cart())
-
-            for tuple in cart:
-                if tuple["type"] == "add":
-                    for i in range(tuple["quantity"]):
-                        # check if we can add to cart or not (check marketplace)
-                        while True:
-                            added_or_not = self.marketplace.add_to_cart(str(cart_id), tuple["product"])
-                            if added_or_not:
-                                break
-                            time.sleep(self.retry_wait_time)
-                else:
-                    for i in range(tuple["quantity"]):
-                        # no need to check if it worked or not, the result will be logged
-                        self.marketplace.remove_from_cart(str(cart_id), tuple["product"])
-
-            self.marketplace.place_order(str(cart_id))
+            while True:
+                cart_id = int(self.open_cart())
+                try:
+                    self.fill(cart_id, cart)
+                    while self.marketplace.place_order(str(cart_id)) is None:
+                        # some holds expired (hold_ttl), buy those units again
+                        for product, quantity in self.marketplace.lost_units(str(cart_id)):
+                            self.add(cart_id, product, quantity)
+                except CartClosedError:
+                    continue
+                break
+            self.progress += 1
+
+    def fill(self, cart_id, cart):
+        """
+        Applies the operations of a cart.
+        """
+        if self.batch and self.marketplace.apply_cart_ops(str(cart_id), cart):
+            return
+        for tuple in cart:
+            if tuple["type"] == "add":
+                # check if we can add to cart or not (check marketplace)
+                self.add(cart_id, tuple["product"], tuple["quantity"])
+            elif self.batch:
+                self.marketplace.remove_many(str(cart_id), tuple["product"], tuple["quantity"])
+            else:
+                for i in range(tuple["quantity"]):
+                    # no need to check if it worked or not, the result will be logged
+                    self.marketplace.remove_from_cart(str(cart_id), tuple["product"])
+
+    def open_cart(self):
+        """
+        Gets a new cart, retrying every retry_wait_time while the marketplace
+        has too many carts open (blocking: waiting for one to close).
+        """
+        if self.blocking:
+            return self.marketplace.new_cart()
+        cart_id = self.marketplace.new_cart(timeout=0)
+        while cart_id is None:
+            self.clock.sleep(self.retry_wait_time)
+            cart_id = self.marketplace.new_cart(timeout=0)
+        return cart_id
+
+    def add(self, cart_id, product, quantity):
+        """
+        Adds quantity units of product to the cart, retrying until the
+        marketplace had all of them. Only the missing units are retried.
+        """
+        timeout = self.retry_wait_time if self.blocking else 0
+        while quantity > 0:
+            if self.batch:
+                added = self.marketplace.add_many(str(cart_id), product, quantity, timeout=timeout)
+            else:
+                added = int(self.marketplace.add_to_cart(str(cart_id), product, timeout=timeout))
+            quantity -= added
+            if added:
+                self.progress += added
+                self.waiting_for = None
+                self.retries = 0
+                continue
+            self.waiting_for = product
+            self.retries += 1
+            if not self.blocking:
+                self.clock.sleep(self.retry_wait_time)
+
+
+class TestConsumer(unittest.TestCase):
+    """
+    Class that represents the consumer test class.
+    """
+    def test_reaped_cart(self):
+        """
+        A cart reaped while its consumer sleeps between tries should be
+        replayed in a new cart and ordered.
+        """
+        marketplace = Marketplace(3, order_sink=CollectorOrderSink(), cart_ttl=0.05)
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, "tea")
+        carts = [[{"type": "add", "product": "tea", "quantity": 1},
+                  {"type": "add", "product": "coffee", "quantity": 1}]]
+        consumer = Consumer(carts, marketplace, 0.2, name="cons1")
+        reaped = []
+
+        def restock():
+            # the consumer is sleeping after failing to add coffee
+            reaped.append(marketplace.reap_carts())
+            marketplace.publish(producer_id, "coffee")
+
+        timer = Timer(0.1, restock)
+        timer.start()
+        consumer.start()
+        consumer.join(2)
+        timer.join()
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(reaped, [1])
+        self.assertEqual(marketplace.order_sink.lines, ["cons1 bought tea", "cons1 bought coffee"])
+        self.assertEqual(marketplace.queue_depths(), {producer_id: 0})
+
+    def test_other_error(self):
+        """
+        Errors other than a closed cart should stop the consumer, not make it
+        replay the cart.
+        """
+        class Broken(Marketplace):
+            """
+            A marketplace that refuses every add.
+            """
+            def add_to_cart(self, cart_id, product, timeout=0):
+                """
+                Fails like a bug would.
+                """
+                raise ValueError("broken")
+
+        consumer = Consumer([[{"type": "add", "product": "tea", "quantity": 1}]], Broken(3), 0.01)
+        self.assertRaises(ValueError, consumer.shop)
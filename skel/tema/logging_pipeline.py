@@ -0,0 +1,271 @@
+"""Logging/queue/threading modules"""
+from io import StringIO
+from itertools import count
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Empty, SimpleQueue
+from threading import Lock
+from weakref import WeakSet
+import atexit
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+LOGGER_NAME = 'Logger Marketplace'
+LOG_FORMAT = '%(asctime)s:%(name)s:%(levelname)s:%(message)s'
+SAMPLED_MESSAGES = ('Couldnt add product',) # errors the consumers' retry loops repeat
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that can also write a whole batch of records with a
+    single write and flush.
+    """
+    def emit_batch(self, records):
+        """
+        Formats the records, rotating the file when needed, and writes them.
+        """
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            size = self.stream.tell()
+            chunk = []
+            for record in records:
+                if not self.filter(record):
+                    continue
+                try:
+                    message = self.format(record) + self.terminator
+                except Exception: # pylint: disable=broad-except
+                    self.handleError(record)
+                    continue
+                if 0 < self.maxBytes <= size + len(message) and (size or chunk):
+                    self.stream.write(''.join(chunk))
+                    self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                    size = 0
+                    chunk = []
+                chunk.append(message)
+                size += len(message)
+            self.stream.write(''.join(chunk))
+            self.flush()
+        finally:
+            self.release()
+
+
+class BatchQueueListener(QueueListener):
+    """
+    QueueListener that drains up to batch_size queued records at a time and
+    hands them to the handlers' emit_batch in one go.
+    """
+    def __init__(self, log_queue, *handlers, batch_size=512):
+        QueueListener.__init__(self, log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        while True:
+            batch = [self.dequeue(True)]
+            while batch[-1] is not self._sentinel and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            stop = batch[-1] is self._sentinel
+            if stop:
+                batch.pop()
+            if batch:
+                self.handle_batch(batch)
+            if stop:
+                break
+
+    def handle_batch(self, records):
+        """
+        Passes a batch of records to every handler.
+        """
+        for handler in self.handlers:
+            accepted = [record for record in records if record.levelno >= handler.level]
+            if hasattr(handler, 'emit_batch'):
+                handler.emit_batch(accepted)
+            else:
+                for record in accepted:
+                    handler.handle(record)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. The marketplace
+    only logs immutable arguments (ids, names, frozen products), so the record
+    can be queued as it is.
+    """
+    def prepare(self, record):
+        return record
+
+
+class SampledErrorFilter(logging.Filter):
+    """
+    Lets through only one in every `rate` records of the high-volume messages
+    in SAMPLED_MESSAGES; everything else passes.
+    """
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.seen = count()
+
+    def filter(self, record):
+        if self.rate <= 1 or not record.msg.startswith(SAMPLED_MESSAGES):
+            return True
+        return next(self.seen) % self.rate == 0
+
+
+_PIPELINES = {} # (absolute log file path, (logger name, queue handler, listener, loggers))
+_PIPELINES_LOCK = Lock()
+
+
+def _logger_name(path):
+    """
+    The name of the loggers of a new pipeline: the usual marketplace logger
+    name for the first log file, one naming the file for the others.
+    """
+    if all(name != LOGGER_NAME for name, _, _, _ in _PIPELINES.values()):
+        return LOGGER_NAME
+    return '{} {}'.format(LOGGER_NAME, path)
+
+
+def get_marketplace_logger(log_file='marketplace.log', level=logging.INFO, error_sample_rate=1):
+    """
+    Returns a new logger writing to log_file through a background listener,
+    with its own level and sampling rate of the retry-loop errors. The
+    handler and listener are created once per file and shared by its loggers.
+    """
+    path = os.path.abspath(log_file)
+    with _PIPELINES_LOCK:
+        pipeline = _PIPELINES.get(path)
+        if pipeline is None:
+            file_handler = BatchRotatingFileHandler(log_file, maxBytes=25000, backupCount=3)
+            file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            log_queue = SimpleQueue()
+            listener = BatchQueueListener(log_queue, file_handler)
+            listener.start()
+            pipeline = _PIPELINES[path] = (_logger_name(path), DeferredQueueHandler(log_queue),
+                                           listener, WeakSet())
+        name, queue_handler, _, loggers = pipeline
+        # not registered with logging.getLogger, so every marketplace's level and
+        # filter stay its own
+        logger = logging.Logger(name, level)
+        logger.propagate = False
+        logger.addFilter(SampledErrorFilter(error_sample_rate))
+        logger.addHandler(queue_handler)
+        loggers.add(logger)
+        return logger
+
+
+def close_marketplace_logger(log_file='marketplace.log'):
+    """
+    Writes out everything queued for log_file, then detaches and closes its
+    pipeline. Its loggers are disabled, so threads still logging (daemon
+    producers) don't end up on stderr through logging.lastResort. Also runs
+    for every log file at exit.
+    """
+    with _PIPELINES_LOCK:
+        pipeline = _PIPELINES.pop(os.path.abspath(log_file), None)
+    if pipeline is None:
+        return
+    _, queue_handler, listener, loggers = pipeline
+    for logger in list(loggers):
+        logger.disabled = True
+        logger.removeHandler(queue_handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+@atexit.register
+def close_all_marketplace_loggers():
+    """
+    Flushes and closes every pipeline still open. Runs when the interpreter
+    exits, but not on os._exit.
+    """
+    for path in list(_PIPELINES):
+        close_marketplace_logger(path)
+
+
+class TestLoggingPipeline(unittest.TestCase):
+    """
+    Class that represents the logging pipeline test class.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.log_file = os.path.join(self.log_dir.name, 'marketplace.log')
+
+    def tearDown(self):
+        close_marketplace_logger(self.log_file)
+        self.log_dir.cleanup()
+
+    def read_log(self):
+        """
+        Waits for the listener to write everything queued, then reads the log.
+        """
+        close_marketplace_logger(self.log_file)
+        with open(self.log_file) as log:
+            return log.read().splitlines()
+
+    def test_single_handler(self):
+        """
+        Asking for the same log file twice shouldn't duplicate the log lines.
+        """
+        get_marketplace_logger(self.log_file)
+        logger = get_marketplace_logger(self.log_file)
+        self.assertEqual(len(logger.handlers), 1)
+        logger.info('Registered new cart with id %s', 0)
+        self.assertEqual(len(self.read_log()), 1)
+
+    def test_error_sampling(self):
+        """
+        Only every third retry-loop error should be written, other messages all are.
+        """
+        logger = get_marketplace_logger(self.log_file, error_sample_rate=3)
+        for cart_id in range(6):
+            logger.error('Couldnt add product %s to the cart %s - didnt find product', 'tea', cart_id)
+            logger.error('Couldnt remove item %s from cart %s - didnt find item', 'tea', cart_id)
+        lines = self.read_log()
+        self.assertEqual(sum('Couldnt add' in line for line in lines), 2)
+        self.assertEqual(sum('Couldnt remove' in line for line in lines), 6)
+
+    def test_level(self):
+        """
+        Records below the configured level should be dropped.
+        """
+        logger = get_marketplace_logger(self.log_file, level=logging.ERROR)
+        logger.info('Registered new cart with id %s', 0)
+        logger.error('Couldnt remove item %s from cart %s - didnt find item', 'tea', 0)
+        self.assertEqual(len(self.read_log()), 1)
+
+    def test_closed(self):
+        """
+        Records logged after the pipeline was closed should be dropped, not
+        written to stderr.
+        """
+        logger = get_marketplace_logger(self.log_file)
+        close_marketplace_logger(self.log_file)
+        with mock.patch('sys.stderr', new_callable=StringIO) as stderr:
+            logger.error('Couldnt remove item %s from cart %s - didnt find item', 'tea', 0)
+        self.assertEqual(stderr.getvalue(), '')
+        get_marketplace_logger(self.log_file).info('Registered new cart with id %s', 0)
+        self.assertEqual(len(self.read_log()), 1)
+
+    def test_own_settings(self):
+        """
+        Loggers of the same file should keep their own level and sampling.
+        """
+        quiet = get_marketplace_logger(self.log_file, level=logging.ERROR, error_sample_rate=2)
+        loud = get_marketplace_logger(self.log_file)
+        for logger in (quiet, loud):
+            logger.info('Registered new cart with id %s', 0)
+            for cart_id in range(2):
+                logger.error('Couldnt add product %s to the cart %s - didnt find product', 'tea',
+                             cart_id)
+        lines = self.read_log()
+        self.assertEqual(sum('Registered' in line for line in lines), 1)
+        self.assertEqual(sum('Couldnt add' in line for line in lines), 3)
@@ -1,30 +1,150 @@
-"""Thread/unittest/logging modules"""
-from threading import Lock, currentThread
-from logging.handlers import RotatingFileHandler
+"""Thread/heapq/unittest/logging modules"""
+from collections import deque
+from contextlib import ExitStack
+from heapq import heappop, heappush
+from threading import Condition, Lock, Timer, current_thread
+from time import monotonic, sleep
 import unittest
 import logging
 
+from tema.catalog import ProductCatalog
+from tema.logging_pipeline import get_marketplace_logger
+from tema.order_sink import CollectorOrderSink, StreamOrderSink
+from tema.metrics import InstrumentedLock, MarketplaceMetrics
+from tema.producer_queue import ProducerQueue
+from tema.product import Tea
+from tema.selection import get_policy
+
+CONCURRENCY_GLOBAL = "global" # one lock for the whole marketplace
+CONCURRENCY_STRIPED = "striped" # per-producer locks, per-cart locks, striped product index
+
+
+class _Cart(dict):
+    """
+    The {product_id: {producer_id: units}} of a cart, plus the runs of units
+    in the order they were added, for the order to keep that order.
+    """
+    __slots__ = ('runs',)
+
+    def __init__(self, counts=(), runs=()):
+        dict.__init__(self, counts)
+        self.runs = [list(run) for run in runs] # [product_id, producer_id, units], adds merged
+
+    def copy(self):
+        """
+        A copy whose counts and runs can change without touching this cart.
+        """
+        return _Cart({product_id: dict(units) for product_id, units in self.items()}, self.runs)
+
+    def units(self):
+        """
+        The (product_id, producer_id) of every unit, in the order they were
+        added. The units taken out of the cart count as the earliest ones of
+        their product and producer.
+        """
+        left = {(product_id, producer): count for product_id, units in self.items()
+                for producer, count in units.items()}
+        units = []
+        for product_id, producer, count in reversed(self.runs):
+            kept = min(count, left.get((product_id, producer), 0))
+            if kept:
+                left[(product_id, producer)] -= kept
+                units.extend([(product_id, producer)] * kept)
+        units.reverse()
+        return units
+
+
+class CartClosedError(ValueError):
+    """
+    Raised for a cart that is not open: never opened, ordered or reaped.
+    """
+
 class Marketplace:
     """
     Class that represents the Marketplace in the MPMC program, a mediator between
     producers and consumers.
     """
-    def __init__(self, queue_size_per_producer):
+    lock_type = Lock # every lock of the marketplace is made with this (see metrics)
+    queue_type = ProducerQueue # queue accounting of every producer, built with the queue size
+
+    def __init__(self, queue_size_per_producer, concurrency=CONCURRENCY_GLOBAL, lock_stripes=16,
+                 log_file='marketplace.log', log_level=logging.INFO, error_sample_rate=1,
+                 order_sink=None, metrics=None, selection="first_fit", max_open_carts=None,
+                 cart_ttl=None, hold_ttl=None):
         """
         Initialize variables + logger information.
+
+        concurrency: every piece of state is guarded by a lock of producer_locks,
+        cart_locks or the product index stripes. CONCURRENCY_GLOBAL hands out
+        self.lock for all of them, CONCURRENCY_STRIPED gives producers and carts
+        their own locks and the index lock_stripes locks. No method holds two of
+        them at once. A ProducerQueue keeps its capacity without locking.
+
+        log_file: written in batches by a background thread (logging_pipeline);
+        error_sample_rate=N keeps one in N of the "couldnt add product" errors.
+        order_sink: where placed orders go (stdout by default), one per write.
+        selection: the producer a unit is taken from, a policy name of
+        selection.SELECTION_POLICIES or a policy function.
+        metrics: a MarketplaceMetrics for operation counters, lock histograms
+        and queue depths; None keeps the hot paths to an "is not None" check.
+        max_open_carts, cart_ttl: see new_cart and reap_carts.
+        hold_ttl: seconds the units put in a cart are held, see reclaim_holds.
         """
+        if concurrency not in (CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED):
+            raise ValueError('Unknown concurrency mode %s' % concurrency)
         self.queue_size_per_producer = queue_size_per_producer
+        self.concurrency = concurrency
+        self.select_producer = get_policy(selection)
+        self.metrics = metrics
+        if metrics is not None:
+            self.lock_type = lambda: InstrumentedLock(metrics)
+            metrics.register_gauge('queue_depth', self.queue_depths)
         self.producer_id_count = -1 # will add to it in the future
         self.carts_id_count = -1 # will add to it in the future
-        self.producers = {} # (producer_id, product list for the producer_id)
-        self.carts = {} # (cart_id, list of products of the cart)
-        self.lock = Lock()
-        self.logger = logging.getLogger('Logger Marketplace')
-        self.logger.setLevel(logging.INFO)
-        handler = RotatingFileHandler('marketplace.log', maxBytes=25000, backupCount=3)
-        formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:%(message)s')
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.producers = {} # (producer_id, queue_type tracking the producer's units on the market)
+        self.catalog = ProductCatalog()
+        self.inventory = {} # (product id, {producer_id: units available from that producer})
+        self.carts = {} # (cart_id, {product id: {producer_id: units in the cart}})
+        self.max_open_carts = max_open_carts
+        self.cart_ttl = cart_ttl
+        self.cart_used = {} # (cart_id, monotonic() time of its last use), with cart_ttl only
+        self.next_reap = 0 # monotonic() time new_cart reaps the expired carts at
+        self.hold_ttl = hold_ttl
+        # (cart_id, deque of [expiry, product id, producer_id, units] in the order they were put)
+        self.holds = {}
+        self.lost = {} # (cart_id, {product id: units whose hold expired}), with hold_ttl only
+        self.hold_expiries = [] # heap of (expiry, cart_id): when a cart's oldest holds are due
+        self.hold_lock = Lock() # guards hold_expiries, never held with another lock
+        self.lock = self.lock_type() # registration lock, and the only lock in the global mode
+        self.cart_slots = Condition(self.lock) # signaled when a cart is closed
+        self.producer_locks = {} # (producer_id, lock of the producer's Condition)
+        self.cart_locks = {} # (cart_id, lock owned by the open cart)
+        self.producer_conditions = {} # (producer_id, signaled when the producer's queue has room)
+        self.product_conditions = {} # (product id, signaled when the product is stocked)
+        if concurrency == CONCURRENCY_STRIPED:
+            self.stripes = [self.lock_type() for _ in range(lock_stripes)] # locks for the product index
+        else:
+            self.stripes = [self.lock]
+        self.logger = get_marketplace_logger(log_file, log_level, error_sample_rate)
+        self.order_sink = order_sink or StreamOrderSink()
+
+    def _new_lock(self):
+        """
+        A fresh lock for a producer or a cart (the global lock in the global mode).
+        """
+        return self.lock_type() if self.concurrency == CONCURRENCY_STRIPED else self.lock
+
+    def _stripe_index(self, product_id):
+        """
+        Index of the stripe lock guarding a product's entry in the inventory index.
+        """
+        return product_id % len(self.stripes)
+
+    def _product_lock(self, product_id):
+        """
+        The stripe lock guarding a product's entry in the inventory index.
+        """
+        return self.stripes[self._stripe_index(product_id)]
 
     def register_producer(self):
         """
@@ -32,72 +152,780 @@ class Marketplace:
         """
         with self.lock:
             self.producer_id_count += 1
-            self.producers[self.producer_id_count] = [] # initialize
-            self.logger.info('Registered new producer with id %s', str(self.producer_id_count))
-            return self.producer_id_count
+            self.producer_locks[self.producer_id_count] = self._new_lock()
+            self.producer_conditions[self.producer_id_count] = \
+                Condition(self.producer_locks[self.producer_id_count])
+            self.producers[self.producer_id_count] = self.queue_type(self.queue_size_per_producer)
+            producer_id = self.producer_id_count
+        self.logger.info('Registered new producer with id %s', str(producer_id))
+        return producer_id
+
+    @staticmethod
+    def _wait(condition, attempt, timeout):
+        """
+        Calls attempt() until it returns something else than None, waiting on
+        condition in between for at most timeout seconds overall (None means
+        forever). Returns the last result (condition's lock held).
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        result = attempt()
+        while result is None:
+            if deadline is None:
+                condition.wait()
+            else:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                condition.wait(remaining)
+            result = attempt()
+        return result
 
-    def publish(self, producer_id, product):
+    def _reserve_slots(self, producer_id, wanted, timeout):
+        """
+        Takes up to wanted slots of the producer's queue, waiting up to timeout
+        for one to free up if it is full. Returns how many it took, or None.
+        """
+        queue = self.producers[producer_id]
+        reserved = queue.reserve(wanted)
+        if reserved is None and timeout != 0:
+            with self.producer_locks[producer_id]:
+                queue.waiting += 1
+                try:
+                    reserved = self._wait(self.producer_conditions[producer_id],
+                                          lambda: queue.reserve(wanted), timeout)
+                finally:
+                    queue.waiting -= 1
+        return reserved
+
+    def _release_slots(self, producer_id, count=1):
+        """
+        Gives back count slots of the producer's queue.
+        """
+        queue = self.producers[producer_id]
+        queue.release(count)
+        # a publisher counts itself as waiting before its last reserve(), so
+        # either it sees the freed slots or it is seen here
+        if queue.waiting:
+            with self.producer_locks[producer_id]:
+                self._signal_producer(producer_id, count)
+
+    def _signal_producer(self, producer_id, count):
+        """
+        Wakes up to count publishers waiting for room in the producer's queue
+        (producer lock held).
+        """
+        self.producer_conditions[producer_id].notify(count)
+
+    def publish(self, producer_id, product, timeout=0):
         """
         Publish a producer's item on the market if the number of item's produced
-        isn't bigger than the queue size.
+        isn't bigger than the queue size. A timeout of 0 fails right away, a
+        positive one or None (forever) waits for a slot in the queue.
         """
-        if len(self.producers[int(producer_id)]) == self.queue_size_per_producer:
+        producer_id = int(producer_id)
+        reserved = self._reserve_slots(producer_id, 1, timeout)
+        if reserved is None:
+            if self.metrics is not None:
+                self.metrics.count('publish_rejected')
             self.logger.error('Producer %s couldnt place %s on the market - max queue size', producer_id, product)
             return False
-        self.producers[int(producer_id)].append(product)
+        product_id = self.catalog.intern(product)
+        with self._product_lock(product_id):
+            self._stock(product_id, producer_id)
+        if self.metrics is not None:
+            self.metrics.count('publishes')
         self.logger.info('Producer %s placed on the market %s', producer_id, product)
         return True
 
-    def new_cart(self):
+    def _stock(self, product_id, producer_id, count=1):
         """
-        Regiser a new cart in the database with its own id.
+        Makes count more units of a product available from producer_id and
+        wakes up consumers waiting for them (product lock held).
+        """
+        units = self.inventory.get(product_id)
+        if units is None:
+            units = self.inventory[product_id] = {}
+        units[producer_id] = units.get(producer_id, 0) + count
+        self._signal_product(product_id, count)
+
+    def _signal_product(self, product_id, count):
+        """
+        Wakes up to count consumers waiting for a product (product lock held).
+        """
+        condition = self.product_conditions.get(product_id)
+        if condition is not None:
+            condition.notify(count)
+
+    def _unstock(self, product_id, producer_id, count):
+        """
+        Takes back count units of a product stocked from producer_id, used to
+        roll back apply_cart_ops (product lock held).
+        """
+        units = self.inventory[product_id]
+        if units[producer_id] == count:
+            del units[producer_id]
+        else:
+            units[producer_id] -= count
+
+    def _product_condition(self, product_id):
+        """
+        The Condition consumers waiting for a product sleep on (product lock held).
+        """
+        condition = self.product_conditions.get(product_id)
+        if condition is None:
+            condition = self.product_conditions[product_id] = \
+                Condition(self._product_lock(product_id))
+        return condition
+
+    def _claim(self, product_id):
+        """
+        Takes one unit of a product off the market and returns the producer it
+        came from, or None if nobody has it (product lock held).
+        """
+        units = self.inventory.get(product_id)
+        if not units:
+            return None
+        producer_id = self.select_producer(self, units)
+        if units[producer_id] == 1:
+            del units[producer_id]
+        else:
+            units[producer_id] -= 1
+        return producer_id
+
+    def _claim_many(self, product_id, wanted):
+        """
+        Takes up to wanted units of a product off the market. Returns a list of
+        (producer_id, units) pairs, or None if nobody has the product (product
+        lock held).
+        """
+        units = self.inventory.get(product_id)
+        if not units:
+            return None
+        claims = []
+        while wanted > 0 and units:
+            producer_id = self.select_producer(self, units)
+            taken = min(units[producer_id], wanted)
+            if taken == units[producer_id]:
+                del units[producer_id]
+            else:
+                units[producer_id] -= taken
+            claims.append((producer_id, taken))
+            wanted -= taken
+        return claims
+
+    def new_cart(self, timeout=None):
+        """
+        Regiser a new cart in the database with its own id. If max_open_carts
+        carts are open, waits up to timeout seconds (None means forever) for
+        one to close and returns None if none did.
+        """
+        if self.cart_ttl is not None and monotonic() >= self.next_reap:
+            self.reap_carts()
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(deadline - monotonic(), 0)
+            if self.cart_ttl is not None:
+                # wake up to reap the carts expiring meanwhile
+                wait = self.cart_ttl if wait is None else min(wait, self.cart_ttl)
+            with self.lock:
+                cart_id = self._wait(self.cart_slots, self._register_cart, wait)
+            if cart_id is not None or self.cart_ttl is None:
+                break
+            # unless expired carts made room, give up once the timeout is over
+            if not self.reap_carts() and deadline is not None and monotonic() >= deadline:
+                break
+        if cart_id is None:
+            if self.metrics is not None:
+                self.metrics.count('new_cart_rejected')
+            self.logger.error('Couldnt register a new cart - %s carts open', self.max_open_carts)
+            return None
+        self.logger.info('Registered new cart with id %s', str(cart_id))
+        return cart_id
+
+    def _register_cart(self):
+        """
+        Opens a cart and returns its id, or None if max_open_carts are open
+        (registration lock held).
+        """
+        if self.max_open_carts is not None and len(self.cart_locks) >= self.max_open_carts:
+            return None
+        self.carts_id_count += 1
+        self.cart_locks[self.carts_id_count] = self._new_lock()
+        self.carts[self.carts_id_count] = _Cart() # initialize
+        if self.cart_ttl is not None:
+            self.cart_used[self.carts_id_count] = monotonic()
+        return self.carts_id_count
+
+    def _cart_lock(self, cart_id):
+        """
+        The lock of an open cart. With cart_ttl the cart is noted as being used
+        under it, even by calls that fail.
+        """
+        lock = self.cart_locks.get(cart_id)
+        if lock is None:
+            raise CartClosedError('Cart %s is not open' % cart_id)
+        if self.cart_ttl is not None:
+            with lock:
+                self._open_cart(cart_id)
+        return lock
+
+    def _open_cart(self, cart_id):
+        """
+        The contents of an open cart, noting that it is being used (cart lock
+        held). The cart may have been reaped since its lock was looked up.
+        """
+        cart = self.carts.get(cart_id)
+        if cart is None:
+            raise CartClosedError('Cart %s is not open' % cart_id)
+        if self.cart_ttl is not None:
+            self.cart_used[cart_id] = monotonic()
+        return cart
+
+    def _close_cart(self, cart_id):
+        """
+        Forgets a cart already taken out of self.carts and lets a new_cart
+        waiting for a free cart in.
         """
         with self.lock:
-            self.carts_id_count += 1
-            self.carts[self.carts_id_count] = [] # initialize
-            self.logger.info('Registered new cart with id %s', str(self.carts_id_count))
-            return self.carts_id_count
+            del self.cart_locks[cart_id]
+            self.cart_slots.notify()
 
-    def add_to_cart(self, cart_id, product):
+    def reap_carts(self):
+        """
+        Closes the carts unused for cart_ttl seconds, giving their units back
+        to the market. Returns how many were closed. new_cart runs it every
+        cart_ttl / 2 seconds and whenever it waits for a free cart.
+        """
+        now = monotonic()
+        self.next_reap = now + self.cart_ttl / 2
+        expired = [cart_id for cart_id, used in list(self.cart_used.items())
+                   if now - used >= self.cart_ttl]
+        closed = 0
+        for cart_id in expired:
+            lock = self.cart_locks.get(cart_id)
+            if lock is None:
+                continue
+            with lock:
+                # the owner may have used it since
+                cart = self.carts.get(cart_id)
+                if cart is None or monotonic() - self.cart_used[cart_id] < self.cart_ttl:
+                    continue
+                del self.carts[cart_id]
+                del self.cart_used[cart_id]
+                self.holds.pop(cart_id, None)
+                self.lost.pop(cart_id, None)
+            for product_id, units in cart.items():
+                self._give_back(product_id, units)
+            self._close_cart(cart_id)
+            closed += 1
+            if self.metrics is not None:
+                self.metrics.count('carts_expired')
+            self.logger.info('Closed the expired cart %s', cart_id)
+        return closed
+
+    def add_to_cart(self, cart_id, product, timeout=0):
         """
         Add an item to a cart if the item is produced already (it is on a queue
-        of one of the producers).
+        of one of the producers). A timeout of 0 fails right away, a positive
+        one or None (forever) waits for the product to be stocked.
         """
-        with self.lock:
-            for producer in self.producers:
-                if product in self.producers[producer]:
-                    self.carts[int(cart_id)].append((product, producer))
-                    self.producers[producer].remove(product)
-                    self.logger.info('Added product %s to the cart %s', product, cart_id)
-                    return True
+        cart_id = int(cart_id)
+        cart_lock = self._cart_lock(cart_id)
+        product_id = self.catalog.intern(product)
+        if self.hold_ttl is not None:
+            self._reclaim_due()
+        with self._product_lock(product_id):
+            producer = self._claim(product_id)
+            if producer is None and timeout != 0:
+                producer = self._wait(self._product_condition(product_id),
+                                      lambda: self._claim(product_id), timeout)
+        if producer is None:
+            if self.metrics is not None:
+                self.metrics.count('add_misses')
             self.logger.error('Couldnt add product %s to the cart %s - didnt find product', product, cart_id)
             return False
+        self._release_slots(producer)
+        self._fill(cart_id, cart_lock, product_id, {producer: 1})
+        if self.metrics is not None:
+            self.metrics.count('add_hits')
+        self.logger.info('Added product %s to the cart %s', product, cart_id)
+        return True
 
     def remove_from_cart(self, cart_id, product):
         """
         Removes an item from a cart (if the item exists in the cart)
         """
-        with self.lock:
-            for pair in self.carts[int(cart_id)]:
-                if pair[0] == product:
-                    self.carts[int(cart_id)].remove(pair)
-                    self.producers[pair[1]].append(product)
-                    self.logger.info('Removed product %s from the cart %s', product, cart_id)
-                    return
+        cart_id = int(cart_id)
+        product_id = self.catalog.lookup(product)
+        producer = None
+        lost = 0
+        with self._cart_lock(cart_id):
+            cart = self._open_cart(cart_id)
+            units = cart.get(product_id)
+            if units:
+                # give the unit back to the producer added last
+                producer = next(reversed(units))
+                self._drop(cart, product_id, producer, 1)
+                if self.hold_ttl is not None:
+                    self._unhold(cart_id, product_id, {producer: 1})
+            elif self.hold_ttl is not None:
+                # a unit whose hold expired no longer has to be bought again
+                lost = self._unlose(cart_id, product_id, 1)
+        if producer is None and not lost:
+            if self.metrics is not None:
+                self.metrics.count('remove_misses')
             self.logger.error('Couldnt remove item %s from cart %s - didnt find item', product, cart_id)
+            return
+        if producer is not None:
+            self._give_back(product_id, {producer: 1})
+        if self.metrics is not None:
+            self.metrics.count('removes')
+        self.logger.info('Removed product %s from the cart %s', product, cart_id)
 
-    def place_order(self, cart_id):
+    def publish_many(self, producer_id, product, quantity, timeout=0):
         """
-        Places an order from a cart with a specific id.
+        Publishes up to quantity units of a product, as many as the producer's
+        queue has room for. Returns how many were published; with a timeout it
+        waits until at least one slot is free.
         """
-        order = []
-        for pair in self.carts[int(cart_id)]:
-            with self.lock:
-                print("{} bought {}".format(currentThread().getName(), pair[0]))
-            order.append(pair[0])
+        producer_id = int(producer_id)
+        reserved = self._reserve_slots(producer_id, quantity, timeout)
+        if reserved is None:
+            if self.metrics is not None:
+                self.metrics.count('publish_rejected')
+            self.logger.error('Producer %s couldnt place %s on the market - max queue size', producer_id, product)
+            return 0
+        product_id = self.catalog.intern(product)
+        with self._product_lock(product_id):
+            self._stock(product_id, producer_id, reserved)
+        if self.metrics is not None:
+            self.metrics.count('publishes', reserved)
+        self.logger.info('Producer %s placed on the market %d x %s', producer_id, reserved, product)
+        return reserved
+
+    def add_many(self, cart_id, product, quantity, timeout=0):
+        """
+        Adds up to quantity units of a product to a cart, as many as the market
+        has. Returns how many were added; with a timeout it waits until at least
+        one unit is available.
+        """
+        cart_id = int(cart_id)
+        cart_lock = self._cart_lock(cart_id)
+        product_id = self.catalog.intern(product)
+        if self.hold_ttl is not None:
+            self._reclaim_due()
+        with self._product_lock(product_id):
+            claims = self._claim_many(product_id, quantity)
+            if claims is None and timeout != 0:
+                claims = self._wait(self._product_condition(product_id),
+                                    lambda: self._claim_many(product_id, quantity), timeout)
+        if claims is None:
+            if self.metrics is not None:
+                self.metrics.count('add_misses')
+            self.logger.error('Couldnt add product %s to the cart %s - didnt find product', product, cart_id)
+            return 0
+        for producer, units in claims:
+            self._release_slots(producer, units)
+        self._fill(cart_id, cart_lock, product_id, dict(claims))
+        added = sum(units for _, units in claims)
+        if self.metrics is not None:
+            self.metrics.count('add_hits', added)
+        self.logger.info('Added %d x product %s to the cart %s', added, product, cart_id)
+        return added
+
+    def remove_many(self, cart_id, product, quantity):
+        """
+        Removes up to quantity units of a product from a cart and returns how
+        many were removed.
+        """
+        cart_id = int(cart_id)
+        product_id = self.catalog.lookup(product)
+        lost = 0
+        with self._cart_lock(cart_id):
+            returns = self._take_from(self._open_cart(cart_id), product_id, quantity)
+            if self.hold_ttl is not None:
+                self._unhold(cart_id, product_id, returns)
+                lost = self._unlose(cart_id, product_id, quantity - sum(returns.values()))
+        if not returns and not lost:
+            if self.metrics is not None:
+                self.metrics.count('remove_misses')
+            self.logger.error('Couldnt remove item %s from cart %s - didnt find item', product, cart_id)
+            return 0
+        self._give_back(product_id, returns)
+        removed = sum(returns.values()) + lost
+        if self.metrics is not None:
+            self.metrics.count('removes', removed)
+        self.logger.info('Removed %d x product %s from the cart %s', removed, product, cart_id)
+        return removed
+
+    def _fill(self, cart_id, cart_lock, product_id, units):
+        """
+        Puts the {producer_id: units} claimed of a product in the cart, or back
+        on the market if the cart was reaped in the meantime.
+        """
+        expiry = None
+        with cart_lock:
+            cart = self.carts.get(cart_id)
+            if cart is not None:
+                for producer, count in units.items():
+                    self._put(cart, product_id, producer, count)
+                if self.hold_ttl is not None:
+                    expiry = self._hold(cart_id, product_id, units)
+        if cart is None:
+            self._give_back(product_id, units)
+            raise CartClosedError('Cart %s is not open' % cart_id)
+        if expiry is not None:
+            self._schedule(cart_id, expiry)
+
+    def _give_back(self, product_id, units):
+        """
+        Puts {producer_id: units} of a product taken out of a cart back on the
+        market.
+        """
+        for producer, count in units.items():
+            self.producers[producer].restock(count)
+            with self._product_lock(product_id):
+                self._stock(product_id, producer, count)
+
+    @staticmethod
+    def _put(cart, product_id, producer_id, count=1):
+        """
+        Adds count units of a product from producer_id to the cart (cart lock held).
+        """
+        units = cart.get(product_id)
+        if units is None:
+            units = cart[product_id] = {}
+        units[producer_id] = units.get(producer_id, 0) + count
+        runs = cart.runs
+        if runs and runs[-1][0] == product_id and runs[-1][1] == producer_id:
+            runs[-1][2] += count
+        else:
+            runs.append([product_id, producer_id, count])
+
+    @staticmethod
+    def _drop(cart, product_id, producer_id, count):
+        """
+        Takes count units of a product from producer_id out of the cart (cart
+        lock held).
+        """
+        units = cart[product_id]
+        if units[producer_id] == count:
+            del units[producer_id]
+            if not units:
+                del cart[product_id]
+        else:
+            units[producer_id] -= count
+
+    @classmethod
+    def _take_from(cls, cart, product_id, quantity):
+        """
+        Takes up to quantity units of a product out of the cart, the units of
+        the producers added last first. Returns {producer_id: units} for the
+        units taken (cart lock held).
+        """
+        returns = {}
+        while quantity > 0 and product_id in cart:
+            producer = next(reversed(cart[product_id]))
+            taken = min(cart[product_id][producer], quantity)
+            cls._drop(cart, product_id, producer, taken)
+            returns[producer] = taken
+            quantity -= taken
+        return returns
+
+    def apply_cart_ops(self, cart_id, operations):
+        """
+        Applies a list of cart operations (dicts with "type", "product" and
+        "quantity", like the consumers' carts) atomically. Returns True if every
+        add was fulfilled; otherwise the cart and the market are left untouched
+        and False is returned. Removing products that aren't in the cart is
+        ignored, like remove_from_cart does.
+        """
+        cart_id = int(cart_id)
+        product_ids = [self.catalog.intern(op["product"]) for op in operations]
+        if self.hold_ttl is not None:
+            self._reclaim_due()
+        # cart lock first, then the stripes in index order, so concurrent calls can't deadlock
+        locks = [self._cart_lock(cart_id)]
+        for index in sorted({self._stripe_index(product_id) for product_id in product_ids}):
+            if all(self.stripes[index] is not lock for lock in locks):
+                locks.append(self.stripes[index])
+
+        slots = {} # (producer_id, slots freed in its queue, negative for returned units)
+        expiry = None
+        with ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            cart = self._open_cart(cart_id).copy()
+            undo = [] # (product id, claimed {producer_id: units}, returned {producer_id: units})
+            for operation, product_id in zip(operations, product_ids):
+                quantity = operation["quantity"]
+                if operation["type"] == "add":
+                    claims = dict(self._claim_many(product_id, quantity) or [])
+                    undo.append((product_id, claims, {}))
+                    if sum(claims.values()) < quantity:
+                        self._roll_back(undo)
+                        break
+                    for producer, units in claims.items():
+                        self._put(cart, product_id, producer, units)
+                        slots[producer] = slots.get(producer, 0) + units
+                else:
+                    returns = self._take_from(cart, product_id, quantity)
+                    undo.append((product_id, {}, returns))
+                    for producer, units in returns.items():
+                        self._stock(product_id, producer, units)
+                        slots[producer] = slots.get(producer, 0) - units
+            else:
+                self.carts[cart_id] = cart
+                if self.hold_ttl is not None:
+                    for (product_id, claims, returns), operation in zip(undo, operations):
+                        if claims:
+                            expiry = self._hold(cart_id, product_id, claims)
+                        else:
+                            self._unhold(cart_id, product_id, returns)
+                            self._unlose(cart_id, product_id,
+                                         operation["quantity"] - sum(returns.values()))
+                undo = None
+        if undo is not None:
+            if self.metrics is not None:
+                self.metrics.count('cart_ops_rejected')
+            self.logger.error('Couldnt apply %d operations to the cart %s - missing product %s',
+                              len(operations), cart_id, operations[len(undo) - 1]["product"])
+            return False
+
+        if expiry is not None:
+            self._schedule(cart_id, expiry)
+        for producer, freed in slots.items():
+            if freed > 0:
+                self._release_slots(producer, freed)
+            elif freed < 0:
+                self.producers[producer].restock(-freed)
+        if self.metrics is not None:
+            self.metrics.count('cart_ops_applied')
+        self.logger.info('Applied %d operations to the cart %s', len(operations), cart_id)
+        return True
+
+    def _roll_back(self, undo):
+        """
+        Reverts the inventory changes apply_cart_ops logged in undo (stripe locks held).
+        """
+        for product_id, claims, returns in reversed(undo):
+            for producer, units in claims.items():
+                self._stock(product_id, producer, units)
+            for producer, units in returns.items():
+                self._unstock(product_id, producer, units)
+
+    def place_order(self, cart_id, buyer=None):
+        """
+        Places an order from a cart with a specific id. The buyer printed is the
+        current thread's name unless another name is given.
+        """
+        if buyer is None:
+            buyer = current_thread().name
+        order = self.checkout(cart_id)
+        if order is None:
+            return None
+        self.order_sink.emit(buyer, order)
+        return order
+
+    def checkout(self, cart_id):
+        """
+        Returns the products ordered from a cart without printing them, for
+        callers that report the order themselves. The cart is closed, unless
+        some of its holds expired: then it stays open and None is returned.
+        """
+        cart_id = int(cart_id)
+        with self._cart_lock(cart_id):
+            cart = self._open_cart(cart_id)
+            lost = sum(self.lost.get(cart_id, {}).values())
+            if not lost:
+                del self.carts[cart_id]
+                self.cart_used.pop(cart_id, None)
+                self.holds.pop(cart_id, None)
+        if lost:
+            if self.metrics is not None:
+                self.metrics.count('orders_rejected')
+            self.logger.error('Couldnt place order from the cart %s - %d units lost their hold',
+                              cart_id, lost)
+            return None
+        self._close_cart(cart_id)
+        # nothing changes the cart once it is out of self.carts
+        products = self.catalog.products
+        order = [products[product_id] for product_id, _ in cart.units()]
+        if self.metrics is not None:
+            self.metrics.count('orders')
+            self.metrics.count('ordered_units', len(order))
         self.logger.info('Placed order from the cart %s', cart_id)
         return order
 
+    def _hold(self, cart_id, product_id, units):
+        """
+        Holds the {producer_id: units} of a product just put in the cart for
+        hold_ttl seconds. Returns when they expire, for _schedule (cart lock held).
+        """
+        expiry = monotonic() + self.hold_ttl
+        holds = self.holds.get(cart_id)
+        if holds is None:
+            holds = self.holds[cart_id] = deque()
+        for producer, count in units.items():
+            holds.append([expiry, product_id, producer, count])
+        return expiry
+
+    def _schedule(self, cart_id, expiry):
+        """
+        Notes that some holds of a cart expire at expiry.
+        """
+        with self.hold_lock:
+            heappush(self.hold_expiries, (expiry, cart_id))
+
+    def _unhold(self, cart_id, product_id, units):
+        """
+        Drops the holds on {producer_id: units} of a product taken out of the
+        cart, the newest first like _take_from (cart lock held).
+        """
+        holds = self.holds.get(cart_id, ())
+        for producer, count in units.items():
+            for hold in reversed(holds):
+                if count == 0:
+                    break
+                if hold[1] == product_id and hold[2] == producer:
+                    dropped = min(hold[3], count)
+                    hold[3] -= dropped
+                    count -= dropped
+
+    def _unlose(self, cart_id, product_id, quantity):
+        """
+        Forgets up to quantity units of a product the cart lost, removed by its
+        owner before buying them again. Returns how many (cart lock held).
+        """
+        lost = self.lost.get(cart_id)
+        if not lost or quantity <= 0 or product_id not in lost:
+            return 0
+        forgotten = min(lost[product_id], quantity)
+        if forgotten == lost[product_id]:
+            del lost[product_id]
+        else:
+            lost[product_id] -= forgotten
+        return forgotten
+
+    def _reclaim_due(self):
+        """
+        Calls reclaim_holds if a hold may have expired.
+        """
+        try:
+            due = self.hold_expiries[0][0] <= monotonic()
+        except IndexError:
+            return
+        if due:
+            self.reclaim_holds()
+
+    def reclaim_holds(self):
+        """
+        Takes the units whose hold expired out of their carts and gives them
+        back to the market, noting them in the carts' lost units. Returns how
+        many units were reclaimed. The next add runs it once a hold is due.
+        """
+        now = monotonic()
+        due = set()
+        with self.hold_lock:
+            while self.hold_expiries and self.hold_expiries[0][0] <= now:
+                due.add(heappop(self.hold_expiries)[1])
+        reclaimed = 0
+        for cart_id in due:
+            lock = self.cart_locks.get(cart_id)
+            if lock is None:
+                continue
+            expired = [] # (product id, producer_id, units)
+            with lock:
+                cart = self.carts.get(cart_id)
+                holds = self.holds.get(cart_id)
+                if cart is None or holds is None:
+                    continue
+                lost = self.lost.setdefault(cart_id, {})
+                while holds and holds[0][0] <= now:
+                    _, product_id, producer, count = holds.popleft()
+                    if count:
+                        self._drop(cart, product_id, producer, count)
+                        lost[product_id] = lost.get(product_id, 0) + count
+                        expired.append((product_id, producer, count))
+            for product_id, producer, count in expired:
+                self._give_back(product_id, {producer: count})
+                reclaimed += count
+        if reclaimed:
+            if self.metrics is not None:
+                self.metrics.count('holds_expired', reclaimed)
+            self.logger.info('Reclaimed %d units whose hold expired', reclaimed)
+        return reclaimed
+
+    def lost_units(self, cart_id):
+        """
+        The (product, units) taken out of a cart since the last call because
+        their hold expired, for the owner to buy again (see hold_ttl).
+        """
+        cart_id = int(cart_id)
+        with self._cart_lock(cart_id):
+            self._open_cart(cart_id)
+            lost = self.lost.pop(cart_id, {})
+        products = self.catalog.products
+        return [(products[product_id], units) for product_id, units in lost.items()]
+
+    def cart_contents(self, cart_id):
+        """
+        The (product, producer_id) pairs of every unit in a cart, in checkout order.
+        """
+        cart_id = int(cart_id)
+        with self._cart_lock(cart_id):
+            units = self._open_cart(cart_id).units()
+        products = self.catalog.products
+        return [(products[product_id], producer) for product_id, producer in units]
+
+    def queue_depths(self):
+        """
+        {producer_id: units on the market} of every producer.
+        """
+        return {producer_id: len(queue) for producer_id, queue in list(self.producers.items())}
+
+    def available(self, product):
+        """
+        {producer_id: units} of a product currently on the market.
+        """
+        product_id = self.catalog.lookup(product)
+        if product_id is None:
+            return {}
+        with self._product_lock(product_id):
+            return dict(self.inventory.get(product_id, {}))
+
+    def producer_stock(self):
+        """
+        {producer_id: {product: units on the market}} of every producer.
+        """
+        stock = {}
+        products = self.catalog.products
+        for product_id, units in list(self.inventory.items()):
+            with self._product_lock(product_id):
+                units = list(units.items())
+            for producer, count in units:
+                stock.setdefault(producer, {})[products[product_id]] = count
+        return stock
+
+    def evict(self, producer_id, product):
+        """
+        Takes every unit of a product a producer has on the market off it,
+        freeing their slots in its queue. Returns how many were evicted.
+        """
+        producer_id = int(producer_id)
+        product_id = self.catalog.lookup(product)
+        if product_id is None:
+            return 0
+        with self._product_lock(product_id):
+            evicted = self.inventory.get(product_id, {}).pop(producer_id, 0)
+        if evicted:
+            self._release_slots(producer_id, evicted)
+            if self.metrics is not None:
+                self.metrics.count('evicted', evicted)
+            self.logger.info('Evicted %d x %s of producer %s from the market', evicted, product,
+                             producer_id)
+        return evicted
+
 class TestMarketplace(unittest.TestCase):
     """
     Class that represents the Marketplace test class, made for unittesting
@@ -130,6 +958,13 @@ class TestMarketplace(unittest.TestCase):
         self.assertTrue(self.marketplace.publish(producer_id, "coffee1"))
         self.assertFalse(self.marketplace.publish(producer_id, "coffee2"))
 
+    def test_single_log_handler(self):
+        """
+        Creating more marketplaces shouldn't attach more log handlers.
+        """
+        Marketplace(3)
+        self.assertEqual(len(self.marketplace.logger.handlers), 1)
+
     def test_new_cart(self):
         """
         First cart id should be 0
@@ -151,6 +986,94 @@ class TestMarketplace(unittest.TestCase):
         """
         self.assertFalse(self.marketplace.add_to_cart(self.marketplace.new_cart(), "tea"))
 
+    def test_add_to_cart_frees_queue_slot(self):
+        """
+        Taking a product off the market should let its producer publish again,
+        and the product shouldn't be available twice.
+        """
+        producer_id = self.marketplace.register_producer()
+        for product in ["tea1", "tea2", "tea3"]:
+            self.marketplace.publish(producer_id, product)
+        self.assertFalse(self.marketplace.publish(producer_id, "tea4"))
+        cart_id = self.marketplace.new_cart()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, "tea2"))
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, "tea2"))
+        self.assertTrue(self.marketplace.publish(producer_id, "tea4"))
+
+    def test_remove_from_cart_restocks(self):
+        """
+        A removed product should go back to the producer it came from.
+        """
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        self.marketplace.publish(second, "tea")
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.marketplace.remove_from_cart(cart_id, "tea")
+        self.assertEqual(self.marketplace.available("tea"), {second: 1})
+        self.assertEqual(self.marketplace.queue_depths(), {first: 0, second: 1})
+
+    def test_add_to_cart_timeout(self):
+        """
+        A blocking add should give up after its timeout if nothing is published,
+        and should succeed as soon as another thread publishes the product.
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, "tea", timeout=0.01))
+        publisher = Timer(0.05, self.marketplace.publish, args=(producer_id, "tea"))
+        publisher.start()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, "tea", timeout=5))
+        publisher.join()
+
+    def test_publish_timeout(self):
+        """
+        A blocking publish on a full queue should wait until a unit is bought.
+        """
+        producer_id = self.marketplace.register_producer()
+        for product in ["tea1", "tea2", "tea3"]:
+            self.marketplace.publish(producer_id, product)
+        self.assertFalse(self.marketplace.publish(producer_id, "tea4", timeout=0.01))
+        buyer = Timer(0.05, self.marketplace.add_to_cart,
+                      args=(self.marketplace.new_cart(), "tea1"))
+        buyer.start()
+        self.assertTrue(self.marketplace.publish(producer_id, "tea4", timeout=5))
+        buyer.join()
+
+    def test_bulk_partial(self):
+        """
+        Bulk calls should move as many units as possible and report how many.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.assertEqual(self.marketplace.publish_many(producer_id, "tea", 5), 3)
+        self.assertEqual(self.marketplace.publish_many(producer_id, "tea", 1), 0)
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_many(cart_id, "tea", 2), 2)
+        self.assertEqual(self.marketplace.add_many(cart_id, "tea", 2), 1)
+        self.assertEqual(self.marketplace.remove_many(cart_id, "tea", 5), 3)
+        self.assertEqual(len(self.marketplace.producers[producer_id]), 3)
+
+    def test_apply_cart_ops(self):
+        """
+        A cart op list should be applied entirely or not at all.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer_id, "tea", 2)
+        self.marketplace.publish(producer_id, "coffee")
+        cart_id = self.marketplace.new_cart()
+        failing = [{"type": "add", "product": "tea", "quantity": 2},
+                   {"type": "remove", "product": "tea", "quantity": 1},
+                   {"type": "add", "product": "coffee", "quantity": 2}]
+        self.assertFalse(self.marketplace.apply_cart_ops(cart_id, failing))
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [])
+        self.assertEqual(self.marketplace.available("tea"), {producer_id: 2})
+        self.assertEqual(self.marketplace.available("coffee"), {producer_id: 1})
+        failing[2]["quantity"] = 1
+        self.assertTrue(self.marketplace.apply_cart_ops(cart_id, failing))
+        self.assertEqual(self.marketplace.place_order(cart_id), ["tea", "coffee"])
+        self.assertEqual(self.marketplace.available("tea"), {producer_id: 1})
+        self.assertEqual(len(self.marketplace.producers[producer_id]), 1)
+
     def test_remove_from_cart(self):
         """
         Tests successively remove_from_cart function with 2 items, tea and coffee.
@@ -160,9 +1083,23 @@ class TestMarketplace(unittest.TestCase):
         self.marketplace.publish(producer_id, "coffee")
         cart_id = self.marketplace.new_cart()
         self.marketplace.add_to_cart(cart_id, "tea")
-        self.assertEqual(self.marketplace.carts[cart_id], [("tea", 0)])
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [("tea", 0)])
+        self.marketplace.remove_from_cart(cart_id, "tea")
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [])
+
+    def test_remove_from_cart_last_producer(self):
+        """
+        A removed unit should go back to the producer whose units were added last.
+        """
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        self.marketplace.publish(first, "tea")
+        self.marketplace.publish(second, "tea")
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_many(cart_id, "tea", 2), 2)
         self.marketplace.remove_from_cart(cart_id, "tea")
-        self.assertEqual(self.marketplace.carts[cart_id], [])
+        self.assertEqual(self.marketplace.available("tea"), {second: 1})
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [("tea", first)])
 
     def test_place_order(self):
         """
@@ -176,4 +1113,197 @@ class TestMarketplace(unittest.TestCase):
         self.marketplace.add_to_cart(cart_id, "coffee")
         order = self.marketplace.place_order(cart_id)
         self.assertEqual(order, ["tea", "coffee"])
-    
\ No newline at end of file
+
+    def test_place_order_interleaved(self):
+        """
+        The cart and the order should list the units in the order they were added.
+        """
+        for products in (("tea", "coffee", "tea"), ("tea", "milk")):
+            producer_id = self.marketplace.register_producer()
+            for product in products:
+                self.marketplace.publish(producer_id, product)
+        cart_id = self.marketplace.new_cart()
+        for product in ("tea", "coffee", "tea", "milk", "tea"):
+            self.marketplace.add_to_cart(cart_id, product)
+        self.assertEqual([product for product, _ in self.marketplace.cart_contents(cart_id)],
+                         ["tea", "coffee", "tea", "milk", "tea"])
+        self.assertEqual(self.marketplace.place_order(cart_id),
+                         ["tea", "coffee", "tea", "milk", "tea"])
+
+    def test_place_order_sink(self):
+        """
+        The order should be written to the marketplace's order sink.
+        """
+        self.marketplace.order_sink = CollectorOrderSink()
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, "tea")
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.marketplace.place_order(cart_id, buyer="cons1")
+        self.assertEqual(self.marketplace.order_sink.lines, ["cons1 bought tea"])
+
+    def test_place_order_closes_cart(self):
+        """
+        A placed order's cart should be forgotten and unusable.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, "tea")
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.marketplace.checkout(cart_id)
+        self.assertEqual((self.marketplace.carts, self.marketplace.cart_locks), ({}, {}))
+        self.assertRaises(ValueError, self.marketplace.add_to_cart, cart_id, "tea")
+        self.assertRaises(ValueError, self.marketplace.checkout, cart_id)
+
+    def test_max_open_carts(self):
+        """
+        new_cart should wait for a cart to close when max_open_carts are open.
+        """
+        self.marketplace = Marketplace(3, concurrency=self.marketplace.concurrency,
+                                       order_sink=CollectorOrderSink(), max_open_carts=1)
+        cart_id = self.marketplace.new_cart()
+        self.assertIsNone(self.marketplace.new_cart(timeout=0.01))
+        buyer = Timer(0.05, self.marketplace.place_order, args=(cart_id,))
+        buyer.start()
+        self.assertEqual(self.marketplace.new_cart(timeout=5), cart_id + 1)
+        buyer.join()
+
+    def test_cart_ttl(self):
+        """
+        An unused cart should expire, its units going back to their producer,
+        and make room for a new cart.
+        """
+        self.marketplace = Marketplace(3, concurrency=self.marketplace.concurrency,
+                                       max_open_carts=1, cart_ttl=0.05)
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer_id, "tea", 3)
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_many(cart_id, "tea", 2)
+        self.assertEqual(self.marketplace.reap_carts(), 0)
+        self.assertEqual(self.marketplace.new_cart(timeout=5), cart_id + 1)
+        self.assertEqual(self.marketplace.available("tea"), {producer_id: 3})
+        self.assertEqual(self.marketplace.queue_depths(), {producer_id: 3})
+        self.assertRaises(CartClosedError, self.marketplace.remove_from_cart, cart_id, "tea")
+        self.assertRaises(CartClosedError, self.marketplace.add_to_cart, cart_id, "tea")
+        self.assertNotIn(cart_id, self.marketplace.cart_used)
+
+    def test_hold_ttl(self):
+        """
+        Units held past hold_ttl should go to the next consumer asking for
+        them, and the stalled cart's order wait until they are bought again.
+        """
+        self.marketplace = Marketplace(3, concurrency=self.marketplace.concurrency,
+                                       order_sink=CollectorOrderSink(), hold_ttl=0.05)
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer_id, "tea", 2)
+        stalled = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_many(stalled, "tea", 2), 2)
+        self.assertFalse(self.marketplace.add_to_cart(stalled, "coffee"))
+        sleep(0.1)
+        cart_id = self.marketplace.new_cart()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, "tea"))
+        self.assertEqual(self.marketplace.cart_contents(stalled), [])
+        self.assertIsNone(self.marketplace.place_order(stalled))
+        # a lost unit removed by its owner needn't be bought again
+        self.assertEqual(self.marketplace.remove_many(stalled, "tea", 1), 1)
+        self.assertEqual(self.marketplace.lost_units(stalled), [("tea", 1)])
+        self.assertTrue(self.marketplace.add_to_cart(stalled, "tea"))
+        self.assertEqual(self.marketplace.place_order(stalled), ["tea"])
+        self.assertEqual(self.marketplace.place_order(cart_id), ["tea"])
+
+    def test_metrics(self):
+        """
+        Operations should be counted and the queue depths reported.
+        """
+        metrics = MarketplaceMetrics()
+        self.marketplace = Marketplace(3, concurrency=self.marketplace.concurrency,
+                                       order_sink=CollectorOrderSink(), metrics=metrics)
+        producer_id = self.marketplace.register_producer()
+        for product in ["tea", "tea", "coffee", "coffee"]:
+            self.marketplace.publish(producer_id, product)
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.marketplace.add_to_cart(cart_id, "milk")
+        self.marketplace.place_order(cart_id)
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {"publishes": 3, "publish_rejected": 1,
+                                                "add_hits": 1, "add_misses": 1,
+                                                "orders": 1, "ordered_units": 1})
+        self.assertEqual(snapshot["gauges"]["queue_depth"], {producer_id: 2})
+        self.assertGreater(snapshot["histograms"]["lock_wait"]["count"], 0)
+
+    def test_first_fit_selection(self):
+        """
+        By default a unit should come from the lowest producer id having the
+        product, even if it restocked after the others.
+        """
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        self.marketplace.publish(first, "tea")
+        self.marketplace.publish(second, "tea")
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.marketplace.publish(first, "tea")
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [("tea", first), ("tea", first)])
+
+    def test_fullest_selection(self):
+        """
+        With the fullest policy a unit should come from the producer that has
+        the most units on the market.
+        """
+        self.marketplace = Marketplace(3, concurrency=self.marketplace.concurrency,
+                                       selection="fullest")
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        self.marketplace.publish(first, "tea")
+        self.marketplace.publish_many(second, "tea", 3)
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.add_to_cart(cart_id, "tea")
+        self.assertEqual(self.marketplace.cart_contents(cart_id), [("tea", second)])
+        self.assertTrue(self.marketplace.publish(second, "coffee"))
+
+    def test_evict(self):
+        """
+        Evicting a product should free its producer's slots and leave the rest
+        of the stock alone.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish_many(producer_id, "coffee", 2)
+        self.marketplace.publish(producer_id, "tea")
+        self.assertEqual(self.marketplace.producer_stock(), {producer_id: {"coffee": 2, "tea": 1}})
+        self.assertEqual(self.marketplace.evict(producer_id, "coffee"), 2)
+        self.assertEqual(self.marketplace.evict(producer_id, "milk"), 0)
+        self.assertEqual(self.marketplace.producer_stock(), {producer_id: {"tea": 1}})
+        self.assertEqual(self.marketplace.publish_many(producer_id, "milk", 3), 2)
+
+    def test_interned_products(self):
+        """
+        Equal products should share one catalog id and come back out of the
+        cart as the instance first published.
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, Tea("Linden", 9, "Herbal"))
+        cart_id = self.marketplace.new_cart()
+        self.assertTrue(self.marketplace.add_to_cart(cart_id, Tea("Linden", 9, "Herbal")))
+        self.assertEqual(len(self.marketplace.catalog), 1)
+        self.assertEqual(self.marketplace.checkout(cart_id), [Tea("Linden", 9, "Herbal")])
+
+
+
+class TestStripedMarketplace(TestMarketplace):
+    """
+    Runs every Marketplace test again with the striped concurrency mode.
+    """
+    def setUp(self):
+        self.marketplace = Marketplace(3, concurrency=CONCURRENCY_STRIPED, lock_stripes=4)
+
+    def test_disjoint_locks(self):
+        """
+        Producers and carts should get their own locks in the striped mode.
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+        self.assertIsNot(self.marketplace.producer_locks[producer_id], self.marketplace.lock)
+        self.assertIsNot(self.marketplace.cart_locks[cart_id],
+                         self.marketplace.producer_locks[producer_id])
@@ -0,0 +1,247 @@
+"""Threading/time/json modules"""
+from threading import Event, Lock, Thread, local
+import json
+import sys
+import time
+import unittest
+
+
+class Histogram:
+    """
+    Histogram of durations with power of two microsecond buckets: bucket i
+    counts the samples below 2**i microseconds (and at least 2**(i-1)).
+    """
+    def __init__(self):
+        self.buckets = []
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """
+        Adds one duration to the histogram.
+        """
+        index = int(seconds * 1e6).bit_length()
+        if index >= len(self.buckets):
+            self.buckets.extend([0] * (index + 1 - len(self.buckets)))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Adds the samples of another histogram to this one.
+        """
+        if len(other.buckets) > len(self.buckets):
+            self.buckets.extend([0] * (len(other.buckets) - len(self.buckets)))
+        for index, samples in enumerate(other.buckets):
+            self.buckets[index] += samples
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, point):
+        """
+        Upper bound, in microseconds, of the bucket holding the given percentile.
+        """
+        rank = self.count * point / 100
+        seen = 0
+        for index, samples in enumerate(self.buckets):
+            seen += samples
+            if samples and seen >= rank:
+                return min(2 ** index, self.max * 1e6)
+        return self.max * 1e6
+
+    def snapshot(self):
+        """
+        The histogram as a JSON friendly dict.
+        """
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "sum_us": self.total * 1e6,
+                "mean_us": self.total * 1e6 / self.count, "max_us": self.max * 1e6,
+                "p50_us": self.percentile(50), "p90_us": self.percentile(90),
+                "p99_us": self.percentile(99),
+                "buckets": {"<{}us".format(2 ** index): samples
+                            for index, samples in enumerate(self.buckets) if samples}}
+
+
+class MarketplaceMetrics:
+    """
+    Counters, histograms and gauges of a Marketplace.
+
+    Every thread updates its own counters and histograms, so recording never
+    takes a lock; snapshot() merges them. Gauges are functions evaluated at
+    snapshot time, which keeps them off the hot path entirely.
+    """
+    def __init__(self):
+        self.local = local()
+        self.shards = [] # ((counters, histograms) of every thread that recorded something)
+        self.shards_lock = Lock()
+        self.gauges = {} # (name, function returning the gauge's current value)
+        self.started = time.monotonic()
+        self.dump_stop = None
+
+    def _shard(self):
+        """
+        The calling thread's (counters, histograms).
+        """
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = ({}, {})
+            with self.shards_lock:
+                self.shards.append(shard)
+            return shard
+
+    def count(self, name, amount=1):
+        """
+        Adds amount to a counter.
+        """
+        counters = self._shard()[0]
+        counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """
+        Adds a duration to a histogram.
+        """
+        histograms = self._shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def register_gauge(self, name, function):
+        """
+        Adds a gauge whose value is function() at snapshot time.
+        """
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """
+        Every metric, merged over all threads, as a JSON friendly dict.
+        """
+        counters = {}
+        histograms = {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for thread_counters, thread_histograms in shards:
+            for name, value in list(thread_counters.items()):
+                counters[name] = counters.get(name, 0) + value
+            for name, histogram in list(thread_histograms.items()):
+                histograms.setdefault(name, Histogram()).merge(histogram)
+        return {"uptime_sec": time.monotonic() - self.started,
+                "counters": counters,
+                "histograms": {name: histogram.snapshot()
+                               for name, histogram in histograms.items()},
+                "gauges": {name: function() for name, function in self.gauges.items()}}
+
+    def start_dump(self, interval, stream=None):
+        """
+        Writes a JSON snapshot line to stream (stderr by default) every
+        interval seconds until stop_dump() is called.
+        """
+        self.dump_stop = Event()
+
+        def dump(stop):
+            while not stop.wait(interval):
+                print(json.dumps(self.snapshot()), file=stream or sys.stderr, flush=True)
+
+        Thread(target=dump, args=(self.dump_stop,), name='metrics-dump', daemon=True).start()
+
+    def stop_dump(self):
+        """
+        Stops the periodic dump.
+        """
+        if self.dump_stop is not None:
+            self.dump_stop.set()
+            self.dump_stop = None
+
+
+class InstrumentedLock:
+    """
+    Lock that records how long it was waited for and how long it was held in
+    the lock_wait / lock_hold histograms of a MarketplaceMetrics.
+    """
+    def __init__(self, metrics):
+        self._lock = Lock()
+        self.metrics = metrics
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Same as Lock.acquire.
+        """
+        if self._lock.acquire(False):
+            self.metrics.observe('lock_wait', 0.0)
+        elif not blocking:
+            return False
+        else:
+            start = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            self.metrics.observe('lock_wait', time.perf_counter() - start)
+        self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        """
+        Same as Lock.release.
+        """
+        self.metrics.observe('lock_hold', time.perf_counter() - self.acquired_at)
+        self._lock.release()
+
+    def _is_owned(self):
+        # what Condition assumes for locks without ownership tracking
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Class that represents the metrics test class.
+    """
+    def test_counters_merge_threads(self):
+        """
+        Counts recorded from several threads should all end up in the snapshot.
+        """
+        metrics = MarketplaceMetrics()
+        threads = [Thread(target=lambda: [metrics.count('add_hits') for _ in range(1000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.count('add_hits', 5)
+        self.assertEqual(metrics.snapshot()["counters"], {"add_hits": 4005})
+
+    def test_histogram(self):
+        """
+        Percentiles should come from the right power of two bucket.
+        """
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.observe(0.000003)
+        histogram.observe(0.001)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 100)
+        self.assertEqual(snapshot["p50_us"], 4)
+        self.assertAlmostEqual(snapshot["max_us"], 1000)
+
+    def test_instrumented_lock(self):
+        """
+        Every acquisition should record a wait and every release a hold time.
+        """
+        metrics = MarketplaceMetrics()
+        lock = InstrumentedLock(metrics)
+        with lock:
+            self.assertFalse(lock.acquire(False))
+        histograms = metrics.snapshot()["histograms"]
+        self.assertEqual(histograms["lock_wait"]["count"], 1)
+        self.assertEqual(histograms["lock_hold"]["count"], 1)
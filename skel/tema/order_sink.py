@@ -0,0 +1,132 @@
+"""Threading/queue/sys modules"""
+from queue import SimpleQueue
+from threading import Lock, Thread
+import io
+import sys
+import unittest
+
+
+def format_order(buyer, products):
+    """
+    The output lines of an order, one "<buyer> bought <product>" per unit.
+    """
+    return ''.join("{} bought {}\n".format(buyer, product) for product in products)
+
+
+class OrderSink:
+    """
+    Where placed orders are written. Every order goes out as one block of
+    whole lines, so orders of different consumers never interleave mid-line.
+    """
+    def emit(self, buyer, products):
+        """
+        Writes the order of buyer.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Writes out anything still buffered.
+        """
+
+
+class StreamOrderSink(OrderSink):
+    """
+    Writes every order with a single write call on a text stream (sys.stdout,
+    looked up at write time, by default).
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = Lock()
+
+    def emit(self, buyer, products):
+        text = format_order(buyer, products)
+        if not text:
+            return
+        with self.lock:
+            (self.stream or sys.stdout).write(text)
+
+    def close(self):
+        with self.lock:
+            (self.stream or sys.stdout).flush()
+
+
+class FileOrderSink(StreamOrderSink):
+    """
+    Writes the orders to a file.
+    """
+    def __init__(self, path):
+        StreamOrderSink.__init__(self, open(path, 'w'))
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+
+
+class CollectorOrderSink(OrderSink):
+    """
+    Keeps the order lines in memory, for tests and benchmarks.
+    """
+    def __init__(self):
+        self.lines = []
+
+    def emit(self, buyer, products):
+        # list.extend is atomic, no lock needed
+        self.lines.extend(["{} bought {}".format(buyer, product) for product in products])
+
+
+class QueuedOrderSink(OrderSink):
+    """
+    Hands the orders to a single writer thread that formats them and passes
+    them on to another sink, so consumers never wait for the output.
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.queue = SimpleQueue()
+        self.writer = Thread(target=self._drain, name='order-writer', daemon=True)
+        self.writer.start()
+
+    def _drain(self):
+        """
+        Writer thread: forwards queued orders until it gets None.
+        """
+        while True:
+            order = self.queue.get()
+            if order is None:
+                break
+            self.sink.emit(*order)
+
+    def emit(self, buyer, products):
+        self.queue.put((buyer, products))
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        self.sink.close()
+
+
+class TestOrderSink(unittest.TestCase):
+    """
+    Class that represents the order sinks test class.
+    """
+    def test_stream_sink_writes_whole_orders(self):
+        """
+        An order should reach the stream as one write of complete lines.
+        """
+        stream = io.StringIO()
+        sink = StreamOrderSink(stream)
+        sink.emit("cons1", ["tea", "coffee"])
+        sink.emit("cons2", [])
+        self.assertEqual(stream.getvalue(), "cons1 bought tea\ncons1 bought coffee\n")
+
+    def test_queued_sink_forwards_everything(self):
+        """
+        Closing a queued sink should write out every order emitted before.
+        """
+        collector = CollectorOrderSink()
+        sink = QueuedOrderSink(collector)
+        for i in range(100):
+            sink.emit("cons%d" % i, ["tea"])
+        sink.close()
+        self.assertEqual(len(collector.lines), 100)
+        self.assertEqual(collector.lines[-1], "cons99 bought tea")
@@ -1,26 +1,60 @@
-"""Thread/time modules"""
-import time
+"""Thread modules"""
 from threading import Thread
 
+from tema.clock import REAL_CLOCK
+
 class Producer(Thread):
     """
     Class that represents the Producer in the MPMC program.
+
+    With blocking=True the producer waits on the marketplace for a free slot
+    instead of sleeping republish_wait_time between failed publishes. With
+    batch=True it publishes as many units of a product as fit in one call.
+    Its sleeps go through clock, which can be a VirtualClock.
+
+    publishing and rejections tell a Watchdog how the producer is doing.
     """
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, blocking=False, batch=False,
+                 clock=REAL_CLOCK, **kwargs):
         Thread.__init__(self, **kwargs)
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.blocking = blocking
+        self.batch = batch
+        self.clock = clock
+        self.publishing = None # product the marketplace keeps rejecting
+        self.rejections = 0 # rejected publishes of publishing in a row
+        self.clock.register(self)
         self.this_producer_id = self.marketplace.register_producer()
 
     def run(self):
+        self.clock.enter()
         while True:
             for tuple in self.products: # tuple = (product, nr_product, wait_time)
-                for i in range(0, tuple[1]):
-                    if self.marketplace.publish(str(self.this_producer_id), tuple[0]):
-                        # marketplace is available
-                        time.sleep(tuple[2])
-                    else:
-                        # marketplace is not available, stay on the same loop iteration
-                        time.sleep(self.republish_wait_time)
-                        i -= 1
+                self.publish(tuple[0], tuple[1], tuple[2])
+
+    def publish(self, product, quantity, wait_time):
+        """
+        Publishes quantity units of product, waiting wait_time for every unit
+        the marketplace took and retrying the rest until it takes them.
+        """
+        timeout = self.republish_wait_time if self.blocking else 0
+        while quantity > 0:
+            if self.batch:
+                published = self.marketplace.publish_many(str(self.this_producer_id), product,
+                                                          quantity, timeout=timeout)
+            else:
+                published = int(self.marketplace.publish(str(self.this_producer_id), product,
+                                                         timeout=timeout))
+            quantity -= published
+            if published:
+                self.publishing = None
+                self.rejections = 0
+                self.clock.sleep(wait_time * published)
+                continue
+            self.publishing = product
+            self.rejections += 1
+            if not self.blocking:
+                # marketplace is not available, try the same product again later
+                self.clock.sleep(self.republish_wait_time)
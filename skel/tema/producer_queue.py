@@ -0,0 +1,132 @@
+"""Thread/collections/unittest modules"""
+from collections import deque
+from itertools import repeat
+from threading import Lock, Thread
+import unittest
+
+
+class ProducerQueue:
+    """
+    Bounded queue accounting of one producer: a deque holding one token per
+    free slot. Taking a slot pops a token and freeing one pushes it back, both
+    single atomic deque operations, so publishers and consumers don't need the
+    producer's lock to enforce the capacity.
+
+    A unit removed from a cart goes back to its producer even if the queue
+    filled up in the meantime; restock() records the slots it couldn't get as
+    debt, paid back from the next freed slots. Only that rare path takes the
+    queue's own lock.
+
+    waiting counts the publishers blocked on the producer's Condition; whoever
+    frees slots only takes the producer lock to notify them when it isn't 0.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.free = deque(repeat(None, capacity)) # one token per free slot
+        self.debt = 0 # units restocked over capacity
+        self.waiting = 0 # publishers blocked on the producer's Condition
+        self.lock = Lock() # guards debt
+
+    def reserve(self, wanted=1):
+        """
+        Takes up to wanted slots and returns how many it took, or None if the
+        queue is full.
+        """
+        if self.debt:
+            self._settle()
+        taken = 0
+        try:
+            while taken < wanted:
+                self.free.pop()
+                taken += 1
+        except IndexError:
+            pass
+        return taken or None
+
+    def release(self, count=1):
+        """
+        Frees count slots.
+        """
+        self.free.extend(repeat(None, count))
+
+    def restock(self, count=1):
+        """
+        Takes count slots for units coming back from a cart, going over the
+        capacity if the queue is full.
+        """
+        with self.lock:
+            try:
+                while count:
+                    self.free.pop()
+                    count -= 1
+            except IndexError:
+                self.debt += count
+
+    def _settle(self):
+        """
+        Pays the debt back from the free slots.
+        """
+        with self.lock:
+            try:
+                while self.debt:
+                    self.free.pop()
+                    self.debt -= 1
+            except IndexError:
+                pass
+
+    def __len__(self):
+        """
+        Number of the producer's units on the market.
+        """
+        return self.capacity - len(self.free) + self.debt
+
+
+class TestProducerQueue(unittest.TestCase):
+    """
+    Class that represents the producer queue test class.
+    """
+    def test_capacity(self):
+        """
+        Only capacity slots should be handed out until some are released.
+        """
+        queue = ProducerQueue(3)
+        self.assertEqual(queue.reserve(2), 2)
+        self.assertEqual(queue.reserve(5), 1)
+        self.assertIsNone(queue.reserve())
+        queue.release()
+        self.assertEqual(queue.reserve(), 1)
+        self.assertEqual(len(queue), 3)
+
+    def test_restock_over_capacity(self):
+        """
+        Restocked units may overflow the queue, and the overflow should be
+        paid back before new slots are handed out.
+        """
+        queue = ProducerQueue(2)
+        queue.reserve(2)
+        queue.restock()
+        self.assertEqual(len(queue), 3)
+        queue.release()
+        self.assertIsNone(queue.reserve())
+        queue.release()
+        self.assertEqual(queue.reserve(), 1)
+        self.assertEqual(len(queue), 2)
+
+    def test_concurrent_reserve(self):
+        """
+        Threads racing for slots should never get more than the capacity.
+        """
+        queue = ProducerQueue(1000)
+        taken = []
+
+        def reserve():
+            for _ in range(500):
+                taken.append(queue.reserve() or 0)
+
+        threads = [Thread(target=reserve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(taken), 1000)
+        self.assertEqual(len(queue), 1000)
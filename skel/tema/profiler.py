@@ -0,0 +1,167 @@
+"""Thread/sys/unittest modules"""
+from collections import Counter
+from io import StringIO
+from threading import Event, Thread, current_thread, enumerate as threads
+import os
+import sys
+import time
+import unittest
+
+
+class SamplingProfiler(Thread):
+    """
+    Wall-clock sampling profiler of every thread of the process (cProfile only
+    sees the thread that enables it). Every interval seconds it takes the
+    stack of each other thread from sys._current_frames() and counts it, under
+    a root frame named after the thread's class (Producer, Consumer, ...), so
+    time spent sleeping or waiting for a lock shows up too. The sampler only
+    runs once it gets the GIL, so a busy thread tends to be caught where it
+    releases it (sleeps, lock waits, I/O) rather than in pure Python code.
+
+    write_collapsed writes the counts in the collapsed stack format of
+    flamegraph.pl / speedscope, summary prints the functions of some classes
+    that most samples were in.
+    """
+    def __init__(self, interval=0.005):
+        Thread.__init__(self, name='profiler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter() # ((thread class, code objects from the outermost), samples)
+        self.samples = 0
+        self.thread_ids = set() # threads seen in the samples
+        self.labels = {} # (code object, frame label)
+        self.stop_event = Event()
+
+    def run(self):
+        own = current_thread().ident
+        while not self.stop_event.wait(self.interval):
+            kinds = {thread.ident: type(thread).__name__ for thread in threads()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(kinds.get(ident, 'Thread'),) + tuple(stack)] += 1
+                self.thread_ids.add(ident)
+            self.samples += 1
+
+    def stop(self):
+        """
+        Stops sampling and waits for the last sample to be counted.
+        """
+        self.stop_event.set()
+        self.join()
+
+    def _label(self, code):
+        """
+        A code object's name in the stacks: "qualified name (file:line)".
+        """
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = '%s (%s:%d)' % (
+                getattr(code, 'co_qualname', code.co_name), os.path.basename(code.co_filename),
+                code.co_firstlineno)
+        return label
+
+    def write_collapsed(self, output_file):
+        """
+        Writes one "root;caller;...;callee samples" line per distinct stack.
+        """
+        lines = sorted(';'.join([stack[0]] + [self._label(code) for code in stack[1:]])
+                       + ' %d' % count for stack, count in self.stacks.items())
+        output_file.write('\n'.join(lines) + '\n' if lines else '')
+
+    def totals(self, classes):
+        """
+        {"Class.method": [self samples, total samples]} of the methods defined
+        by classes (and their bases), a function being counted once per stack
+        even if it recurses.
+        """
+        names = {}
+        for cls in classes:
+            for klass in reversed(cls.__mro__):
+                for name, attribute in vars(klass).items():
+                    function = getattr(attribute, '__func__', attribute)
+                    code = getattr(function, '__code__', None)
+                    if code is not None:
+                        names[code] = '%s.%s' % (klass.__name__, name)
+        totals = {}
+        for stack, count in self.stacks.items():
+            for code in set(stack[1:]):
+                if code in names:
+                    totals.setdefault(names[code], [0, 0])[1] += count
+            if stack[-1] in names:
+                totals.setdefault(names[stack[-1]], [0, 0])[0] += count
+        return totals
+
+    def summary(self, classes, top=15, stream=None):
+        """
+        Prints the top methods of classes by total samples: the samples they
+        were running themselves and including their callees, also as shares of
+        every thread's samples.
+        """
+        stream = stream or sys.stderr
+        thread_samples = sum(self.stacks.values()) or 1
+        print('profile: %d samples of %d threads every %.1fms' % (
+            self.samples, len(self.thread_ids), self.interval * 1000), file=stream)
+        print('%8s %8s %8s %8s  %s' % ('self', 'total', 'self %', 'total %', 'method'),
+              file=stream)
+        rows = sorted(self.totals(classes).items(), key=lambda item: (-item[1][1], item[0]))
+        for name, (self_count, total) in rows[:top]:
+            print('%8d %8d %8.2f %8.2f  %s' % (self_count, total,
+                                               100.0 * self_count / thread_samples,
+                                               100.0 * total / thread_samples, name), file=stream)
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    """
+    Class that represents the sampling profiler test class.
+    """
+    class Busy:
+        """
+        Something to profile.
+        """
+        def work(self, seconds):
+            """
+            Sleeps for seconds in a nested call.
+            """
+            self.nap(seconds)
+
+        @staticmethod
+        def nap(seconds):
+            """
+            Sleeps for seconds.
+            """
+            time.sleep(seconds)
+
+    def test_profile(self):
+        """
+        A thread sleeping in a nested call should be seen in both methods,
+        under its class, but only running the inner one.
+        """
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        worker = Thread(target=self.Busy().work, args=(0.2,))
+        worker.start()
+        worker.join()
+        profiler.stop()
+        totals = profiler.totals([self.Busy])
+        self_count, total = totals['Busy.nap']
+        self.assertGreater(self_count, 0)
+        self.assertEqual(totals['Busy.work'][0], 0)
+        self.assertGreaterEqual(totals['Busy.work'][1], total)
+
+        collapsed = StringIO()
+        profiler.write_collapsed(collapsed)
+        nested = [line for line in collapsed.getvalue().splitlines() if 'Busy.nap' in line]
+        self.assertTrue(nested)
+        stack, count = nested[0].rsplit(' ', 1)
+        self.assertTrue(stack.startswith('Thread;'))
+        self.assertIn('TestSamplingProfiler.Busy.work (profiler.py:', stack)
+        self.assertGreater(int(count), 0)
+
+        summary = StringIO()
+        profiler.summary([self.Busy], stream=summary)
+        self.assertIn('Busy.nap', summary.getvalue())
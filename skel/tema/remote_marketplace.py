@@ -0,0 +1,535 @@
+"""
+This module serves a Marketplace over TCP or a Unix socket, so producers and
+consumers can run in other processes or on other hosts, and provides the
+client they use instead of the Marketplace.
+
+Protocol: every message is a frame, a FRAME header (body length, request id)
+followed by a UTF-8 JSON body. A request is [method, args, kwargs] and its
+response, tagged with the same request id, is [0, result] or
+[1, exception type, message]. Products travel as the dicts of the .in files
+("product_type" plus their fields), never pickled.
+
+Usage example (the orders are printed by the clients):
+    python3 -m tema.remote_marketplace --queue-size 8 --port 8765
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict
+from functools import lru_cache
+from itertools import count
+from json import dumps, loads
+from threading import Lock, Thread
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import struct
+import tempfile
+import unittest
+
+from tema.marketplace import CartClosedError, Marketplace
+from tema.order_sink import CollectorOrderSink, StreamOrderSink
+from tema.product import Product, Tea
+from tema.scenario import PRODUCT_TYPES
+from tema.selection import SELECTION_POLICIES
+
+FRAME = struct.Struct("<II") # body length, request id
+MAX_BODY = 1 << 24
+ERRORS = {"ValueError": ValueError, "CartClosedError": CartClosedError} # raised as they are
+METHODS = ("register_producer", "publish", "new_cart", "add_to_cart", "remove_from_cart",
+           "checkout", "lost_units")
+
+
+def encode_value(value):
+    """
+    A value with its Products (even in lists) turned into JSON friendly dicts.
+    """
+    if isinstance(value, Product):
+        return dict(asdict(value), product_type=type(value).__name__)
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    return value
+
+
+@lru_cache(maxsize=4096)
+def _product(fields):
+    """
+    The Product of the (key, value) pairs of an encoded product, shared by
+    every message naming it.
+    """
+    fields = dict(fields)
+    return PRODUCT_TYPES[fields.pop("product_type")](**fields)
+
+
+def decode_value(value):
+    """
+    Reverts encode_value.
+    """
+    if isinstance(value, dict) and "product_type" in value:
+        return _product(tuple(value.items()))
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def encode_frame(request_id, message):
+    """
+    The frame carrying a message.
+    """
+    body = dumps(message, separators=(",", ":")).encode()
+    return FRAME.pack(len(body), request_id) + body
+
+
+def parse_address(address):
+    """
+    "host:port" as a (host, port) pair; anything with a "/" is a Unix socket path.
+    """
+    if "/" in address:
+        return address
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+class _ServerProtocol(asyncio.Protocol):
+    """
+    One client connection of a MarketplaceServer. Every complete request of a
+    received chunk is answered, the answers going out in a single write.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        responses = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME.size:
+            length, request_id = FRAME.unpack_from(self.buffer, offset)
+            if length > MAX_BODY:
+                self.transport.close()
+                return
+            end = offset + FRAME.size + length
+            if len(self.buffer) < end:
+                break
+            request = loads(self.buffer[offset + FRAME.size:end])
+            offset = end
+            response = self.server.dispatch(request, request_id, self)
+            if response is not None:
+                responses.append(response)
+        del self.buffer[:offset]
+        if responses:
+            self.transport.write(b"".join(responses))
+
+    def send(self, frame):
+        """
+        Sends the answer of a request that ran on the server's executor.
+        """
+        if not self.transport.is_closing():
+            self.transport.write(frame)
+
+
+class MarketplaceServer:
+    """
+    Serves a marketplace (a Marketplace or anything with its METHODS) on an
+    asyncio event loop, at address: a (host, port) pair, port 0 picking a free
+    one, or a Unix socket path.
+
+    The calls that may wait (publish / add_to_cart with a timeout, new_cart
+    with max_open_carts) run on a pool of blocking_workers threads instead of
+    the loop, so their answers can come back after those of later requests:
+    clients match answers to requests by their id.
+    """
+    def __init__(self, marketplace, address=("127.0.0.1", 0), blocking_workers=64):
+        self.marketplace = marketplace
+        self.address = address
+        self.executor = ThreadPoolExecutor(blocking_workers, thread_name_prefix="blocking-call")
+        self.server = None
+        self.loop = None
+
+    async def start(self):
+        """
+        Starts listening and returns the address listened on.
+        """
+        self.loop = asyncio.get_running_loop()
+        if isinstance(self.address, str):
+            self.server = await self.loop.create_unix_server(lambda: _ServerProtocol(self),
+                                                             self.address)
+            return self.address
+        self.server = await self.loop.create_server(lambda: _ServerProtocol(self),
+                                                    *self.address)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self, ready=None):
+        """
+        Serves until cancelled, calling ready(address) once listening.
+        """
+        address = await self.start()
+        if ready is not None:
+            ready(address)
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_thread(self):
+        """
+        Serves from a daemon thread running its own event loop and returns the
+        address, for clients in the same process (tests, benchmarks).
+        """
+        listening = Future()
+        Thread(target=asyncio.run, args=(self.serve_forever(listening.set_result),),
+               name="marketplace-server", daemon=True).start()
+        return listening.result()
+
+    def _blocks(self, method, kwargs):
+        """
+        Whether a call may wait inside the marketplace.
+        """
+        if method == "new_cart":
+            return getattr(self.marketplace, "max_open_carts", None) is not None \
+                and kwargs.get("timeout") != 0
+        return kwargs.get("timeout", 0) != 0
+
+    def call(self, method, args, kwargs):
+        """
+        Runs a request and returns its response message, an error one for
+        whatever it raised so the client waiting for it always gets an answer.
+        """
+        try:
+            if method not in METHODS:
+                raise ValueError("Unknown method %s" % method)
+            result = getattr(self.marketplace, method)(*decode_value(args), **kwargs)
+            return [0, encode_value(result)]
+        except Exception as error: # pylint: disable=broad-except
+            return [1, type(error).__name__, str(error)]
+
+    def dispatch(self, request, request_id, protocol):
+        """
+        Runs a request on the loop and returns its response frame, or hands
+        it to the executor and returns None.
+        """
+        try:
+            method, args, kwargs = request
+        except (TypeError, ValueError):
+            return encode_frame(request_id, [1, "ValueError", "Malformed request"])
+        if not self._blocks(method, kwargs):
+            return encode_frame(request_id, self.call(method, args, kwargs))
+        future = self.loop.run_in_executor(self.executor, self.call, method, args, kwargs)
+        future.add_done_callback(
+            lambda done: protocol.send(encode_frame(request_id, done.result())))
+        return None
+
+
+class _Connection:
+    """
+    One client socket. Requests from any thread are written under a lock
+    without waiting for the previous answers; a reader thread resolves the
+    Future of every answer.
+    """
+    def __init__(self, address):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(address)
+        else:
+            self.socket = socket.create_connection(address)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = Lock() # guards sending and pending
+        self.request_ids = count()
+        self.pending = {} # (request id, Future of the answer)
+        self.closed = False
+        Thread(target=self._read, name="marketplace-client", daemon=True).start()
+
+    def submit(self, message):
+        """
+        Sends a request and returns the Future of its decoded result.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection to the marketplace closed")
+            request_id = next(self.request_ids)
+            self.pending[request_id] = future
+            self.socket.sendall(encode_frame(request_id, message))
+        return future
+
+    def _read(self):
+        """
+        Resolves the answers until the connection closes, then fails the
+        requests left without one.
+        """
+        stream = self.socket.makefile("rb")
+        try:
+            while True:
+                header = stream.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    break
+                length, request_id = FRAME.unpack(header)
+                response = loads(stream.read(length))
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    # not a request of ours, or already answered
+                    continue
+                if response[0] == 0:
+                    future.set_result(decode_value(response[1]))
+                elif response[1] in ERRORS:
+                    future.set_exception(ERRORS[response[1]](response[2]))
+                else:
+                    future.set_exception(RuntimeError("%s: %s" % tuple(response[1:])))
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.closed = True
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(ConnectionError("connection to the marketplace closed"))
+
+    def close(self):
+        """
+        Closes the socket, which ends the reader thread.
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class RemoteMarketplace:
+    """
+    Client of a MarketplaceServer with the Marketplace API used by the
+    producers and consumers, so they run unchanged against a remote market.
+
+    It keeps a pool of connections, each request going on the next one in
+    turn. Connections are pipelined: the threads sharing one don't wait for
+    each other's answers, and submit() lets a single thread have many
+    requests in flight. Orders are checked out remotely and written to the
+    client's own order_sink.
+
+    Once closed, calls fail quietly (publish and add_to_cart return False)
+    for the daemon producers still running.
+    """
+    def __init__(self, address, connections=4, order_sink=None):
+        self.connections = [_Connection(address) for _ in range(connections)]
+        self.turn = count()
+        self.order_sink = order_sink or StreamOrderSink()
+        self.closed = False
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Sends a request without waiting for it: returns the Future of its result.
+        """
+        connection = self.connections[next(self.turn) % len(self.connections)]
+        return connection.submit([method, encode_value(args), kwargs])
+
+    def call(self, method, *args, **kwargs):
+        """
+        Runs a request and returns its result, or False if the client was
+        closed meanwhile.
+        """
+        try:
+            return self.submit(method, *args, **kwargs).result()
+        except ConnectionError:
+            if self.closed:
+                return False
+            raise
+
+    def register_producer(self):
+        """
+        Register a producer in the database with its own id.
+        """
+        return self.call("register_producer")
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Marketplace.publish, run by the server.
+        """
+        return self.call("publish", producer_id, product, timeout=timeout)
+
+    def new_cart(self, timeout=None):
+        """
+        Marketplace.new_cart, run by the server.
+        """
+        return self.call("new_cart", timeout=timeout)
+
+    def add_to_cart(self, cart_id, product, timeout=0):
+        """
+        Marketplace.add_to_cart, run by the server.
+        """
+        return self.call("add_to_cart", cart_id, product, timeout=timeout)
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Marketplace.remove_from_cart, run by the server.
+        """
+        return self.call("remove_from_cart", cart_id, product)
+
+    def checkout(self, cart_id):
+        """
+        Marketplace.checkout, run by the server.
+        """
+        return self.call("checkout", cart_id)
+
+    def lost_units(self, cart_id):
+        """
+        Marketplace.lost_units, run by the server.
+        """
+        return self.call("lost_units", cart_id)
+
+    # checks out the cart remotely, writes the order here
+    place_order = Marketplace.place_order
+
+    def close(self):
+        """
+        Closes every connection.
+        """
+        self.closed = True
+        for connection in self.connections:
+            connection.close()
+
+
+def parse_args():
+    """
+    Parses the server's command line.
+    """
+    parser = argparse.ArgumentParser(description="serve a marketplace over the network")
+    parser.add_argument("--queue-size", type=int, required=True,
+                        help="queue_size_per_producer of the marketplace")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="TCP port (default: a free one)")
+    parser.add_argument("--unix", metavar="PATH", help="listen on this Unix socket instead")
+    parser.add_argument("--concurrency", choices=["global", "striped"], default="global")
+    parser.add_argument("--selection", choices=list(SELECTION_POLICIES), default="first_fit")
+    parser.add_argument("--max-open-carts", type=int, metavar="N")
+    parser.add_argument("--cart-ttl", type=float, metavar="SECS")
+    parser.add_argument("--hold-ttl", type=float, metavar="SECS")
+    parser.add_argument("--log-file", default="marketplace.log")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        default="INFO")
+    return parser.parse_args()
+
+
+def main():
+    """
+    Serves a marketplace until interrupted, printing the address it listens
+    on as its first line of output.
+    """
+    args = parse_args()
+    marketplace = Marketplace(args.queue_size, concurrency=args.concurrency,
+                              log_file=args.log_file, log_level=getattr(logging, args.log_level),
+                              selection=args.selection, max_open_carts=args.max_open_carts,
+                              cart_ttl=args.cart_ttl, hold_ttl=args.hold_ttl)
+
+    def ready(address):
+        print(address if isinstance(address, str) else "%s:%d" % address, flush=True)
+
+    server = MarketplaceServer(marketplace, args.unix or (args.host, args.port))
+    try:
+        asyncio.run(server.serve_forever(ready))
+    except KeyboardInterrupt:
+        pass
+
+
+class TestRemoteMarketplace(unittest.TestCase):
+    """
+    Class that represents the RemoteMarketplace test class.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.marketplace = Marketplace(3, log_file=os.path.join(self.log_dir.name, "log"))
+        address = MarketplaceServer(self.marketplace).start_thread()
+        self.client = RemoteMarketplace(address, connections=2, order_sink=CollectorOrderSink())
+
+    def tearDown(self):
+        self.client.close()
+        self.log_dir.cleanup()
+
+    def test_order(self):
+        """
+        Products should make the round trip and the order be written by the client.
+        """
+        producer_id = self.client.register_producer()
+        tea = Tea("Linden", 9, "Herbal")
+        self.assertTrue(self.client.publish(str(producer_id), tea))
+        self.assertTrue(self.client.publish(str(producer_id), "coffee"))
+        cart_id = self.client.new_cart()
+        self.assertTrue(self.client.add_to_cart(str(cart_id), tea))
+        self.assertTrue(self.client.add_to_cart(str(cart_id), "coffee"))
+        self.client.remove_from_cart(str(cart_id), "coffee")
+        self.assertEqual(self.client.lost_units(str(cart_id)), [])
+        self.assertEqual(self.client.place_order(str(cart_id), buyer="cons1"), [tea])
+        self.assertEqual(self.client.order_sink.lines, ["cons1 bought " + str(tea)])
+        self.assertEqual(self.marketplace.available("coffee"), {producer_id: 1})
+
+    def test_errors(self):
+        """
+        ValueErrors and closed carts should be raised by the client, unknown
+        methods refused.
+        """
+        self.assertRaises(CartClosedError, self.client.checkout, 42)
+        self.assertRaises(ValueError, self.client.call, "queue_depths")
+
+    def test_server_error(self):
+        """
+        Any error of the marketplace should be answered, on the loop or not.
+        """
+        class Broken(Marketplace):
+            """
+            A marketplace whose checkout and blocking adds fail.
+            """
+            def checkout(self, cart_id):
+                """
+                Fails on the loop.
+                """
+                raise RuntimeError("checkout failed")
+
+            def add_to_cart(self, cart_id, product, timeout=0):
+                """
+                Fails on the executor when given a timeout.
+                """
+                raise RuntimeError("add failed")
+
+        broken = Broken(3, log_file=os.path.join(self.log_dir.name, "log"))
+        address = MarketplaceServer(broken).start_thread()
+        client = RemoteMarketplace(address, connections=1)
+        try:
+            self.assertRaises(RuntimeError, client.submit("checkout", 0).result, 5)
+            self.assertRaises(RuntimeError,
+                              client.submit("add_to_cart", 0, "tea", timeout=5).result, 5)
+            self.assertEqual(client.call("new_cart"), 0)
+        finally:
+            client.close()
+
+    def test_pipelining(self):
+        """
+        Requests in flight together should each get their own answer.
+        """
+        producer_id = self.client.register_producer()
+        futures = [self.client.submit("publish", producer_id, "tea%d" % i) for i in range(10)]
+        self.assertEqual(sorted(future.result() for future in futures), [False] * 7 + [True] * 3)
+
+    def test_waiting(self):
+        """
+        An add waiting for stock shouldn't keep the server from publishing it.
+        """
+        producer_id = self.client.register_producer()
+        cart_id = self.client.new_cart()
+        added = self.client.submit("add_to_cart", cart_id, "tea", timeout=5)
+        self.assertTrue(self.client.publish(producer_id, "tea"))
+        self.assertTrue(added.result(5))
+
+    def test_closed(self):
+        """
+        Calls on a closed client should fail quietly.
+        """
+        producer_id = self.client.register_producer()
+        self.client.close()
+        self.assertIs(self.client.publish(producer_id, "tea"), False)
+        self.assertIs(self.client.add_to_cart(0, "tea"), False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+This module turns market configurations (the tests' .in files) into the
+objects test.py and the benchmarks run: product ids become Products.
+
+It also reads and writes the line-delimited variant of the .in format
+(.ndjson), one JSON record per line:
+    {"marketplace": {"queue_size_per_producer": 40}}
+    {"product": "id1", "definition": {"product_type": "Tea", ...}}
+    {"producer": {"name": "prod1", "products": [...], "republish_wait_time": 0.1}}
+    {"consumer": {"name": "cons1", "retry_wait_time": 0.2}}
+    {"consumer": "cons1", "cart": [{"type": "add", "product": "id1", "quantity": 2}]}
+Products and producers come first, every consumer before its carts. The
+carts of the consumers are interleaved, so all consumers can start early.
+"""
+from io import StringIO
+from itertools import chain, zip_longest
+from json import dumps, loads
+from queue import Queue
+import unittest
+
+from tema.product import Coffee, Tea
+
+PRODUCT_TYPES = {"Coffee": Coffee, "Tea": Tea}
+
+
+def build_products(product_defs):
+    """
+    Turns the "products" section of a configuration into {product id: Product}.
+    """
+    products = {}
+    for k, products_dict in product_defs.items():
+        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
+        products[k] = PRODUCT_TYPES[products_dict['product_type']](**params)
+    return products
+
+
+def resolve_config(market_config):
+    """
+    Replaces the product ids in the producers and the consumers' carts with the
+    products themselves, in place, and drops the "products" section.
+    """
+    products = build_products(market_config['products'])
+    del market_config['products']
+
+    # turn product ids into products in producers
+    for producer in market_config['producers']:
+        producer['products'] = [(products[i], quantity, sleep_time)
+                                for i, quantity, sleep_time
+                                in producer['products']]
+
+    # turn product ids into products in consumer order lists
+    for consumer in market_config['consumers']:
+        for cart in consumer['carts']:
+            for operation in cart:
+                operation['product'] = products[operation['product']]
+
+    return market_config
+
+
+STREAM_SUFFIX = ".ndjson"
+
+
+def write_stream(market_config, output_file):
+    """
+    Writes a configuration in the shape of the .in files as .ndjson records,
+    the consumers' carts interleaved.
+    """
+    print(dumps({"marketplace": market_config['marketplace']}), file=output_file)
+    for product_id, definition in market_config['products'].items():
+        print(dumps({"product": product_id, "definition": definition}), file=output_file)
+    for producer in market_config['producers']:
+        print(dumps({"producer": producer}), file=output_file)
+    for consumer in market_config['consumers']:
+        header = {key: value for key, value in consumer.items() if key != 'carts'}
+        print(dumps({"consumer": header}), file=output_file)
+    names = [consumer['name'] for consumer in market_config['consumers']]
+    for carts in zip_longest(*(consumer['carts'] for consumer in market_config['consumers'])):
+        for name, cart in zip(names, carts):
+            if cart is not None:
+                print(dumps({"consumer": name, "cart": cart}), file=output_file)
+
+
+def _records(input_file):
+    """
+    The records of an .ndjson file, one per non-empty line.
+    """
+    return (loads(line) for line in input_file if line.strip())
+
+
+def read_stream(input_file):
+    """
+    Reads a whole .ndjson file into a configuration shaped like the .in files.
+    """
+    market_config = {"products": {}, "producers": [], "consumers": []}
+    consumers = {}
+    for record in _records(input_file):
+        if "marketplace" in record:
+            market_config['marketplace'] = record['marketplace']
+        elif "product" in record:
+            market_config['products'][record['product']] = record['definition']
+        elif "producer" in record:
+            market_config['producers'].append(record['producer'])
+        elif "cart" in record:
+            consumers[record['consumer']]['carts'].append(record['cart'])
+        else:
+            consumer = consumers[record['consumer']['name']] = dict(record['consumer'], carts=[])
+            market_config['consumers'].append(consumer)
+    return market_config
+
+
+def stream_config(input_file, backlog=16):
+    """
+    Reads an .ndjson file lazily. The marketplace, products and producers are
+    read right away and resolved like resolve_config does; "consumers" is a
+    generator handing out every consumer as soon as its record is read, with
+    "carts" being a generator over a queue of at most backlog carts that the
+    rest of the file fills while iterating "consumers" to the end.
+    """
+    market_config = {"producers": []}
+    products = {}
+    records = _records(input_file)
+    for record in records:
+        if "marketplace" in record:
+            market_config['marketplace'] = record['marketplace']
+        elif "product" in record:
+            products.update(build_products({record['product']: record['definition']}))
+        elif "producer" in record:
+            producer = record['producer']
+            producer['products'] = [(products[i], quantity, sleep_time)
+                                    for i, quantity, sleep_time in producer['products']]
+            market_config['producers'].append(producer)
+        else:
+            records = chain([record], records)
+            break
+    market_config['consumers'] = _stream_consumers(records, products, backlog)
+    return market_config
+
+
+def _stream_consumers(records, products, backlog):
+    """
+    Yields the consumers of the remaining records and feeds their carts.
+    """
+    queues = {} # (consumer name, Queue of its carts not taken yet, None ending it)
+    for record in records:
+        if "cart" in record:
+            for operation in record['cart']:
+                operation['product'] = products[operation['product']]
+            queues[record['consumer']].put(record['cart'])
+        else:
+            queue = queues[record['consumer']['name']] = Queue(backlog)
+            yield dict(record['consumer'], carts=_drain(queue))
+    for queue in queues.values():
+        queue.put(None)
+
+
+def _drain(queue):
+    """
+    The carts put in queue, until None.
+    """
+    cart = queue.get()
+    while cart is not None:
+        yield cart
+        cart = queue.get()
+
+
+class TestScenarioStream(unittest.TestCase):
+    """
+    Class that represents the .ndjson scenario format test class.
+    """
+    CONFIG = {"marketplace": {"queue_size_per_producer": 2},
+              "products": {"id1": {"product_type": "Tea", "name": "Linden", "type": "Herbal",
+                                   "price": 9}},
+              "producers": [{"name": "prod1", "products": [["id1", 2, 0.1]],
+                             "republish_wait_time": 0.2}],
+              "consumers": [{"name": "cons1", "retry_wait_time": 0.1,
+                             "carts": [[{"type": "add", "product": "id1", "quantity": 1}]] * 3},
+                            {"name": "cons2", "retry_wait_time": 0.1, "carts": []}]}
+
+    def _stream(self):
+        output_file = StringIO()
+        write_stream(self.CONFIG, output_file)
+        output_file.seek(0)
+        return output_file
+
+    def test_round_trip(self):
+        """
+        Reading a written stream should give the configuration back.
+        """
+        self.assertEqual(read_stream(self._stream()), self.CONFIG)
+
+    def test_lazy_carts(self):
+        """
+        Consumers should come out before their carts are read, with the carts
+        resolved to Products.
+        """
+        market_config = stream_config(self._stream(), backlog=5)
+        self.assertEqual(market_config['producers'][0]['products'][0][0].name, "Linden")
+        consumers = market_config['consumers']
+        first = next(consumers)
+        self.assertEqual(first['name'], "cons1")
+        second = next(consumers)
+        self.assertRaises(StopIteration, next, consumers)
+        carts = list(first['carts'])
+        self.assertEqual(len(carts), 3)
+        self.assertEqual(carts[0][0]['product'].name, "Linden")
+        self.assertEqual(list(second['carts']), [])
@@ -0,0 +1,108 @@
+"""
+This module offers the policies choosing which producer a unit added to a
+cart is taken from.
+
+A policy is called as policy(marketplace, units) with the product lock held,
+units being the non-empty {producer_id: units available} dict of the product,
+and returns one of its producer ids. Taking a unit frees a slot in that
+producer's queue, so the policy decides which producers get to publish again.
+"""
+import random
+import unittest
+
+from tema.producer_queue import ProducerQueue
+
+
+def first_fit(marketplace, units):
+    """
+    The producer registered first among those having the product, like the
+    original scan of the producers in id order.
+    """
+    return min(units)
+
+
+def fullest(marketplace, units):
+    """
+    The producer with the most units on the market, the closest to having
+    its publishes rejected.
+    """
+    producers = marketplace.producers
+    return max(units, key=lambda producer_id: len(producers[producer_id]))
+
+
+def round_robin(marketplace, units):
+    """
+    Takes turns between the producers of the product: the chosen one moves to
+    the back of the dict.
+    """
+    producer_id = next(iter(units))
+    units[producer_id] = units.pop(producer_id)
+    return producer_id
+
+
+def random_producer(marketplace, units):
+    """
+    Any producer of the product.
+    """
+    return random.choice(list(units))
+
+
+SELECTION_POLICIES = {"first_fit": first_fit, "fullest": fullest, "round_robin": round_robin,
+                      "random": random_producer}
+
+
+def get_policy(policy):
+    """
+    The policy function for a name of SELECTION_POLICIES, or policy itself if
+    it already is a function.
+    """
+    if callable(policy):
+        return policy
+    try:
+        return SELECTION_POLICIES[policy]
+    except KeyError:
+        raise ValueError('Unknown selection policy %s' % policy) from None
+
+
+class TestSelection(unittest.TestCase):
+    """
+    Class that represents the selection policies test class.
+    """
+    class _Market:
+        """
+        Just the producer queues of a marketplace.
+        """
+        def __init__(self, depths):
+            self.producers = {}
+            for producer_id, depth in depths.items():
+                self.producers[producer_id] = ProducerQueue(10)
+                self.producers[producer_id].reserve(depth)
+
+    def test_first_fit(self):
+        """
+        The producer with the lowest id should be chosen, whatever the order
+        the units were stocked in.
+        """
+        self.assertEqual(first_fit(None, {3: 1, 1: 5}), 1)
+
+    def test_fullest(self):
+        """
+        The producer with the fullest queue should be chosen.
+        """
+        market = self._Market({0: 2, 1: 7, 2: 4})
+        self.assertEqual(fullest(market, {0: 2, 1: 1, 2: 4}), 1)
+
+    def test_round_robin(self):
+        """
+        Producers should be chosen in turns.
+        """
+        units = {0: 2, 1: 2}
+        self.assertEqual([round_robin(None, units) for _ in range(3)], [0, 1, 0])
+
+    def test_get_policy(self):
+        """
+        Policies should be found by name and unknown names rejected.
+        """
+        self.assertIs(get_policy("fullest"), fullest)
+        self.assertIs(get_policy(first_fit), first_fit)
+        self.assertRaises(ValueError, get_policy, "cheapest")
@@ -0,0 +1,353 @@
+"""Multiprocessing/threading/time/unittest modules"""
+from multiprocessing import Pipe, Process, parent_process
+from threading import Condition, Lock, current_thread
+from time import monotonic, sleep
+import os
+import tempfile
+import unittest
+
+from tema.marketplace import Marketplace
+from tema.logging_pipeline import close_marketplace_logger, get_marketplace_logger
+from tema.order_sink import CollectorOrderSink, StreamOrderSink
+
+
+class _Shard:
+    """
+    One shard of a ShardedMarketplace: a whole Marketplace owning a subset of
+    the producers, living in its own process. It is addressed with the
+    router's global producer and cart ids and maps them to its own.
+    """
+    def __init__(self, queue_size_per_producer, log_file, selection):
+        self.marketplace = Marketplace(queue_size_per_producer, log_file=log_file,
+                                       selection=selection)
+        self.producers = {} # (global producer_id, shard producer_id)
+        self.carts = {} # (global cart_id, shard cart_id)
+
+    def _cart(self, cart_id):
+        """
+        The shard's cart for the global cart_id, created on first use.
+        """
+        local_id = self.carts.get(cart_id)
+        if local_id is None:
+            local_id = self.carts[cart_id] = self.marketplace.new_cart()
+        return local_id
+
+    def register_producer(self, producer_id):
+        """
+        Registers the global producer_id with this shard.
+        """
+        self.producers[producer_id] = self.marketplace.register_producer()
+
+    def publish(self, producer_id, product):
+        """
+        Publishes a product of one of the shard's producers.
+        """
+        return self.marketplace.publish(self.producers[producer_id], product)
+
+    def add_to_cart(self, cart_id, product):
+        """
+        Adds a product from one of the shard's producers to a cart.
+        """
+        return self.marketplace.add_to_cart(self._cart(cart_id), product)
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes a product the cart got from this shard.
+        """
+        self.marketplace.remove_from_cart(self._cart(cart_id), product)
+
+    def checkout(self, cart_id):
+        """
+        The products the cart got from this shard, closing the shard's cart.
+        """
+        order = self.marketplace.checkout(self._cart(cart_id))
+        del self.carts[cart_id]
+        return order
+
+
+def _serve(connection, queue_size_per_producer, log_file, selection):
+    """
+    Shard process main loop: runs (method, args) requests sent by the router
+    one at a time and sends back (exception, result) replies, until it
+    receives None.
+    """
+    shard = _Shard(queue_size_per_producer, log_file, selection)
+    while True:
+        if not connection.poll(1):
+            # the router may have died without calling close()
+            if parent_process().is_alive():
+                continue
+            break
+        request = connection.recv()
+        if request is None:
+            break
+        method, args = request
+        try:
+            reply = (None, getattr(shard, method)(*args))
+        except Exception as error: # pylint: disable=broad-except
+            # the router raises it, the shard keeps serving
+            reply = (error, None)
+        connection.send(reply)
+    connection.close()
+    # shard processes skip atexit handlers, write out the queued log records here
+    close_marketplace_logger(log_file)
+
+
+class ShardedMarketplace:
+    """
+    Marketplace partitioned across worker processes to use more than one core.
+
+    Producers are spread round-robin over the shards, so each shard enforces
+    queue_size_per_producer for its own producers like a plain Marketplace.
+    Producer and cart ids are handed out here and stay globally unique. A cart
+    gets a sub-cart on every shard it took products from; place_order collects
+    all of them. add_to_cart tries the shard the product was last seen on
+    first, then the others.
+
+    Timeouts are supported by retrying every poll_interval seconds, the shards
+    themselves never block. The selection policy is handed to every shard.
+    Open carts are capped here, new_cart waiting while max_open_carts are.
+
+    Once closed, calls fail (publish and add_to_cart return False)
+    instead of reaching the stopped shards, for the daemon producers still
+    running.
+    """
+    def __init__(self, queue_size_per_producer, shards=None, poll_interval=0.001,
+                 log_file='marketplace.log', order_sink=None, selection="first_fit",
+                 max_open_carts=None):
+        self.shards = []
+        self.shard_locks = [] # one request/reply in flight per shard pipe
+        self.poll_interval = poll_interval
+        for index in range(shards or os.cpu_count()):
+            connection, child_connection = Pipe()
+            process = Process(target=_serve, daemon=True,
+                              args=(child_connection, queue_size_per_producer,
+                                    '{}.shard{}'.format(log_file, index), selection))
+            process.start()
+            self.shards.append((process, connection))
+            self.shard_locks.append(Lock())
+        self.lock = Lock()
+        self.max_open_carts = max_open_carts
+        self.cart_slots = Condition(self.lock) # notified when a cart is closed
+        self.producer_id_count = -1
+        self.carts_id_count = -1
+        self.carts = {} # (cart_id, {shard index: {product: units taken from that shard}})
+        self.stock_hints = {} # (product, shard index it was last published or found on)
+        self.order_sink = order_sink or StreamOrderSink()
+        self.log_file = log_file
+        self.logger = get_marketplace_logger(log_file)
+        self.closed = False
+
+    def _call(self, shard, method, *args):
+        """
+        Runs method on a shard and returns its result, raising what it raised.
+        Returns False once the marketplace is closed.
+        """
+        with self.shard_locks[shard]:
+            if self.closed:
+                return False
+            connection = self.shards[shard][1]
+            connection.send((method, args))
+            error, result = connection.recv()
+        if error is not None:
+            raise error
+        return result
+
+    def _retry(self, attempt, timeout):
+        """
+        Calls attempt() until it is truthy or timeout seconds passed (None
+        means forever, 0 means a single try) or the marketplace is closed.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        result = attempt()
+        while not result and not self.closed and (deadline is None or monotonic() < deadline):
+            sleep(self.poll_interval)
+            result = attempt()
+        return result
+
+    def close(self):
+        """
+        Stops the shard processes and writes out the log.
+        """
+        if self.closed:
+            return
+        for shard, (process, connection) in enumerate(self.shards):
+            with self.shard_locks[shard]:
+                self.closed = True
+                connection.send(None)
+            process.join()
+        close_marketplace_logger(self.log_file)
+
+    def register_producer(self):
+        """
+        Register a producer with its own id on the shard owning it.
+        """
+        with self.lock:
+            self.producer_id_count += 1
+            producer_id = self.producer_id_count
+        self._call(producer_id % len(self.shards), 'register_producer', producer_id)
+        return producer_id
+
+    def publish(self, producer_id, product, timeout=0):
+        """
+        Publish a producer's item on its shard if its queue isn't full.
+        """
+        producer_id = int(producer_id)
+        shard = producer_id % len(self.shards)
+        published = self._retry(lambda: self._call(shard, 'publish', producer_id, product),
+                                timeout)
+        if published:
+            self.stock_hints[product] = shard
+        return published
+
+    def new_cart(self, timeout=None):
+        """
+        Regiser a new cart with its own id, waiting up to timeout seconds (None
+        means forever) while max_open_carts are open. Returns None if no cart
+        got closed in time.
+        """
+        with self.lock:
+            if self.max_open_carts is not None and not self.cart_slots.wait_for(
+                    lambda: len(self.carts) < self.max_open_carts, timeout):
+                return None
+            self.carts_id_count += 1
+            self.carts[self.carts_id_count] = {}
+            return self.carts_id_count
+
+    def _add_once(self, cart_id, product):
+        """
+        One pass over the shards looking for product, starting with its hint.
+        """
+        first = self.stock_hints.get(product, 0)
+        for step in range(len(self.shards)):
+            shard = (first + step) % len(self.shards)
+            if self._call(shard, 'add_to_cart', cart_id, product):
+                self.stock_hints[product] = shard
+                taken = self.carts[cart_id].setdefault(shard, {})
+                taken[product] = taken.get(product, 0) + 1
+                return True
+        return False
+
+    def add_to_cart(self, cart_id, product, timeout=0):
+        """
+        Add an item to a cart from whichever shard has it.
+        """
+        cart_id = int(cart_id)
+        return self._retry(lambda: self._add_once(cart_id, product), timeout)
+
+    def remove_from_cart(self, cart_id, product):
+        """
+        Removes an item from a cart, giving it back to the shard it came from.
+        """
+        cart_id = int(cart_id)
+        for shard, taken in self.carts[cart_id].items():
+            if taken.get(product, 0) > 0:
+                taken[product] -= 1
+                self._call(shard, 'remove_from_cart', cart_id, product)
+                return
+        self.logger.error('Couldnt remove item %s from cart %s - didnt find item', product, cart_id)
+
+    def place_order(self, cart_id, buyer=None):
+        """
+        Places an order from a cart, collecting its products from every shard.
+        The cart is closed.
+        """
+        cart_id = int(cart_id)
+        if buyer is None:
+            buyer = current_thread().name
+        order = []
+        with self.lock:
+            shards = self.carts.pop(cart_id)
+            self.cart_slots.notify()
+        for shard in shards:
+            order += self._call(shard, 'checkout', cart_id) or []
+        self.order_sink.emit(buyer, order)
+        return order
+
+
+class TestShardedMarketplace(unittest.TestCase):
+    """
+    Class that represents the ShardedMarketplace test class.
+    """
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.marketplace = ShardedMarketplace(3, shards=2,
+                                              log_file=os.path.join(self.log_dir.name, 'log'))
+
+    def tearDown(self):
+        self.marketplace.close()
+        self.log_dir.cleanup()
+
+    def test_ids_are_global(self):
+        """
+        Producer and cart ids should keep counting across shards.
+        """
+        self.assertEqual([self.marketplace.register_producer() for _ in range(3)], [0, 1, 2])
+        self.assertEqual([self.marketplace.new_cart() for _ in range(2)], [0, 1])
+
+    def test_max_open_carts(self):
+        """
+        new_cart should wait for a cart to be ordered while max_open_carts are open.
+        """
+        self.marketplace.max_open_carts = 1
+        self.marketplace.order_sink = CollectorOrderSink()
+        cart_id = self.marketplace.new_cart()
+        self.assertIsNone(self.marketplace.new_cart(timeout=0))
+        self.assertIsNone(self.marketplace.new_cart(timeout=0.05))
+        self.marketplace.place_order(cart_id, buyer="cons1")
+        self.assertEqual(self.marketplace.new_cart(timeout=0), cart_id + 1)
+
+    def test_queue_size_per_producer(self):
+        """
+        Every producer keeps its own queue size on its shard.
+        """
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        for producer_id in (first, second):
+            for _ in range(3):
+                self.assertTrue(self.marketplace.publish(producer_id, "tea"))
+            self.assertFalse(self.marketplace.publish(producer_id, "tea"))
+
+    def test_cart_spanning_shards(self):
+        """
+        A cart holding products of both shards should order all of them.
+        """
+        first = self.marketplace.register_producer()
+        second = self.marketplace.register_producer()
+        self.marketplace.publish(first, "tea")
+        self.marketplace.publish(second, "coffee")
+        self.marketplace.publish(second, "tea")
+        cart_id = self.marketplace.new_cart()
+        for product in ("tea", "coffee", "tea"):
+            self.assertTrue(self.marketplace.add_to_cart(cart_id, product))
+        self.assertFalse(self.marketplace.add_to_cart(cart_id, "tea"))
+        self.marketplace.remove_from_cart(cart_id, "coffee")
+        self.assertEqual(sorted(self.marketplace.place_order(cart_id)), ["tea", "tea"])
+
+    def test_shard_error(self):
+        """
+        An error in a shard should be raised by the router, the shard going on.
+        """
+        self.assertRaises(KeyError, self.marketplace.publish, 1, "tea")
+        self.marketplace.register_producer()
+        self.assertTrue(self.marketplace.publish(self.marketplace.register_producer(), "tea"))
+
+    def test_remove_missing(self):
+        """
+        Removing a product that isn't in the cart should be logged as an error.
+        """
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.remove_from_cart(cart_id, "tea")
+        self.marketplace.close()
+        with open(self.marketplace.log_file) as log:
+            self.assertIn('Couldnt remove item tea from cart 0', log.read())
+
+    def test_closed(self):
+        """
+        Calls on a closed marketplace should fail instead of raising.
+        """
+        producer_id = self.marketplace.register_producer()
+        cart_id = self.marketplace.new_cart()
+        self.marketplace.close()
+        self.assertIs(self.marketplace.publish(producer_id, "tea", timeout=None), False)
+        self.assertIs(self.marketplace.add_to_cart(cart_id, "tea"), False)
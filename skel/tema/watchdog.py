@@ -0,0 +1,229 @@
+"""Thread/json/unittest modules"""
+from io import StringIO
+from threading import Event, Thread
+from time import monotonic
+import json
+import sys
+import unittest
+
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.order_sink import CollectorOrderSink
+from tema.producer import Producer
+
+POLICY_REPORT = "report" # write the snapshot and keep watching
+POLICY_ABORT = "abort" # write the snapshot and give up on the scenario, see wait_consumers
+POLICY_EVICT = "evict" # write the snapshot and free the full queues of what nobody waits for
+WATCHDOG_POLICIES = (POLICY_REPORT, POLICY_ABORT, POLICY_EVICT)
+ABORT_EXIT_CODE = 3
+
+
+class Watchdog(Thread):
+    """
+    Thread that watches a running scenario for stalls, like a producer whose
+    queue is full of products nobody wants while the consumers keep retrying
+    the products it never gets to publish.
+
+    Every interval seconds (stall_time / 4 by default) it sums the consumers'
+    progress. If it didn't change for stall_time seconds while a consumer is
+    still shopping, it writes a snapshot of the market as a JSON line to
+    stream (stderr by default) and applies its policy, then waits another
+    stall_time before acting again. A stall is so noticed within
+    stall_time + interval seconds.
+
+    consumers may still grow while the watchdog runs (streamed scenarios).
+
+    The abort policy sets aborted and stops watching, which ends
+    wait_consumers: the stuck consumers never finish, so the caller is the
+    one to write out its outputs and exit (with ABORT_EXIT_CODE).
+    """
+    def __init__(self, marketplace, producers, consumers, stall_time, policy=POLICY_REPORT,
+                 stream=None, interval=None):
+        if policy not in WATCHDOG_POLICIES:
+            raise ValueError('Unknown watchdog policy %s' % policy)
+        Thread.__init__(self, name='watchdog', daemon=True)
+        self.marketplace = marketplace
+        self.producers = producers
+        self.consumers = consumers
+        self.stall_time = stall_time
+        self.policy = policy
+        self.stream = stream
+        self.interval = interval or stall_time / 4
+        self.stalls = 0 # stalls noticed so far
+        self.stop_event = Event()
+        self.aborted = Event()
+
+    def run(self):
+        last_progress = self.progress()
+        progressed_at = monotonic()
+        while not self.stop_event.wait(self.interval):
+            now = monotonic()
+            progress = self.progress()
+            if progress != last_progress:
+                last_progress = progress
+                progressed_at = now
+            elif now - progressed_at >= self.stall_time and self.shopping():
+                self.stalls += 1
+                snapshot = self.snapshot(now - progressed_at)
+                print(json.dumps(snapshot), file=self.stream or sys.stderr, flush=True)
+                self.resolve()
+                progressed_at = now
+
+    def stop(self):
+        """
+        Stops watching.
+        """
+        self.stop_event.set()
+
+    def wait_consumers(self, poll=0.1):
+        """
+        Waits for the consumers to finish. Returns False if the abort policy
+        gave up on them first.
+        """
+        while any(consumer.is_alive() for consumer in list(self.consumers)):
+            if self.aborted.wait(poll):
+                return False
+        return True
+
+    def progress(self):
+        """
+        Units added and orders placed by the consumers so far.
+        """
+        return sum(consumer.progress for consumer in list(self.consumers))
+
+    def shopping(self):
+        """
+        Whether some consumer is still running.
+        """
+        return any(consumer.is_alive() for consumer in list(self.consumers))
+
+    def snapshot(self, stalled_for):
+        """
+        The state of the market: every producer's queue and the product it
+        fails to publish, and what the running consumers fail to add.
+        """
+        stock = self.marketplace.producer_stock()
+        producers = {}
+        for producer in self.producers:
+            producer_id = producer.this_producer_id
+            producers[producer.name] = {
+                "id": producer_id,
+                "queued": len(self.marketplace.producers[producer_id]),
+                "stock": {str(product): units
+                          for product, units in stock.get(producer_id, {}).items()},
+                "publishing": None if producer.publishing is None else str(producer.publishing),
+                "rejections": producer.rejections}
+        consumers = {}
+        for consumer in list(self.consumers):
+            if consumer.is_alive():
+                consumers[consumer.name] = {
+                    "waiting_for": None if consumer.waiting_for is None
+                                   else str(consumer.waiting_for),
+                    "retries": consumer.retries, "progress": consumer.progress}
+        return {"stalled_for": round(stalled_for, 3), "policy": self.policy,
+                "queue_size": self.marketplace.queue_size_per_producer,
+                "open_carts": len(self.marketplace.cart_locks),
+                "producers": producers, "consumers": consumers}
+
+    def resolve(self):
+        """
+        Applies the policy to the stall.
+        """
+        self.marketplace.logger.error('No progress for %.1fs, watchdog policy %s',
+                                      self.stall_time, self.policy)
+        if self.policy == POLICY_ABORT:
+            self.aborted.set()
+            self.stop()
+        elif self.policy == POLICY_EVICT:
+            self.evict()
+
+    def evict(self):
+        """
+        Takes the products no consumer is waiting for off the producers'
+        full queues, so they can publish the ones consumers are waiting for.
+        Returns how many units were evicted.
+        """
+        wanted = {consumer.waiting_for for consumer in list(self.consumers)
+                  if consumer.is_alive()}
+        evicted = 0
+        for producer_id, products in self.marketplace.producer_stock().items():
+            if len(self.marketplace.producers[producer_id]) < \
+                    self.marketplace.queue_size_per_producer:
+                continue
+            for product in products:
+                if product not in wanted:
+                    evicted += self.marketplace.evict(producer_id, product)
+        return evicted
+
+
+class TestWatchdog(unittest.TestCase):
+    """
+    Class that represents the watchdog test class.
+    """
+    def _run(self, policy, products, carts):
+        """
+        Runs a producer with queue size 2 and a consumer under a watchdog.
+        """
+        marketplace = Marketplace(2, order_sink=CollectorOrderSink())
+        producers = [Producer(products, marketplace, 0.01, name="prod1", daemon=True)]
+        consumers = [Consumer(carts, marketplace, 0.01, name="cons1", daemon=True)]
+        stream = StringIO()
+        watchdog = Watchdog(marketplace, producers, consumers, 0.2, policy=policy,
+                            stream=stream)
+        watchdog.start()
+        for thread in producers + consumers:
+            thread.start()
+        consumers[0].join(2)
+        watchdog.stop()
+        return consumers[0], watchdog, stream.getvalue().splitlines()
+
+    def test_evict(self):
+        """
+        The deadlock of the test generator's comment (the producer fills its
+        queue with coffee before it gets to make the tea the consumer wants)
+        should be reported, and evicting the coffee should let the producer
+        make the tea.
+        """
+        tea = [{"type": "add", "product": "tea", "quantity": 1}]
+        consumer, watchdog, lines = self._run(POLICY_EVICT, [("coffee", 2, 0.01), ("tea", 1, 0.01)],
+                                              [tea])
+        self.assertFalse(consumer.is_alive())
+        self.assertGreaterEqual(watchdog.stalls, 1)
+        snapshot = json.loads(lines[0])
+        self.assertEqual(snapshot["producers"]["prod1"]["stock"], {"coffee": 2})
+        self.assertEqual(snapshot["producers"]["prod1"]["publishing"], "tea")
+        self.assertEqual(snapshot["consumers"]["cons1"]["waiting_for"], "tea")
+        self.assertGreater(snapshot["consumers"]["cons1"]["retries"], 0)
+
+    def test_abort(self):
+        """
+        The abort policy should end wait_consumers while the consumer is stuck.
+        """
+        tea = [{"type": "add", "product": "tea", "quantity": 1}]
+        marketplace = Marketplace(2, order_sink=CollectorOrderSink())
+        producers = [Producer([("coffee", 2, 0.01), ("tea", 1, 0.01)], marketplace, 0.01,
+                              name="prod1", daemon=True)]
+        consumers = [Consumer([tea], marketplace, 0.01, name="cons1", daemon=True)]
+        watchdog = Watchdog(marketplace, producers, consumers, 0.2, policy=POLICY_ABORT,
+                            stream=StringIO())
+        watchdog.start()
+        for thread in producers + consumers:
+            thread.start()
+        self.assertFalse(watchdog.wait_consumers())
+        self.assertTrue(consumers[0].is_alive())
+        self.assertEqual(watchdog.stalls, 1)
+
+    def test_progress(self):
+        """
+        A scenario that keeps making progress shouldn't be reported.
+        """
+        coffee = [{"type": "add", "product": "coffee", "quantity": 1}]
+        consumer, watchdog, lines = self._run(POLICY_REPORT, [("coffee", 1, 0.01)], [coffee] * 20)
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual((watchdog.stalls, lines), (0, []))
+
+    def test_unknown_policy(self):
+        """
+        Unknown policies should be refused.
+        """
+        self.assertRaises(ValueError, Watchdog, None, [], [], 1, policy="panic")
@@ -11,12 +11,24 @@ Script input
     - max number of carts per consumer
     - is basic test
     - should have removal operations
+    - --binary: also write the test's input in the binary format (tests/{name}.bin)
+    - --zipf S: product popularity follows a Zipf law of exponent S (0 = uniform)
+    - --hot-producers K: the first K producers stock every product, with
+      --hot-factor times the usual quantities
+
+Consumers are generated and written one at a time, so scenarios with millions
+of operations don't have to fit in memory, e.g.:
+    python3 test_generator.py big 50 2000 500 100 200 200 --zipf 1.1 --hot-producers 2
 """
 import argparse
 import random
-from json import loads, dumps
+from collections import Counter, deque
+from itertools import accumulate
+from json import dumps
 
+from tema.binary_scenario import write_binary
 from tema.product import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from tema.scenario import build_products
 from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
 
 
@@ -31,11 +43,13 @@ def generate_test():
     cmdline_arguments = parse_input()
     if not sanitize_inputs(cmdline_arguments):
         print("Invalid arguments")
-    print(cmdline_arguments)
+        return
 
     products = generate_products(cmdline_arguments[ARG_PRODUCTS])
     producers = generate_producers(cmdline_arguments[ARG_PRODUCERS],
-                                   products, cmdline_arguments[ARG_IS_BASIC])
+                                   products, cmdline_arguments[ARG_IS_BASIC],
+                                   cmdline_arguments[ARG_HOT_PRODUCERS],
+                                   cmdline_arguments[ARG_HOT_FACTOR])
 
     # eliminate the products not produced
 
@@ -43,25 +57,23 @@ def generate_test():
         if not products[prod_id]["is_produced"]:
             del products[prod_id]
 
-    consumers = generate_consumers(cmdline_arguments[ARG_CONSUMERS],
-                                   products,
-                                   cmdline_arguments[ARG_MIN_CARTS],
-                                   cmdline_arguments[ARG_MAX_CARTS],
-                                   cmdline_arguments[ARG_IS_BASIC],
-                                   cmdline_arguments[ARG_SUPPORTS_REMOVAL])
+    consumers = iter_consumers(cmdline_arguments[ARG_CONSUMERS],
+                               products,
+                               cmdline_arguments[ARG_MIN_CARTS],
+                               cmdline_arguments[ARG_MAX_CARTS],
+                               has_remove_operation=cmdline_arguments[ARG_SUPPORTS_REMOVAL],
+                               basic_test=cmdline_arguments[ARG_IS_BASIC],
+                               zipf=cmdline_arguments[ARG_ZIPF])
     marketplace = generate_marketplace(cmdline_arguments[ARG_MARKETPLACE_Q])
 
     for prod_id in products.keys():
         del products[prod_id]["is_produced"]
 
-    json_data = {ARG_PRODUCTS: products, ARG_PRODUCERS: producers,
-                 ARG_CONSUMERS: consumers, "marketplace": marketplace}
+    conf = {ARG_PRODUCTS: products, ARG_PRODUCERS: producers,
+            ARG_CONSUMERS: consumers, "marketplace": marketplace}
 
-    # write to json test file (tests/{test_name}.json)
-    with open(f'{TESTS_DIR}/{cmdline_arguments[ARG_TEST_NAME]}.json', 'w') as json_file:
-        print(dumps(json_data, indent=4), file=json_file)
-
-    generate_in_out_test_files(cmdline_arguments[ARG_TEST_NAME])
+    generate_in_out_test_files(cmdline_arguments[ARG_TEST_NAME], conf,
+                               cmdline_arguments[ARG_BINARY])
 
 
 def parse_input():
@@ -93,6 +105,17 @@ def parse_input():
                         help="True if it is a simple test, False otherwise")
     parser.add_argument(ARG_SUPPORTS_REMOVAL, type=bool, nargs='?', default=True,
                         help="True if the consumer can remove products from cart, False otherwise")
+    parser.add_argument("--" + ARG_BINARY, action="store_true",
+                        help="also write the input file in the binary format (.bin)")
+    parser.add_argument("--" + ARG_ZIPF, type=float, default=DEFAULT_ZIPF_EXPONENT,
+                        help="exponent of the Zipf law followed by the products' popularity "
+                             "(0 = uniform)")
+    parser.add_argument("--hot-producers", dest=ARG_HOT_PRODUCERS, type=int,
+                        default=DEFAULT_HOT_PRODUCERS,
+                        help="number of producers stocking every product in bulk")
+    parser.add_argument("--hot-factor", dest=ARG_HOT_FACTOR, type=int,
+                        default=DEFAULT_HOT_FACTOR,
+                        help="how many times the usual quantities the hot producers stock")
 
     return parser.parse_args().__dict__
 
@@ -109,12 +132,32 @@ def sanitize_inputs(arguments):
             and arguments[ARG_MARKETPLACE_Q] > 0 \
             and arguments[ARG_MIN_CARTS] > 0 \
             and arguments[ARG_MAX_CARTS] > 0 \
-            and arguments[ARG_MAX_CARTS] >= arguments[ARG_MIN_CARTS]:
+            and arguments[ARG_MAX_CARTS] >= arguments[ARG_MIN_CARTS] \
+            and arguments[ARG_ZIPF] >= 0 \
+            and 0 <= arguments[ARG_HOT_PRODUCERS] <= arguments[ARG_PRODUCERS] \
+            and arguments[ARG_HOT_FACTOR] > 0:
         return True
 
     return False
 
 
+def synthetic_names(names, count):
+    """
+    Returns count distinct (name, base name) pairs: the base names in a random
+    order, then again suffixed with " 2", " 3" and so on once they run out.
+    :param names: the base names
+    :param count: the number of names to generate
+    :return: a list of (name, base name) tuples
+    """
+    result = []
+    rounds = 0
+    while len(result) < count:
+        rounds += 1
+        suffix = "" if rounds == 1 else f" {rounds}"
+        result += [(name + suffix, name) for name in random.sample(names, len(names))]
+    return result[:count]
+
+
 def generate_products(count):
     """
     Generates a dict like the one on this example:
@@ -137,28 +180,23 @@ def generate_products(count):
     :return: a dictionary of products
     """
     # let's have 50% tea, 50% coffee
+    coffee_count = (count + 1) // 2
+    coffees = synthetic_names(COFFEE_NAMES, coffee_count)
+    teas = synthetic_names(list(TEA_NAMES_TYPES), count - coffee_count)
+    prices = random.choices(range(1, 11), k=count)
+    roast_levels = random.choices(ROAST_LEVEL, k=coffee_count)
 
     products = {}
-    # to avoid random duplicates
-    coffee_names_copy = list(COFFEE_NAMES)
-    tea_list_copy = list(TEA_NAMES_TYPES.keys())
-
     for i in range(count):
-        if i < count / 2:
-            product = {"product_type": "Coffee"}
-            name = random.choice(coffee_names_copy)
-            coffee_names_copy.remove(name)
-            product["name"] = name
-            product["acidity"] = round(random.uniform(MIN_ACIDITY, MAX_ACIDITY), 2)
-            product["roast_level"] = random.choice(ROAST_LEVEL)
+        if i < coffee_count:
+            product = {"product_type": "Coffee", "name": coffees[i][0],
+                       "acidity": round(random.uniform(MIN_ACIDITY, MAX_ACIDITY), 2),
+                       "roast_level": roast_levels[i]}
         else:
-            product = {"product_type": "Tea"}
-            tea = random.choice(tea_list_copy)
-            product["name"] = tea
-            product["type"] = TEA_NAMES_TYPES[tea]
-            tea_list_copy.remove(tea)
+            name, tea = teas[i - coffee_count]
+            product = {"product_type": "Tea", "name": name, "type": TEA_NAMES_TYPES[tea]}
 
-        product["price"] = random.randint(1, 10)
+        product["price"] = prices[i]
         product["is_produced"] = False  # temporary field used for generating carts for consumers
         products[PRODUCT_PREFIX + str(i + 1)] = product
 
@@ -177,7 +215,8 @@ def generate_marketplace(queue_size):
     return marketplace
 
 
-def generate_producers(count, products, basic_test):
+def generate_producers(count, products, basic_test, hot_producers=0,
+                       hot_factor=DEFAULT_HOT_FACTOR):
     """
     Example:
     [{
@@ -192,22 +231,33 @@ def generate_producers(count, products, basic_test):
     :param count: the number of producers to generate
     :param products: all the products that can be delivered to the marketplace
     :param basic_test: True if it's a simple test, False otherwise
+    :param hot_producers: the number of producers, first in the list, that stock every
+        product with hot_factor times the usual quantities
+    :param hot_factor: the quantity multiplier of the hot producers
     :return: a list with all producers
     """
     # why?
     # scenario: 1 prod 1 cons prod produces 5 type 1 products, 5 type2. Marketplace queue size 5
     # First the producer produces 5 type2 products. Consumer requests type 1 products - deadlock
     max_quantity = 3 if basic_test else 5
+    product_ids = list(products.keys())
 
     producers = []
     for i in range(count):
         producer = {"name": PRODUCER_NAME_PREFIX + str(i + 1)}
 
-        num_products_per_producer = random.randint(1, len(products.keys()))
-        products_to_produce = random.sample(products.keys(), num_products_per_producer)
+        if i < hot_producers:
+            products_to_produce = product_ids
+            factor = hot_factor
+        else:
+            num_products_per_producer = random.randint(1, len(product_ids))
+            products_to_produce = random.sample(product_ids, num_products_per_producer)
+            factor = 1
 
-        products_list = [[x, random.randint(1, max_quantity), round(random.uniform(0.05, 0.4), 2)]
-                         for x in products_to_produce]
+        quantities = random.choices(range(factor, factor * max_quantity + 1, factor),
+                                    k=len(products_to_produce))
+        products_list = [[x, quantity, round(random.uniform(0.05, 0.4), 2)]
+                         for x, quantity in zip(products_to_produce, quantities)]
 
         producer[ARG_PRODUCTS] = products_list
         producer["republish_wait_time"] = round(random.uniform(0.05, 0.4), 2)
@@ -220,8 +270,93 @@ def generate_producers(count, products, basic_test):
     return producers
 
 
+def popularity(count, zipf):
+    """
+    Cumulative weights of count products ranked by popularity, following a
+    Zipf law of exponent zipf, or None for uniform popularity (zipf 0)
+    :param count: the number of products
+    :param zipf: the exponent of the Zipf law
+    :return: a list of cumulative weights to pass to random.choices, or None
+    """
+    if not zipf:
+        return None
+    return list(accumulate(1 / rank ** zipf for rank in range(1, count + 1)))
+
+
+def sample_products(product_ids, cum_weights, size):
+    """
+    Draws size distinct products by popularity, like random.sample does for
+    uniform popularity
+    :param size: the number of products, at most len(product_ids)
+    :return: a list of product ids
+    """
+    if cum_weights is None:
+        return random.sample(product_ids, size)
+    chosen = {}
+    while len(chosen) < size:
+        for product_id in random.choices(product_ids, cum_weights=cum_weights,
+                                         k=size - len(chosen)):
+            chosen.setdefault(product_id, None)
+    return list(chosen)
+
+
+def generate_consumer(index, product_ids, cum_weights, min_cart, max_cart,
+                      has_remove_operation=True, basic_test=True):
+    """
+    Generates one consumer, see generate_consumers. The sizes, quantities and
+    removals of all its carts are drawn in batches; the products of a cart
+    are distinct.
+    :param index: the index of the consumer, starting from 0
+    :param product_ids: the ids of the products the consumer can buy, the most popular first
+    :param cum_weights: the cumulative popularity of product_ids, see popularity
+    :return: the consumer dict
+    """
+    max_operations_per_cart = 3 if basic_test else 10
+    max_quantity = 5 if basic_test else 10
+
+    num_carts = random.randint(min_cart, max_cart)
+    sizes = random.choices(range(1, min(max_operations_per_cart, len(product_ids)) + 1),
+                           k=num_carts)
+    quantities = random.choices(range(1, max_quantity + 1), k=sum(sizes))
+    # artificially insert 0 or 1 removal operations, aka not all carts will have removals
+    removals = random.choices((False, True), k=num_carts) if has_remove_operation \
+        else [False] * num_carts
+
+    consumer = {"name": CONSUMER_NAME_PREFIX + str(index + 1),
+                "retry_wait_time": round(random.uniform(0.05, 0.4), 2), "carts": []}
+    position = 0
+    for size, should_insert_remove_op in zip(sizes, removals):
+        chosen = sample_products(product_ids, cum_weights, size)
+        operations = [{"type": ADD_TO_CART_OP, "product": product_id, "quantity": quantity}
+                      for product_id, quantity in zip(chosen, quantities[position:position + size])]
+        position += size
+
+        if should_insert_remove_op:
+            removed = random.choice(operations)
+            operations.append({"type": REMOVE_FROM_CART_OP, "product": removed["product"],
+                               "quantity": random.randint(1, removed["quantity"])})
+
+        consumer["carts"].append({"ops": operations,
+                                  "expected_cart": compute_expected_cart(operations)})
+    return consumer
+
+
+def iter_consumers(count, products, min_cart, max_cart,
+                   has_remove_operation=True, basic_test=True, zipf=0):
+    """
+    Generates the consumers one at a time, see generate_consumers.
+    :param zipf: the exponent of the Zipf law followed by the products' popularity
+    :return: a generator of consumers
+    """
+    product_ids = list(products.keys())
+    cum_weights = popularity(len(product_ids), zipf)
+    for i in range(count):
+        yield generate_consumer(i, product_ids, cum_weights, min_cart, max_cart,
+                                has_remove_operation, basic_test)
+
+
 def generate_consumers(count, products, min_cart, max_cart,
-                       has_remove_operation=True, basic_test=True):
+                       has_remove_operation=True, basic_test=True, zipf=0):
     """ Example:
     [
         {
@@ -242,43 +377,8 @@ def generate_consumers(count, products, min_cart, max_cart,
     ],
     :return: list of consumers
     """
-    consumers = []
-    max_operations_per_cart = 3 if basic_test else 10
-    max_quantity = 5 if basic_test else 10
-
-    for i in range(count):
-        consumer = {"name": CONSUMER_NAME_PREFIX + str(i + 1),
-                    "retry_wait_time": round(random.uniform(0.05, 0.4), 2)}
-
-        num_carts = random.randint(min_cart, max_cart)
-        consumer["carts"] = []
-
-        for _ in range(num_carts):
-            num_operations = random.randint(1, max_operations_per_cart)
-
-            print(products.keys(), " ", num_operations)
-            if len(products) < num_operations:
-                num_operations = len(products)
-
-            product_ids = random.sample(products.keys(), num_operations)
-            operations = [{"type": ADD_TO_CART_OP, "product": x,
-                           "quantity": random.randint(1, max_quantity)} for x in product_ids]
-
-            # artificially insert 0 or 1 removal operations, aka not all carts will have removals
-            if has_remove_operation:
-                should_insert_remove_op = random.randint(0, 1)
-                if should_insert_remove_op > 0:
-                    index = random.randint(0, len(operations)) - 1
-                    operations.append({"type": REMOVE_FROM_CART_OP,
-                                       "product": operations[index]["product"],
-                                       "quantity": random.choice(
-                                           range(1, operations[index]["quantity"] + 1))})
-
-            consumer["carts"].append({"ops": operations,
-                                      "expected_cart": compute_expected_cart(operations)})
-
-        consumers.append(consumer)
-    return consumers
+    return list(iter_consumers(count, products, min_cart, max_cart,
+                               has_remove_operation, basic_test, zipf))
 
 
 def compute_expected_cart(operations):
@@ -301,48 +401,95 @@ def compute_expected_cart(operations):
     return expected_cart
 
 
-def generate_in_out_test_files(test_name):
+class JsonListWriter:
+    """
+    Writes a JSON object to a file exactly like print(dumps(obj, indent=4))
+    would, except that the items of one of its lists are appended one at a time.
+    """
+    def __init__(self, output_file, head, key):
+        """
+        :param head: the (key, value) pairs of the object before the streamed list
+        :param key: the key of the streamed list
+        """
+        self.output_file = output_file
+        self.empty = True
+        output_file.write("{\n")
+        for name, value in head.items():
+            output_file.write(f"    {dumps(name)}: {self._indent(value, 1)},\n")
+        output_file.write(f"    {dumps(key)}: [")
+
+    @staticmethod
+    def _indent(value, level):
+        return dumps(value, indent=4).replace("\n", "\n" + "    " * level)
+
+    def append(self, item):
+        """
+        Writes the next item of the list.
+        """
+        self.output_file.write(("\n" if self.empty else ",\n") + "        " + self._indent(item, 2))
+        self.empty = False
+
+    def close(self, tail):
+        """
+        Ends the list and writes the (key, value) pairs of the object after it.
+        """
+        self.output_file.write("]" if self.empty else "\n    ]")
+        for name, value in tail.items():
+            self.output_file.write(f",\n    {dumps(name)}: {self._indent(value, 1)}")
+        self.output_file.write("\n}\n")
+
+
+def generate_in_out_test_files(test_name, conf, binary=False):
     """
-    Creates two files for the given test: the input file and the reference output file
+    Creates the files of the given test in a single pass over conf's consumers:
+    the generator's json file, the input file and the reference output file
     :param test_name: the name (excluding the extension) given to all the files of the test
+    :param conf: the test's products, producers, consumers (any iterable of the dicts
+        generate_consumer returns) and marketplace
+    :param binary: also write the input file in the binary format (tests/{test_name}.bin)
     :return: nothing
     """
-    filename = f'{TESTS_DIR}/{test_name}.json'
-
-    with open(filename) as json_file:
-        conf = loads(json_file.read())
-
     # turn product definitions into actual products
-    products = {}
-    for k, prod_dict in conf['products'].items():
-        params = {k: v for k, v in prod_dict.items() if k != 'product_type'}
-        products[k] = globals()[prod_dict['product_type']](**params)
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in conf['consumers']:
-        for cart in consumer['carts']:
-            cart['expected_cart'] = {products[k]: v
-                                     for k, v
-                                     in cart['expected_cart'].items()}
-
-    lines = []
-    for consumer in conf['consumers']:
-        print("consumer" + str(consumer))
-        for cart in consumer['carts']:
-            for product, count in cart['expected_cart'].items():
-                lines += ([f'{consumer["name"]} bought {product}'] * count)
-
-    # write to output file (tests/{test_name}.out)
+    products = build_products(conf[ARG_PRODUCTS])
+    head = {ARG_PRODUCTS: conf[ARG_PRODUCTS], ARG_PRODUCERS: conf[ARG_PRODUCERS]}
+    tail = {"marketplace": conf["marketplace"]}
+    bought = {}  # (consumer name, Counter of the product ids it buys)
+
+    def written(consumers):
+        # write to json test file (tests/{test_name}.json) and input file (tests/{test_name}.in)
+        with open(f'{TESTS_DIR}/{test_name}.json', 'w') as json_file, \
+                open(f'{TESTS_DIR}/{test_name}.in', 'w') as input_file:
+            json_writer = JsonListWriter(json_file, head, ARG_CONSUMERS)
+            input_writer = JsonListWriter(input_file, head, ARG_CONSUMERS)
+            for consumer in consumers:
+                json_writer.append(consumer)
+                counts = bought.setdefault(consumer["name"], Counter())
+                for cart in consumer["carts"]:
+                    counts.update(cart["expected_cart"])
+                consumer = dict(consumer, carts=[cart["ops"] for cart in consumer["carts"]])
+                input_writer.append(consumer)
+                yield consumer
+            json_writer.close(tail)
+            input_writer.close(tail)
+
+    if binary:
+        with open(f'{TESTS_DIR}/{test_name}.bin', 'wb') as binary_file:
+            write_binary(dict(head, consumers=written(conf[ARG_CONSUMERS]), **tail), binary_file)
+    else:
+        deque(written(conf[ARG_CONSUMERS]), maxlen=0)
+
+    # write to output file (tests/{test_name}.ref.out), sorted like the whole list of lines
+    # would be: names have no spaces, so "cons1 bought" < "cons10 bought" as "cons1 " < "cons10 "
     with open(f'{TESTS_DIR}/{test_name}.ref.out', 'w') as output_file:
-        lines.sort()
-        print('\n'.join(lines), file=output_file)
-
-    for consumer in conf['consumers']:
-        consumer['carts'] = [d['ops'] for d in consumer['carts']]
-
-    # write to input file (tests/{test_name}.in)
-    with open(f'{TESTS_DIR}/{test_name}.in', 'w') as input_file:
-        print(dumps(conf, indent=4), file=input_file)
+        written_lines = 0
+        for name in sorted(bought, key=lambda name: name + " "):
+            lines = sorted((f'{name} bought {products[product_id]}\n', count)
+                           for product_id, count in bought[name].items())
+            for line, count in lines:
+                output_file.write(line * count)
+                written_lines += count
+        if not written_lines:
+            output_file.write("\n")
 
 
 if __name__ == "__main__":
@@ -41,6 +41,9 @@ DEFAULT_NUM_PRODUCTS = 7
 DEFAULT_MARKETPLACE_QUEUE_SIZE = 8
 DEFAULT_MIN_NUMBER_CARTS_PER_CONSUMER = 1
 DEFAULT_MAX_NUMBER_CARTS_PER_CONSUMER = 3
+DEFAULT_ZIPF_EXPONENT = 0
+DEFAULT_HOT_PRODUCERS = 0
+DEFAULT_HOT_FACTOR = 10
 
 # Input arguments names for the test_generator script
 ARG_TEST_NAME = "test_name"
@@ -52,3 +55,7 @@ ARG_MAX_CARTS = "max_carts"
 ARG_MARKETPLACE_Q = "marketplace_q"
 ARG_IS_BASIC = "is_basic"
 ARG_SUPPORTS_REMOVAL = "supports_removal"
+ARG_BINARY = "binary"
+ARG_ZIPF = "zipf"
+ARG_HOT_PRODUCERS = "hot_producers"
+ARG_HOT_FACTOR = "hot_factor"
@@ -6,13 +6,156 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
 import sys
-from json import loads
+import time
+from json import dumps, loads
+from threading import Thread
 
 from tema.producer import Producer
 from tema.consumer import Consumer
-from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.marketplace import Marketplace, CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED
+from tema.async_marketplace import AsyncMarketplace
+from tema.async_producer import AsyncProducer
+from tema.async_consumer import AsyncConsumer
+from tema.sharded_marketplace import ShardedMarketplace
+from tema.logging_pipeline import close_all_marketplace_loggers
+from tema.order_sink import FileOrderSink, QueuedOrderSink, StreamOrderSink
+from tema.metrics import MarketplaceMetrics
+from tema.product import Tea
+from tema.scenario import STREAM_SUFFIX, read_stream, resolve_config, stream_config
+from tema.binary_scenario import BINARY_SUFFIX, map_binary
+from tema.selection import SELECTION_POLICIES
+from tema.clock import REAL_CLOCK, VirtualClock
+from tema.watchdog import ABORT_EXIT_CODE, WATCHDOG_POLICIES, POLICY_ABORT, Watchdog
+from tema.profiler import SamplingProfiler
+from tema.remote_marketplace import RemoteMarketplace, parse_address
+
+
+def parse_args():
+    """
+        Parses the command line: the input file plus the optional run modes.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", nargs="?",
+                        help="market configuration file (tests/NN.in, its .ndjson variant, "
+                             "streamed by the threads engines, or its memory-mapped .bin "
+                             "variant)")
+    parser.add_argument("--engine", choices=["threads", "asyncio", "sharded", "remote"],
+                        default="threads",
+                        help="run producers and consumers as threads or as asyncio tasks, "
+                             "or as threads over a marketplace sharded across processes or "
+                             "served by another process")
+    parser.add_argument("--connect", metavar="ADDRESS",
+                        help="host:port or Unix socket path of the marketplace server the remote "
+                             "engine uses (default: start one, with the file's queue size)")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="number of marketplace processes for the sharded engine "
+                             "(default: one per core)")
+    parser.add_argument("--concurrency", choices=[CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED],
+                        default=CONCURRENCY_GLOBAL, help="marketplace locking mode")
+    parser.add_argument("--selection", choices=list(SELECTION_POLICIES), default="first_fit",
+                        help="which producer add_to_cart takes a unit from (threads engines)")
+    parser.add_argument("--blocking", action="store_true",
+                        help="producers and consumers wait on the marketplace instead of polling")
+    parser.add_argument("--batch", action="store_true",
+                        help="producers and consumers use the bulk marketplace calls")
+    parser.add_argument("--max-open-carts", type=int, metavar="N",
+                        help="consumers wait for a cart while N carts are open "
+                             "(threads, sharded and remote engines)")
+    parser.add_argument("--cart-ttl", type=float, metavar="SECS",
+                        help="give back the units of carts unused for SECS seconds, above "
+                             "every retry_wait_time (threads and remote engines)")
+    parser.add_argument("--hold-ttl", type=float, metavar="SECS",
+                        help="units stay in a cart for SECS seconds, then go back to the market "
+                             "until their consumer adds them again (threads and remote engines)")
+    parser.add_argument("--watchdog", type=float, metavar="SECS",
+                        help="watch for SECS seconds without any consumer progress, then print "
+                             "a snapshot of the market to stderr and apply --watchdog-policy "
+                             "(threads engine)")
+    parser.add_argument("--watchdog-policy", choices=WATCHDOG_POLICIES, default=POLICY_ABORT,
+                        help="what the watchdog does about a stall: keep watching, exit with "
+                             "status 3, or evict the products nobody waits for from full queues")
+    parser.add_argument("--virtual-time", action="store_true",
+                        help="simulate the producers' and consumers' sleeps instead of sleeping "
+                             "(threads engines, without --blocking); the run is reproducible "
+                             "and its wall time is the marketplace's own overhead")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        default="INFO", help="marketplace.log level")
+    parser.add_argument("--log-sample-rate", type=int, default=1, metavar="N",
+                        help="log only one in N of the failed add_to_cart errors")
+    parser.add_argument("--order-file", metavar="PATH",
+                        help="write the orders to this file instead of stdout")
+    parser.add_argument("--queued-orders", action="store_true",
+                        help="write the orders from a single writer thread")
+    parser.add_argument("--metrics", type=float, metavar="SECS",
+                        help="collect marketplace metrics, dump them to stderr every SECS seconds "
+                             "(0 = only at the end)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="sample the stacks of every thread, write them to FILE as collapsed "
+                             "stacks (flamegraph.pl, speedscope) and print the top marketplace "
+                             "methods to stderr")
+    parser.add_argument("--profile-interval", type=float, default=0.005, metavar="SECS",
+                        help="seconds between two samples of --profile")
+    parser.add_argument("--stress", type=int, nargs="+", metavar="THREADS",
+                        help="run the lock stress test with these producer/consumer pair counts")
+    parser.add_argument("--stress-ops", type=int, default=20000,
+                        help="units published and bought by each stress test pair")
+    return parser.parse_args()
+
+
+def stress_pair(marketplace, product, ops):
+    """
+        One producer/consumer pair of the stress test: the producer publishes
+        `ops` units of its own product, the consumer buys all of them into its
+        own cart. Neither sleeps, so the run measures marketplace overhead.
+    """
+    producer_id = marketplace.register_producer()
+    cart_id = marketplace.new_cart()
+
+    def produce():
+        for _ in range(ops):
+            while not marketplace.publish(producer_id, product):
+                time.sleep(0)
+
+    def consume():
+        for _ in range(ops):
+            while not marketplace.add_to_cart(cart_id, product):
+                time.sleep(0)
+
+    return [Thread(target=produce, daemon=True), Thread(target=consume, daemon=True)]
+
+
+def stress(thread_counts, ops):
+    """
+        Runs the stress test for every pair count and both concurrency modes
+        and prints the add_to_cart throughput of each run.
+    """
+    print("{:>8} {:>10} {:>14}".format("pairs", "mode", "adds/sec"))
+    for pairs in thread_counts:
+        for concurrency in (CONCURRENCY_GLOBAL, CONCURRENCY_STRIPED):
+            marketplace = Marketplace(8, concurrency=concurrency)
+            marketplace.logger.disabled = True
+            threads = [thread for i in range(pairs)
+                       for thread in stress_pair(marketplace, Tea("stress%d" % i, 1, "Black"), ops)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            marketplace.logger.disabled = False
+            print("{:>8} {:>10} {:>14.0f}".format(pairs, concurrency, pairs * ops / elapsed))
+
+
+class ScenarioAborted(Exception):
+    """
+        The watchdog gave up on a stalled scenario.
+    """
 
 
 def main():
@@ -20,54 +163,214 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
+    args = parse_args()
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(args.profile_interval)
+        profiler.start()
+
+    aborted = False
     try:
-        filename = sys.argv[1]
-    except IndexError:
+        if args.stress:
+            stress(args.stress, args.stress_ops)
+        else:
+            run(args)
+    except ScenarioAborted:
+        aborted = True
+
+    if profiler is not None:
+        profiler.stop()
+        with open(args.profile, 'w') as profile_file:
+            profiler.write_collapsed(profile_file)
+        profiler.summary([Marketplace, ShardedMarketplace, AsyncMarketplace])
+
+    if aborted:
+        # the stuck consumers would keep the interpreter from exiting
+        sys.stdout.flush()
+        sys.stderr.flush()
+        close_all_marketplace_loggers()
+        os._exit(ABORT_EXIT_CODE)
+
+
+def run(args):
+    """
+        Runs the scenario of the input file.
+    """
+    if args.input_file is None:
         print("no input file specified")
         raise SystemExit
+    if args.virtual_time and (args.engine == "asyncio" or args.blocking):
+        raise SystemExit("--virtual-time needs a threads engine, without --blocking")
+    if args.watchdog and args.engine != "threads":
+        raise SystemExit("--watchdog needs the threads engine")
 
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
+    order_sink = FileOrderSink(args.order_file) if args.order_file else StreamOrderSink()
+    if args.queued_orders:
+        order_sink = QueuedOrderSink(order_sink)
 
-    # turn product definitions into actual products
-    products = {}
+    try:
+        with open(args.input_file, 'rb' if args.input_file.endswith(BINARY_SUFFIX) else 'r') \
+                as input_file:
+            if args.input_file.endswith(BINARY_SUFFIX):
+                # the carts are decoded from the mapping while the consumers run
+                market_config = map_binary(input_file)
+            elif not args.input_file.endswith(STREAM_SUFFIX):
+                market_config = resolve_config(loads(input_file.read()))
+            elif args.engine == "asyncio" or args.virtual_time:
+                # virtual time starts once every consumer is created
+                market_config = resolve_config(read_stream(input_file))
+            else:
+                # the consumers start while the rest of the file is read
+                market_config = stream_config(input_file)
+            if isinstance(market_config['consumers'], list):
+                for c_market_config in market_config['consumers']:
+                    check_cart_ttl(c_market_config, args)
+
+            if args.engine == "asyncio":
+                asyncio.run(run_asyncio(market_config, order_sink))
+            else:
+                run_threads(market_config, args, order_sink)
+    finally:
+        order_sink.close()
 
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
 
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
+def check_cart_ttl(c_market_config, args):
+    """
+        Refuses a --cart-ttl that would reap the carts of a consumer sleeping
+        retry_wait_time between its tries.
+    """
+    if args.cart_ttl is not None and args.cart_ttl <= c_market_config['retry_wait_time']:
+        raise SystemExit("--cart-ttl must be above every retry_wait_time (%s)"
+                         % c_market_config['retry_wait_time'])
 
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
 
+def run_threads(market_config, args, order_sink):
+    """
+        Runs every producer and consumer in its own thread.
+    """
     # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
+    if args.engine == "sharded":
+        if args.batch:
+            raise SystemExit("the sharded engine has no bulk calls, drop --batch")
+        marketplace = ShardedMarketplace(**market_config['marketplace'], shards=args.shards,
+                                         order_sink=order_sink, selection=args.selection,
+                                         max_open_carts=args.max_open_carts)
+    elif args.engine == "remote":
+        if args.batch:
+            raise SystemExit("the remote engine has no bulk calls, drop --batch")
+        server = None
+        if args.connect:
+            if args.max_open_carts is not None or args.cart_ttl is not None \
+                    or args.hold_ttl is not None or args.selection != "first_fit":
+                raise SystemExit("configure the marketplace on its server with --connect")
+            address = parse_address(args.connect)
+        else:
+            server, address = start_server(market_config['marketplace'], args)
+        marketplace = RemoteMarketplace(address, order_sink=order_sink)
+    else:
+        metrics = None if args.metrics is None else MarketplaceMetrics()
+        marketplace = Marketplace(**market_config['marketplace'], concurrency=args.concurrency,
+                                  log_level=args.log_level,
+                                  error_sample_rate=args.log_sample_rate, order_sink=order_sink,
+                                  metrics=metrics, selection=args.selection,
+                                  max_open_carts=args.max_open_carts, cart_ttl=args.cart_ttl,
+                                  hold_ttl=args.hold_ttl)
+        if args.metrics:
+            metrics.start_dump(args.metrics)
 
-    # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
-                 for p_market_config in market_config['producers']]
+    clock = VirtualClock() if args.virtual_time else REAL_CLOCK
+    started = time.perf_counter()
+    with clock.hold():
+        # build and start the producers
+        producers = [Producer(**p_market_config, marketplace=marketplace, blocking=args.blocking,
+                              batch=args.batch, clock=clock, daemon=True)
+                     for p_market_config in market_config['producers']]
+
+        for producer in producers:
+            producer.start()
+
+        consumers = []
+        watchdog = None
+        if args.watchdog:
+            watchdog = Watchdog(marketplace, producers, consumers, args.watchdog,
+                                policy=args.watchdog_policy)
+            watchdog.start()
 
-    for producer in producers:
-        producer.start()
+        # build and start the consumers, one by one since they may be streamed in
+        for c_market_config in market_config['consumers']:
+            if not isinstance(market_config['consumers'], list):
+                # streamed in, not checked by run()
+                check_cart_ttl(c_market_config, args)
+            consumer = Consumer(**c_market_config, marketplace=marketplace,
+                                blocking=args.blocking, batch=args.batch, clock=clock)
+            consumer.start()
+            consumers.append(consumer)
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
+    if watchdog is None:
+        for consumer in consumers:
+            consumer.join()
+    elif not watchdog.wait_consumers():
+        raise ScenarioAborted()
+    clock.stop()
+    if watchdog is not None:
+        watchdog.stop()
+    if args.virtual_time:
+        print("{:.2f}s of virtual time in {:.2f}s".format(clock.time(),
+                                                          time.perf_counter() - started),
+              file=sys.stderr)
+
+    if args.engine == "sharded":
+        marketplace.close()
+    elif args.engine == "remote":
+        marketplace.close()
+        if server is not None:
+            # lets the server write out its log
+            server.send_signal(signal.SIGINT)
+            server.wait()
+    elif marketplace.metrics is not None:
+        marketplace.metrics.stop_dump()
+        print(dumps(marketplace.metrics.snapshot()), file=sys.stderr)
+
+
+def start_server(marketplace_config, args):
+    """
+        Starts a marketplace server process on a free loopback port, logging
+        to marketplace.log here. Returns the process and its address.
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, "-m", "tema.remote_marketplace",
+               "--queue-size", str(marketplace_config['queue_size_per_producer']),
+               "--concurrency", args.concurrency, "--log-level", args.log_level,
+               "--log-file", os.path.abspath("marketplace.log"), "--selection", args.selection]
+    for option, value in (("--max-open-carts", args.max_open_carts),
+                          ("--cart-ttl", args.cart_ttl), ("--hold-ttl", args.hold_ttl)):
+        if value is not None:
+            command += [option, str(value)]
+    server = subprocess.Popen(
+        command, stdout=subprocess.PIPE, text=True, env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+            filter(None, [base, os.environ.get("PYTHONPATH")]))))
+    address = server.stdout.readline().strip()
+    if not address:
+        raise SystemExit("the marketplace server didn't start")
+    return server, parse_address(address)
+
+
+async def run_asyncio(market_config, order_sink):
+    """
+        Runs every producer and consumer as a task on the asyncio event loop.
+        Producers never finish, so they are cancelled once the consumers are done.
+    """
+    marketplace = AsyncMarketplace(**market_config['marketplace'], order_sink=order_sink)
+
+    producers = [AsyncProducer(**p_market_config, marketplace=marketplace)
+                 for p_market_config in market_config['producers']]
+    producer_tasks = [asyncio.create_task(producer.run()) for producer in producers]
 
-    for consumer in consumers:
-        consumer.start()
+    await asyncio.gather(*(AsyncConsumer(**c_market_config, marketplace=marketplace).run()
+                           for c_market_config in market_config['consumers']))
 
-    for consumer in consumers:
-        consumer.join()
+    for task in producer_tasks:
+        task.cancel()
 
 
 if __name__ == '__main__':